@@ -18,7 +18,6 @@ from email.mime.image import MIMEImage
 import pandas as pd
 import sim_trade
 import matplotlib.pyplot as plt
-import pickle
 from pandas.tseries.offsets import BDay
 import math
 
@@ -89,6 +88,9 @@ def sendMail(Signalled_tx : str, Regressions : pd.DataFrame, image_path : str):
 
 if __name__ == "__main__":
     signalsOnly = False
+    # file per le statistiche cProfile delle fasi, None per non profilare
+    profile_file = None
+    profiler = sim_trade.Profiler(profile=profile_file)
     # cominciamo a lavorare
     print("\nStarting...")
     # setting up Logging
@@ -99,6 +101,10 @@ if __name__ == "__main__":
         print(e)
     logging.basicConfig(filename=log_file_name, level=logging.DEBUG)
     # logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    # dei cicli di simulazione tengo un messaggio di debug ogni 1000, le transazioni vanno in trades.jsonl.
+    # per il log completo: sim_trade.hot_path_logging(logging.NOTSET)
+    sim_trade.hot_path_logging(logging.DEBUG, sample=1000)
+    sim_trade.trade_log("./logs/trades.jsonl", mode='w')
     logging.info("******************************************************")
     logging.info("*      NEW START : " + str(datetime.datetime.now()) + "        *")
     logging.info("******************************************************")
@@ -115,43 +121,34 @@ if __name__ == "__main__":
     sell_all = False
 
 
-    filename = "./data/saved.mkts.data." + str(start_date.date()) + '-' + str(end_date.date())
-    try:
-        # se esiste questo file, lo carico e risparmio qualche minuto
-        file_handle = open(filename, "rb")
-        print("Loading previously saved Initial Portfolio and quotations")
-        logging.info("\nLoading previously saved Initial Portfolio and quotations from: " + str(file_handle.name))
-        myPortfolio = pickle.load(file_handle)
-        file_handle.close()
-    except FileNotFoundError:
-        # Create and Initialise myPortfolio
-        myPortfolio = sim_trade.Portfolio(start_date, end_date, initial_capital, days_short=short_stats, days_long=long_stats)
-        print("\tInit Portfolio")
+    # Create and Initialise myPortfolio
+    myPortfolio = sim_trade.Portfolio(start_date, end_date, initial_capital, days_short=short_stats, days_long=long_stats)
+    print("\tInit Portfolio")
+    with profiler.stage("loadAssetList"):
         myPortfolio.loadAssetList()
-        timestamp = datetime.datetime.now()
-        logging.info("\nRetrieving assets history from: " + str(start_date) + " to: " + str(end_date))
-        print("\tLoading quotations")
-        myPortfolio.loadQuotations('./data/cache')
-        logging.info("Retrieve completed in " + str(datetime.datetime.now() - timestamp))
-        # adesso dovrei aver recuperato tutti i dati...
-        # Devo sistemare i gap nelle date perché non voglio continuare a controllare se un indice esiste o meno...
-        print("\tCalculating Basic Stats")
+    logging.info("\nRetrieving assets history from: " + str(start_date) + " to: " + str(end_date))
+    print("\tLoading quotations")
+    # le quotazioni già scaricate stanno in ./data/quotes, un simbolo per file, e servono qualunque finestra di date
+    with profiler.stage("loadQuotations"):
+        failures = myPortfolio.loadQuotations('./data/cache', store=sim_trade.QuoteStore('./data/quotes'))
+    for symbol, error in failures.items():
+        print("\tFailed to retrieve " + symbol + ", skipping it: " + error)
+    # adesso dovrei aver recuperato tutti i dati...
+    # Devo sistemare i gap nelle date perché non voglio continuare a controllare se un indice esiste o meno...
+    # NB: lo store contiene solo le quotazioni grezze, statistiche e correzioni vengono ricalcolate ad ogni lancio
+    print("\tCalculating Basic Stats")
+    with profiler.stage("calc_stats"):
         myPortfolio.calc_stats()
-        print("\tFixing Data")
+    print("\tFixing Data")
+    with profiler.stage("fix_history_data"):
         myPortfolio.fix_history_data()
-        # mi salvo il calcolo per velocizzare i miei tests
-        file_handle = open(filename, "wb")
-        logging.info("\nSaving Initial Portfolio and quotations to: " + str(file_handle.name))
-        pickle.dump(myPortfolio, file_handle)
-        file_handle.close()
     # devo definire una strategia di Trading
     top_strategy = sim_trade.InvBollbandsStrategy(myPortfolio)
     print("\tCalculating Signals for " + top_strategy.description)
     # calcolo i segnali BUY e SELL
-    timestamp = datetime.datetime.now()
     logging.info("\nCalculating BUY/SELL Signals")
-    my_strategy_signals = top_strategy.calc_suggested_transactions(sell_all=sell_all, initial_buy=True, w_short=3.0, w_long=1.0)
-    logging.info("Signals calculated in " + str(datetime.datetime.now() - timestamp))
+    with profiler.stage("signals " + top_strategy.description):
+        my_strategy_signals = top_strategy.calc_suggested_transactions(sell_all=sell_all, initial_buy=True, w_short=3.0, w_long=1.0)
     # Printing raw Signals
     print("Calculation Outcome:")
     print()
@@ -165,14 +162,14 @@ if __name__ == "__main__":
 
     if signalsOnly:
         # se voglio solo i segnali posso finire qui
+        print(profiler.table())
         exit(0)
 
     # processo tutte le transazioni pending e vedo cosa succede
-    timestamp = datetime.datetime.now()
     logging.info("\nExecuting trades")
     print("\n\tSimulating trading")
-    top_port = top_strategy.runTradingSimulation(max_orders=25)
-    logging.info("Trades completed in " + str(datetime.datetime.now() - timestamp))
+    with profiler.stage("simulation " + top_strategy.description):
+        top_port = top_strategy.runTradingSimulation(max_orders=25)
 
     print("\n" + top_port.description + " Executed Tx: ")
     for t in top_port.executedTransactions:
@@ -184,8 +181,10 @@ if __name__ == "__main__":
     # base_strat = sim_trade.InvBollbandsStrategy(myPortfolio)
     # base_strat = sim_trade.BollbandsStrategy(myPortfolio)
     print("\nCalculating " + base_strat.description)
-    base_signals = base_strat.calc_suggested_transactions(sell_all=sell_all, initial_buy=True)
-    base_port = base_strat.runTradingSimulation(max_orders=24.5)
+    with profiler.stage("signals " + base_strat.description):
+        base_signals = base_strat.calc_suggested_transactions(sell_all=sell_all, initial_buy=True)
+    with profiler.stage("simulation " + base_strat.description):
+        base_port = base_strat.runTradingSimulation(max_orders=24.5)
     # base_port.por_history['NetValue'].plot(kind='line', label=base_port.description, legend=True)
     print("\n" + base_port.description + " Executed Tx: ")
     for t in base_port.executedTransactions:
@@ -197,43 +196,52 @@ if __name__ == "__main__":
     # my_strategy = sim_trade.InvBollbandsStrategy(myPortfolio)
     my_strategy = sim_trade.CustomStrategy(myPortfolio)
     print("\nCalculating " + my_strategy.description)
-    my_signals = my_strategy.calc_suggested_transactions(sell_all=sell_all, initial_buy=True)
-    my_port = my_strategy.runTradingSimulation(max_orders=25.5)
+    with profiler.stage("signals " + my_strategy.description):
+        my_signals = my_strategy.calc_suggested_transactions(sell_all=sell_all, initial_buy=True)
+    with profiler.stage("simulation " + my_strategy.description):
+        my_port = my_strategy.runTradingSimulation(max_orders=25.5)
     print("\n" + my_port.description + " Executed Tx: ")
     for t in my_port.executedTransactions:
         if t.verb == "BUY" or t.verb == "SELL":
             print(" Tx: " + str(t))
     # TODO: bisognerebbe stampare una tabella che confronti gli esiti finali, medi e minimi delle tre strategie
 
-    simulations = [top_port, my_port, base_port]
-    simul_outcomes = pd.DataFrame(None, columns=['Simulation Strategy', 'Average Net Value', 'Final Liquidity', 'TotalCommissions', 'TotalDividens',
-                                       'TotalTaxes'])
-    print("\nSimulations Outcome:\n")
-    for simul in simulations:
-        assert isinstance(simul, sim_trade.Portfolio), "Coding error... check Simulations list"
-        simul.por_history.loc[start_date:, 'NetValue'].plot(kind='line', label=simul.description, legend=True)
-        # simul.por_history['TotalTaxes'].plot(kind='line', label=simul.description, legend=True)
-        new_row = {'Simulation Strategy': simul.description, 'Average Net Value': simul.por_history.loc[start_date:, 'NetValue'].mean(), 'Final Liquidity': simul.por_history.loc[end_date, 'Liquidity'], 'TotalCommissions': simul.por_history.loc[end_date, 'TotalCommissions'], 'TotalDividens': simul.por_history.loc[end_date, 'TotalDividens'], 'TotalTaxes': simul.por_history.loc[end_date, 'TotalTaxes']}
-        simul_outcomes = simul_outcomes.append(new_row, ignore_index=True)
-    pd.set_option("display.max_rows", None, "display.max_columns", None, "display.width", 1000)
-    print(simul_outcomes.sort_values(by='Average Net Value', ascending=False))
-
-    # Calculating regressions for currently owned shares
-    Regressions = my_port.get_assets_stats(end_date, 20, True).sort_values(by='XSQ_pct')
-    # Regressions = top_port.get_assets_stats(end_date, 20, True).sort_values(by='XSQ_pct')
-    print()
-    print(Regressions)
-
-    if sys.stdout.isatty():
-        # we are running this from an actual terminal
-        plt.show()
-    else:
-        # You're being piped or redirected
-        # should save a gif of the image
-        print("\nNo tty, saving image")
-        image_path="./data/simulation.png"
-        plt.savefig(image_path)
-        # Email outcomes
-        sendMail(Signalled_tx, Regressions, image_path)
+    with profiler.stage("reporting"):
+        simulations = [top_port, my_port, base_port]
+        simul_outcomes = pd.DataFrame(None, columns=['Simulation Strategy', 'Average Net Value', 'Final Liquidity', 'TotalCommissions', 'TotalDividens',
+                                           'TotalTaxes'])
+        print("\nSimulations Outcome:\n")
+        for simul in simulations:
+            assert isinstance(simul, sim_trade.Portfolio), "Coding error... check Simulations list"
+            simul.por_history.loc[start_date:, 'NetValue'].plot(kind='line', label=simul.description, legend=True)
+            # simul.por_history['TotalTaxes'].plot(kind='line', label=simul.description, legend=True)
+            new_row = {'Simulation Strategy': simul.description, 'Average Net Value': simul.por_history.loc[start_date:, 'NetValue'].mean(), 'Final Liquidity': simul.por_history.loc[end_date, 'Liquidity'], 'TotalCommissions': simul.por_history.loc[end_date, 'TotalCommissions'], 'TotalDividens': simul.por_history.loc[end_date, 'TotalDividens'], 'TotalTaxes': simul.por_history.loc[end_date, 'TotalTaxes']}
+            simul_outcomes = simul_outcomes.append(new_row, ignore_index=True)
+        pd.set_option("display.max_rows", None, "display.max_columns", None, "display.width", 1000)
+        print(simul_outcomes.sort_values(by='Average Net Value', ascending=False))
+
+        # Calculating regressions for currently owned shares
+        Regressions = my_port.get_assets_stats(end_date, 20, True).sort_values(by='XSQ_pct')
+        # Regressions = top_port.get_assets_stats(end_date, 20, True).sort_values(by='XSQ_pct')
+        print()
+        print(Regressions)
+
+        if sys.stdout.isatty():
+            # we are running this from an actual terminal
+            plt.show()
+        else:
+            # You're being piped or redirected
+            # should save a gif of the image
+            print("\nNo tty, saving image")
+            image_path="./data/simulation.png"
+            plt.savefig(image_path)
+            # Email outcomes
+            sendMail(Signalled_tx, Regressions, image_path)
+
+    print("\nStages:\n")
+    print(profiler.table())
+    logging.info("Stages:\n" + profiler.table().to_string())
+    if profile_file:
+        profiler.dump()
 
     print("\nEnded, please check log file.\n")
@@ -0,0 +1,152 @@
+# ver 1.0
+
+"""
+Benchmark: runs the whole pipeline on synthetic markets of growing size and times every stage, from the loading
+of the quotations to the valuation of the simulated portfolios. The market is generated before the timed stages,
+"generate" is reported but it is not sim_trade. Each stage is a JSON line of the output file, with
+the commit and the versions of the libraries, so runs of different commits can be compared.
+The quotations come from sim_trade.SyntheticProvider, seeded, with missing days, splits, pence/pound glitches on
+the London symbols and equities in USD, GBP, CHF and EUR. No network is needed.
+It relies on the sim_trade library
+
+example: python benchmark.py --assets 10 100 1000 --years 1 5 --label "before the new order book"
+the largest scales (10000 assets, 20 years) need several GB of memory
+"""
+
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+import sim_trade
+from pandas.tseries.offsets import BDay
+
+# suffisso del simbolo -> valuta, i titoli del benchmark vengono distribuiti a rotazione sui mercati
+MARKETS = {"": "USD", ".L": "GBP", ".SW": "CHF", ".MI": "EUR"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Times the stages of the pipeline on synthetic markets")
+    parser.add_argument("--assets", nargs='+', type=int, default=[10, 100, 1000], help="number of equities")
+    parser.add_argument("--years", nargs='+', type=int, default=[1, 5], help="years of simulation")
+    parser.add_argument("--strategies", nargs='+', default=["BuyAndHoldTradingStrategy", "InvBollbandsStrategy",
+                                                           "BollbandsStrategy"], help="strategy classes of sim_trade")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gap-rate", type=float, default=0.01, help="probability of a missing quotation")
+    parser.add_argument("--split-rate", type=float, default=0.05, help="expected splits per year of an equity")
+    parser.add_argument("--glitch-rate", type=float, default=0.002, help="probability of a day quoted in pounds")
+    parser.add_argument("--trace-memory", action="store_true", help="peak memory of each stage, slower")
+    parser.add_argument("--label", default="", help="free text saved with the results")
+    parser.add_argument("--output", default="./logs/benchmark.jsonl", help="JSON lines file, results are appended")
+    return parser.parse_args()
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+class PreparedProvider(sim_trade.MarketDataProvider):
+    """
+    Quotations generated before the timed stages, so that loadQuotations measures the library and not the generator
+    """
+
+    def __init__(self, provider: sim_trade.MarketDataProvider, symbols: list, end_date: datetime.date):
+        origin = getattr(provider, 'origin', pd.Timestamp(datetime.date(2000, 1, 3)))
+        self.history = {symbol: provider.get_history(symbol, origin, end_date) for symbol in symbols}
+
+    def get_history(self, symbol, start_date, end_date):
+        quotes, actions = self.history[symbol]
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        if len(actions) > 0:
+            actions = actions[(actions.index >= start_date) & (actions.index <= end_date)]
+        return [quotes.loc[start_date:end_date].copy(), actions.copy()]
+
+    def get_quotes(self, symbol, start_date, end_date):
+        return self.get_history(symbol, start_date, end_date)[0]
+
+    def get_actions(self, symbol, start_date, end_date):
+        return self.get_history(symbol, start_date, end_date)[1]
+
+
+def synthetic_portfolio(assets: int, years: int) -> sim_trade.Portfolio:
+    # la storia parte un anno prima, per gli indicatori lunghi
+    start_date = pd.Timestamp(datetime.date(2001, 1, 2))
+    end_date = start_date + pd.DateOffset(years=years) + BDay(0)
+    portfolio = sim_trade.Portfolio(start_date, end_date, 100000.0, days_short=20, days_long=150,
+                                    description="Benchmark " + str(assets) + " x " + str(years) + "y")
+    for currency in sorted(set(MARKETS.values()) - {portfolio.defCurrency}):
+        portfolio.assets[currency] = sim_trade.Asset(sim_trade.CURRENCY, currency, currency + "EUR=X", "FX",
+                                                     currency)
+    suffixes = list(MARKETS)
+    for i in range(assets):
+        suffix = suffixes[i % len(suffixes)]
+        symbol = "S" + str(i).zfill(5) + suffix
+        portfolio.assets[symbol] = sim_trade.Asset(sim_trade.EQUITY, symbol, symbol, "BENCH", MARKETS[suffix])
+    return portfolio
+
+
+def run(assets: int, years: int, provider: sim_trade.MarketDataProvider, strategies: list,
+        trace_memory: bool) -> pd.DataFrame:
+    profiler = sim_trade.Profiler(trace_memory=trace_memory)
+    portfolio = synthetic_portfolio(assets, years)
+    with profiler.stage("generate"):
+        prepared = PreparedProvider(provider, [asset.symbol for asset in portfolio.assets.values()],
+                                    portfolio.end_date)
+    with profiler.stage("loadQuotations"):
+        failures = portfolio.loadQuotations(provider=prepared)
+    assert not failures, failures
+    with profiler.stage("calc_stats"):
+        portfolio.calc_stats()
+    with profiler.stage("fix_history_data"):
+        portfolio.fix_history_data()
+    for strategy_class in strategies:
+        strategy = strategy_class(portfolio)
+        name = strategy_class.__name__
+        with profiler.stage("signals " + name):
+            strategy.calc_suggested_transactions(sell_all=True, initial_buy=True)
+        with profiler.stage("simulation " + name):
+            outcome = strategy.runTradingSimulation()
+        with profiler.stage("valuation " + name):
+            outcome.port_net_value()
+            sim_trade.simulation_outcome(outcome)
+    results = profiler.table()
+    results.insert(0, 'days', len(portfolio.por_history))
+    results.insert(0, 'years', years)
+    results.insert(0, 'assets', assets)
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("\nStarting...")
+    os.makedirs("./logs", exist_ok=True)
+    logging.basicConfig(filename="./logs/benchmark.log", level=logging.INFO)
+    # i cicli di simulazione non scrivono nel log, altrimenti misurerei il logging
+    sim_trade.hot_path_logging()
+    provider = sim_trade.SyntheticProvider(seed=args.seed, gap_rate=args.gap_rate, split_rate=args.split_rate,
+                                           glitch_rate=args.glitch_rate)
+    strategies = [getattr(sim_trade, name) for name in args.strategies]
+    run_info = {'run': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit(),
+                'label': args.label, 'sim_trade': sim_trade.__version__, 'python': platform.python_version(),
+                'numpy': np.__version__, 'pandas': pd.__version__, 'seed': args.seed}
+    pd.set_option("display.max_rows", None, "display.max_columns", None, "display.width", 1000)
+    for years in args.years:
+        for assets in args.assets:
+            print("\t" + str(assets) + " assets, " + str(years) + " years")
+            results = run(assets, years, provider, strategies, args.trace_memory)
+            print(results)
+            # i NaN (memoria non misurata) diventano null
+            records = results.astype(object).where(results.notna(), None).to_dict(orient='records')
+            with open(args.output, "a") as output:
+                for record in records:
+                    output.write(json.dumps(dict(run_info, **record)) + "\n")
+    print("\nResults appended to " + args.output + "\n")
@@ -1,6 +1,7 @@
 #!/bin/bash
 
-let MAX_RETRIES=10
+# i download falliti vengono già ritentati da sim_trade, qui riprovo solo se il programma si blocca
+let MAX_RETRIES=3
 let TRIES=0
 
 BASE_DIR=$(dirname $0)
@@ -9,7 +10,8 @@ echo ${BASE_DIR}
 
 
 cd ${BASE_DIR}
-rm ${BASE_DIR}/data/*
+# le quotazioni in data/quotes vengono aggiornate in modo incrementale, cancello solo la cache HTTP
+rm -f ${BASE_DIR}/data/cache.sqlite
 
 
 
@@ -18,8 +20,6 @@ python3 backtest.py
 while [ $? -ne 0 ] && [ $TRIES -lt $MAX_RETRIES ]; do
 	mv ${BASE_DIR}/logs/backtesting.log ${BASE_DIR}/logs/backtesting.log.old.$TRIES
 	let TRIES=$TRIES+1
-	sqlite3  ./data/cache.sqlite 'delete from responses ORDER BY rowid DESC LIMIT 10;'
-        # sqlitebrowser data/cache.sqlite
 	python3 backtest.py	
 done
 
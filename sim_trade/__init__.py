@@ -1,19 +1,39 @@
+import asyncio
+import bisect
+import collections.abc
+import contextlib
 import copy as cp
+import cProfile
 import csv
 import datetime
+import json
 import logging
 import math
+import numbers
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
 import typing
+import zlib
 from typing import Dict
 from pandas.tseries.offsets import BDay
 import pandas as pd
 import requests_cache
 # nota bene, ho patchato l'ultima versione di pandas_datareader per fissare un errore su yahoo split
 from pandas_datareader import data as pdr
-from multiprocessing.dummy import Pool as ThreadPool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import itertools
 import numpy as np
 from sklearn.linear_model import LinearRegression
 from sklearn.preprocessing import PolynomialFeatures
+try:
+    import resource
+except ImportError:
+    # su Windows non c'è: il massimo RSS del processo resta NaN
+    resource = None
 
 """
 This is my sim_trade library. It provides the Portfolio and Trading Strategies objects to run Trading Simulations
@@ -22,15 +42,16 @@ This is my sim_trade library. It provides the Portfolio and Trading Strategies o
 __version__ = '1.1'
 
 # defining function for multi-threading.
+# in caso di errore solleva un'eccezione, sarà fetch_quotations a riprovare
 def download_quotations(array):
-    # we expect asset, start_date, end_date
+    # we expect asset, start_date, end_date, provider
     asset = array[0]
     initial_data_day = array[1]
     end_date = array[2]
-    session = array[3]
+    provider = array[3]
     # Insert some Assertions to make sure we get the right parameters
     assert isinstance(asset, Asset)
-    assert isinstance(session, requests_cache.CachedSession)
+    assert isinstance(provider, MarketDataProvider)
     assert isinstance(initial_data_day, datetime.date)
     assert isinstance(end_date, datetime.date)
 
@@ -38,25 +59,541 @@ def download_quotations(array):
     logging.info("Now retrieving quotations for:\t" + str(asset.symbol) + "\t" + str(asset))
     # per tutti gli asset, tranne il portafoglio stesso e la valuta di riferimento recupero
     # le quotazioni storiche
-    asset.history = pdr.DataReader(asset.symbol, "yahoo", initial_data_day, end_date, session=session)
-    logging.debug("number of objects retrieved: " + str(asset.history.size) + " for " + asset.symbol)
-    # Creo un empty DataFrame per contenere eventuali Dividendi
-    dividends = pd.DataFrame()
+    # quotazioni, dividendi e split arrivano con una sola richiesta
+    # non assegno direttamente asset.history: lo stesso asset può essere scaricato in due finestre diverse
+    history, dividends = provider.get_history(asset.symbol, initial_data_day, end_date)
+    logging.debug("number of objects retrieved: " + str(history.size) + " for " + asset.symbol)
     if asset.assetType.hasDividends():
-        logging.debug("\t" + str(asset.symbol) + " has dividends")
+        # i dividendi generano transazioni sulle valute
+        # devo iterare tra i dividendi e creare degli ordini speciali che devo processare alla fine.
+        logging.debug("\t" + str(asset.symbol) + " has " + str(len(dividends)) + " dividends")
+    else:
+        dividends = pd.DataFrame()
+    return [asset, history, dividends]
+
+
+def fetch_quotations(jobs: list, concurrency: int = 20, retries: int = 3, backoff: float = 1.0) -> list:
+    """
+    Runs download_quotations for every job with asyncio, at most concurrency downloads at a time.
+    A failed download is retried up to retries times, waiting backoff * 2^attempt seconds in between.
+
+    :param jobs: list of [asset, start_date, end_date, provider], as expected by download_quotations
+    :return: one item per job, in the same order: the download_quotations outcome or the last exception raised
+    """
+    async def fetch_one(loop, executor, semaphore, job):
+        attempt = 0
+        while True:
+            try:
+                # pandas_datareader non è asincrono, lo eseguo in un thread
+                async with semaphore:
+                    return await loop.run_in_executor(executor, download_quotations, job)
+            except Exception as e:
+                if attempt >= retries:
+                    logging.error("Giving up on " + str(job[0].symbol) + " after " + str(attempt + 1) + " attempts")
+                    return e
+                logging.warning("Retrying " + str(job[0].symbol) + " (attempt " + str(attempt + 1) + "): " + str(e))
+                # aspetto fuori dal semaforo, così gli altri download proseguono
+                await asyncio.sleep(backoff * 2 ** attempt)
+                attempt += 1
+
+    async def fetch_all():
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return await asyncio.gather(*[fetch_one(loop, executor, semaphore, job) for job in jobs])
+
+    return asyncio.run(fetch_all())
+
+
+# colonne restituite da Yahoo per le quotazioni giornaliere, sono quelle che salvo su disco
+QUOTE_COLUMNS = ['High', 'Low', 'Open', 'Close', 'Volume', 'Adj Close']
+ACTIONS_DTYPE = np.dtype([('Date', 'M8[ns]'), ('action', 'U8'), ('value', 'f8')])
+# tabella dei segnali di una strategia: ogni riga è un ordine suggerito, da eseguire il giorno Date.
+# symbol e reason sono oggetti: un campo a lunghezza fissa troncherebbe le chiavi lunghe degli asset
+SIGNAL_DTYPE = np.dtype([('Date', 'M8[ns]'), ('symbol', 'O'), ('verb', 'U8'), ('score', 'f8'), ('reason', 'O')])
+# colonne degli indicatori aggiunte alle quotazioni da calc_stats: sma_short, std_long, sma_60...
+STAT_COLUMN = re.compile(r"(sma|std)_(short|long|\d+)")
+# colonne con lo stato di una simulazione, aggiunte alle quotazioni da fix_history_data
+STATE_COLUMNS = ['OwnedAmount', 'AverageBuyPrice', 'NetWorth', 'TotTaxes', 'TotCommissions']
+# valute le cui quotazioni arrivano nell'unità minore: le azioni UK sono quotate in pence
+MINOR_UNITS = {"GBP": 100.0}
+# sequenza di esecuzione degli ordini nello stesso giorno, i BUY vengono dopo e sono ordinati per score
+VERB_PRIORITY = {"SPLIT": 0, "DIVIDEND": 1, "SELL": 2}
+# righe di una TransactionLog, l'asset è l'indice nell'elenco degli asset della tabella; integral ricorda se la
+# quantità è stata data come intero, per stamparla senza ".0"
+TRANSACTION_DTYPE = np.dtype([('Date', 'M8[ns]'), ('asset', 'i4'), ('verb', 'U8'), ('state', 'U8'), ('quantity', 'f8'),
+                              ('integral', '?'), ('value', 'f8'), ('score', 'f8'), ('note', 'O')])
+
+
+# Diagnostica dei cicli caldi (segnali, simulazione, valorizzazione): passa da un logger dedicato con argomenti
+# pigri, così il messaggio viene formattato solo se il record viene davvero scritto. hot_path_logging ne alza il
+# livello o lo campiona senza toccare il resto del log
+trace = logging.getLogger("sim_trade.trace")
+# Eventi di trading, uno per transazione eseguita o fallita, come record strutturati: non finiscono nel log testuale
+# e vengono costruiti solo se qualcuno ha aggiunto un handler, vedi trade_log
+trades = logging.getLogger("sim_trade.trades")
+trades.propagate = False
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets through one record every `every`
+    """
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self._seen = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self._seen += 1
+        return (self._seen - 1) % self.every == 0
+
+
+def hot_path_logging(level=logging.WARNING, sample: int = None):
+    """
+    Fast mode for the diagnostics of the hot paths, see trace. With the default level their debug and info records
+    are dropped before any formatting
+    :param level: minimum level of the hot path records, logging.NOTSET follows the root logger again
+    :param sample: keep one record every `sample`, None keeps them all
+    """
+    trace.setLevel(level)
+    for sampler in [f for f in trace.filters if isinstance(f, SampleFilter)]:
+        trace.removeFilter(sampler)
+    if sample:
+        trace.addFilter(SampleFilter(sample))
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats the trade events as one JSON object per line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(getattr(record, 'trade', {'message': record.getMessage()}))
+
+
+def trade_log(path: str, mode: str = 'a') -> logging.Handler:
+    """
+    Writes the trade events in the JSON lines file path
+    :param mode: 'a' appends to the file, 'w' starts a new one
+    :return: the handler, remove it from trades and close it to stop the log
+    """
+    handler = logging.FileHandler(path, mode=mode)
+    handler.setFormatter(JsonLinesFormatter())
+    trades.setLevel(logging.INFO)
+    trades.addHandler(handler)
+    return handler
+
+
+def log_trade(t: 'Transaction', **amounts):
+    """
+    Emits the trade event of the transaction, without a trade log it costs a check
+    :param amounts: amounts of the event besides the fields of the transaction, e.g. liquidity, commission, tax
+    """
+    if trades.handlers and trades.isEnabledFor(logging.INFO):
+        event = {'Date': t.when.date().isoformat(), 'symbol': t.asset.symbol, 'verb': t.verb, 'state': t.state,
+                 'quantity': t.quantity, 'value': t.value, 'score': t.score, 'note': t.note}
+        event.update((name, float(value)) for name, value in amounts.items())
+        trades.info("%s %s %s", t.verb, t.asset.symbol, t.state, extra={'trade': event})
+
+
+# Tempi e memoria delle fasi di un lancio (caricamento, statistiche, segnali, simulazione, report): ogni fase è un
+# blocco with profiler.stage(nome), alla fine table() li riassume e, se richiesto, il cProfile finisce in un file
+class Profiler:
+    """
+    Records wall time, CPU time and memory of named stages. CPU time is the one of this process, the workers of a
+    parallel sweep are not counted
+    """
+
+    def __init__(self, trace_memory: bool = False, profile: str = None):
+        """
+        :param trace_memory: peak of the Python and NumPy allocations of each stage via tracemalloc, it slows the
+         stages down
+        :param profile: file for the cProfile statistics of all the stages, see dump. It can be read by pstats,
+         snakeviz or converted to a flame graph
+        """
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.stages = []
+        self._profiler = cProfile.Profile() if profile else None
+        self._tracing = False
+        # picchi delle fasi aperte, le fasi annidate fanno salire anche il picco di chi le contiene
+        self._open = []
+
+    @staticmethod
+    def _max_rss() -> float:
+        if resource is None:
+            return float('nan')
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux restituisce KiB, macOS byte
+        return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+    def _fold_peak(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self._open:
+            stage['Peak MiB'] = max(stage['Peak MiB'], peak / 2 ** 20)
+        tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Measures the block as the stage name, stages can be nested
+        """
+        record = {'Stage': name, 'Wall s': 0.0, 'CPU s': 0.0, 'Peak MiB': float('nan'), 'Max RSS MiB': float('nan')}
+        self.stages.append(record)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                # tracemalloc resta attivo solo durante le fasi
+                tracemalloc.start()
+                self._tracing = True
+            self._fold_peak()
+            record['Peak MiB'] = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        self._open.append(record)
+        if self._profiler and len(self._open) == 1:
+            self._profiler.enable()
+        wall, cpu = time.perf_counter(), time.process_time()
         try:
-            # i dividendi generano transazioni sulle valute
-            # devo iterare tra i dividendi e creare degli ordini speciali che devo processare alla fine.
-            # Portfolio[value.currency].historic_transactions
-            logging.info("\tGetting " + str(asset.symbol) + " dividends")
-            # Nota Bene: usare stesse date usate per quotazione e poi filtrate il risultato da una certa data in poi per sfruttare la cache
-            dividends = pdr.DataReader(asset.symbol, "yahoo-actions", initial_data_day, end_date, session=session)
-        except Exception as e:
-            logging.error("Failed to get dividends for " + str(asset.name) + "(" + str(asset) + ")")
-            logging.exception("Unexpected error:" + str(e))
-            # per il momento mi blocco, in futuro potrei pensare di riprovare un paio di volte.
-            exit(-1)
-    return [asset, dividends]
+            yield record
+        finally:
+            record['Wall s'] = time.perf_counter() - wall
+            record['CPU s'] = time.process_time() - cpu
+            if self._profiler and len(self._open) == 1:
+                self._profiler.disable()
+            if self.trace_memory:
+                self._fold_peak()
+            self._open.pop()
+            if self._tracing and not self._open:
+                tracemalloc.stop()
+                self._tracing = False
+            record['Max RSS MiB'] = self._max_rss()
+            logging.info("Stage " + name + " completed in " + str(round(record['Wall s'], 3)) + " s")
+
+    def table(self) -> pd.DataFrame:
+        """
+        :return: one row per stage, in the order they started
+        """
+        return pd.DataFrame(self.stages, columns=['Stage', 'Wall s', 'CPU s', 'Peak MiB', 'Max RSS MiB'])
+
+    def dump(self, path: str = None):
+        """
+        Writes the cProfile statistics of the stages, by default in the file given to the constructor
+        """
+        if self._profiler is None:
+            raise ValueError("The Profiler was created without a profile file")
+        self._profiler.dump_stats(path or self.profile)
+
+
+class QuoteStore:
+    """
+    Columnar on-disk store for quotations and corporate actions, one set of files per symbol.
+
+    Each symbol is saved as plain NumPy arrays that are memory-mapped when loaded:
+    <symbol>.dates.npy (datetime64[ns]), <symbol>.values.npy (float64, one column per QUOTE_COLUMNS),
+    <symbol>.actions.npy (dividends and splits) and <symbol>.meta.json with the downloaded date window.
+    Any sub-window of the stored dates can be served without downloading again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, symbol: str, kind: str) -> str:
+        # alcuni simboli contengono caratteri scomodi per il file system (es. "USDEUR=X")
+        return os.path.join(self.path, re.sub(r'[^A-Za-z0-9.\-]', '_', symbol) + "." + kind)
+
+    def _write(self, symbol: str, kind: str, array: np.ndarray):
+        # scrivo su un file temporaneo e poi lo rinomino, così un download interrotto non corrompe lo store
+        tmp_file = self._file(symbol, kind) + ".tmp"
+        with open(tmp_file, "wb") as file_handle:
+            np.save(file_handle, array, allow_pickle=False)
+        os.replace(tmp_file, self._file(symbol, kind))
+
+    def window(self, symbol: str):
+        """
+        :return: the (first_day, last_day) window downloaded for symbol, None if the symbol is not stored
+        """
+        try:
+            with open(self._file(symbol, "meta.json")) as file_handle:
+                meta = json.load(file_handle)
+        except FileNotFoundError:
+            return None
+        return pd.Timestamp(meta['start']), pd.Timestamp(meta['end'])
+
+    def last_bar(self, symbol: str):
+        """
+        :return: the date of the last stored quotation for symbol, None if nothing is stored
+        """
+        try:
+            dates = np.load(self._file(symbol, "dates.npy"), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        return pd.Timestamp(dates[-1]) if len(dates) > 0 else None
+
+    @staticmethod
+    def last_completed_day() -> pd.Timestamp:
+        # la barra di oggi può essere parziale, l'ultima giornata sicuramente chiusa è il giorno lavorativo precedente
+        return pd.Timestamp(datetime.date.today()) - BDay(1)
+
+    def covers(self, symbol: str, start_date: datetime.date, end_date: datetime.date) -> bool:
+        """
+        True if the stored window starts by start_date and reaches end_date, or the last completed trading day
+        when end_date is in the future
+        """
+        window = self.window(symbol)
+        return window is not None and window[0] <= pd.Timestamp(start_date) and min(
+            pd.Timestamp(end_date), self.last_completed_day()) <= window[1]
+
+    def load(self, symbol: str, start_date: datetime.date = None, end_date: datetime.date = None):
+        """
+        Reads the stored quotations of symbol between start_date and end_date (both included).
+
+        Only the pages of the requested window are read from disk: history wraps a slice of a copy-on-write
+        memory map, without copying it. Pandas copies the data as soon as rows are added or reindexed,
+        as fix_history_data does, so the saving is on load time, not on the memory used during a simulation.
+
+        :return: [history, actions]
+        """
+        dates = np.load(self._file(symbol, "dates.npy"), mmap_mode='r')
+        # mmap_mode 'c': fix_history_data corregge alcuni valori, le modifiche restano in memoria e non toccano il file
+        values = np.load(self._file(symbol, "values.npy"), mmap_mode='c')
+        first = 0 if start_date is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start_date)), 'left')
+        last = len(dates) if end_date is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end_date)),
+                                                                   'right')
+        history = pd.DataFrame(values[first:last], index=pd.DatetimeIndex(dates[first:last], name='Date'),
+                               columns=QUOTE_COLUMNS, copy=False)
+        actions = np.load(self._file(symbol, "actions.npy"))
+        if start_date is not None:
+            actions = actions[actions['Date'] >= np.datetime64(pd.Timestamp(start_date))]
+        if end_date is not None:
+            actions = actions[actions['Date'] <= np.datetime64(pd.Timestamp(end_date))]
+        actions = pd.DataFrame({'action': actions['action'].astype(object), 'value': actions['value']},
+                               index=pd.DatetimeIndex(actions['Date'], name='Date'))
+        return [history, actions]
+
+    def save(self, symbol: str, history: pd.DataFrame, actions: pd.DataFrame, start_date: datetime.date,
+             end_date: datetime.date):
+        """
+        Replaces whatever is stored for symbol with history and actions, downloaded for start_date..end_date.
+        The saved window ends at the last quotation actually received, if that comes before end_date, and never
+        after the last completed trading day: a partial bar of today is stored but downloaded again next time.
+        """
+        history = history[~history.index.duplicated(keep='last')].sort_index()
+        end_date = min(pd.Timestamp(end_date), self.last_completed_day())
+        if len(history) > 0:
+            end_date = min(end_date, history.index[-1])
+        self._write(symbol, "dates.npy", history.index.values.astype('M8[ns]'))
+        self._write(symbol, "values.npy", np.ascontiguousarray(history.reindex(columns=QUOTE_COLUMNS).to_numpy(
+            dtype='float64')))
+        stored_actions = np.zeros(len(actions), dtype=ACTIONS_DTYPE)
+        if len(actions) > 0:
+            stored_actions['Date'] = actions.index.values.astype('M8[ns]')
+            stored_actions['action'] = actions['action'].to_numpy(dtype=str)
+            stored_actions['value'] = actions['value'].to_numpy(dtype='float64')
+        self._write(symbol, "actions.npy", np.sort(stored_actions, order='Date'))
+        # il file meta.json è l'ultimo che scrivo: se manca, il simbolo va riscaricato
+        with open(self._file(symbol, "meta.json.tmp"), "w") as file_handle:
+            json.dump({'start': str(pd.Timestamp(start_date).date()), 'end': str(pd.Timestamp(end_date).date())},
+                      file_handle)
+        os.replace(self._file(symbol, "meta.json.tmp"), self._file(symbol, "meta.json"))
+
+    def update(self, symbol: str, history: pd.DataFrame, actions: pd.DataFrame, start_date: datetime.date,
+               end_date: datetime.date):
+        """
+        Merges history and actions, downloaded for start_date..end_date, into what is stored for symbol.
+        Stored rows between start_date and end_date are replaced by the downloaded ones.
+        """
+        window = self.window(symbol)
+        if window is None:
+            self.save(symbol, history, actions, start_date, end_date)
+            return
+        start_date = pd.Timestamp(start_date)
+        end_date = pd.Timestamp(end_date)
+        old_history, old_actions = self.load(symbol)
+        old_history = old_history[(old_history.index < start_date) | (old_history.index > end_date)]
+        old_actions = old_actions[(old_actions.index < start_date) | (old_actions.index > end_date)]
+        if len(actions) > 0:
+            old_actions = pd.concat([old_actions, actions])
+        self.save(symbol, pd.concat([old_history, history]), old_actions, min(window[0], start_date),
+                  max(window[1], end_date))
+
+
+# Le quotazioni possono arrivare da fonti diverse: Yahoo, file locali o dati sintetici per test e benchmark.
+# Per aggiungere una fonte eredito da MarketDataProvider e faccio override di get_quotes e get_actions
+class MarketDataProvider:
+    """
+    Source of quotations and corporate actions used by Portfolio.loadQuotations
+    """
+
+    def get_quotes(self, symbol: str, start_date: datetime.date, end_date: datetime.date) -> pd.DataFrame:
+        """
+        :return: daily quotations between start_date and end_date, indexed by 'Date', with QUOTE_COLUMNS
+        """
+        raise NotImplementedError
+
+    def get_actions(self, symbol: str, start_date: datetime.date, end_date: datetime.date) -> pd.DataFrame:
+        """
+        :return: dividends and splits between start_date and end_date, indexed by 'Date', with columns
+         'action' ("DIVIDEND" or "SPLIT") and 'value'
+        """
+        return pd.DataFrame(columns=['action', 'value'])
+
+    def get_history(self, symbol: str, start_date: datetime.date, end_date: datetime.date) -> list:
+        """
+        :return: [quotations, actions] for the window, see get_quotes and get_actions.
+         Providers that can get both with a single request override this method
+        """
+        return [self.get_quotes(symbol, start_date, end_date), self.get_actions(symbol, start_date, end_date)]
+
+
+class YahooProvider(MarketDataProvider):
+    """
+    Yahoo quotations through pandas_datareader, get_history asks quotations, dividends and splits with one request
+    """
+
+    def __init__(self, session: requests_cache.CachedSession):
+        self.session = session
+
+    def get_quotes(self, symbol, start_date, end_date):
+        return self.get_history(symbol, start_date, end_date)[0]
+
+    def get_actions(self, symbol, start_date, end_date):
+        return self.get_history(symbol, start_date, end_date)[1]
+
+    def get_history(self, symbol, start_date, end_date):
+        start_date = pd.Timestamp(start_date)
+        end_date = pd.Timestamp(end_date)
+        # con get_actions Yahoo aggiunge le colonne Dividends e Splits alle quotazioni
+        data = pdr.get_data_yahoo(symbol, start_date, end_date, session=self.session, get_actions=True)
+        history = data.reindex(columns=QUOTE_COLUMNS)
+        # le righe dei soli dividendi non hanno quotazioni
+        history = history[history['Close'].notna()]
+        actions = []
+        for column, verb in (('Dividends', "DIVIDEND"), ('Splits', "SPLIT")):
+            if column in data.columns:
+                action = data[column].dropna().to_frame(name='value')
+                action = action[action['value'] != 0.0]
+                action['action'] = verb
+                actions.append(action[['action', 'value']])
+        if len(actions) == 0:
+            return [history, super().get_actions(symbol, start_date, end_date)]
+        return [history, pd.concat(actions).sort_index(ascending=False)]
+
+
+class DirectoryProvider(MarketDataProvider):
+    """
+    Reads quotations from a local directory, one file per symbol: <symbol>.csv or <symbol>.parquet
+    with a 'Date' column plus QUOTE_COLUMNS. Dividends and splits are optional, in <symbol>.actions.csv
+    or <symbol>.actions.parquet with columns 'Date', 'action' and 'value'.
+    Parquet files need pyarrow (or fastparquet) installed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read(self, name: str):
+        # uso gli stessi nomi file di QuoteStore, per i simboli con caratteri strani (es. "USDEUR=X")
+        name = os.path.join(self.path, re.sub(r'[^A-Za-z0-9.\-]', '_', name))
+        if os.path.exists(name + ".parquet"):
+            data = pd.read_parquet(name + ".parquet")
+        elif os.path.exists(name + ".csv"):
+            data = pd.read_csv(name + ".csv", parse_dates=['Date'])
+        else:
+            return None
+        if 'Date' in data.columns:
+            data = data.set_index('Date')
+        data.index = pd.DatetimeIndex(data.index, name='Date')
+        return data.sort_index()
+
+    def get_quotes(self, symbol, start_date, end_date):
+        history = self._read(symbol)
+        if history is None:
+            raise FileNotFoundError("No quotations for " + symbol + " in " + self.path)
+        return history.loc[pd.Timestamp(start_date):pd.Timestamp(end_date)].reindex(columns=QUOTE_COLUMNS)
+
+    def get_actions(self, symbol, start_date, end_date):
+        actions = self._read(symbol + ".actions")
+        if actions is None:
+            return super().get_actions(symbol, start_date, end_date)
+        return actions.loc[pd.Timestamp(start_date):pd.Timestamp(end_date), ['action', 'value']]
+
+
+class SyntheticProvider(MarketDataProvider):
+    """
+    Deterministic random quotations, no network needed: geometric Brownian motion prices and quarterly dividends.
+    The series of a symbol depends only on seed and symbol, so any window of dates returns the same values.
+    Symbols ending with "=X" are treated as exchange rates, with values around 1 and a lower volatility.
+    Optionally the quotations have the defects of real data: missing days, splits and, for the ".L" symbols,
+    days quoted in pounds instead of pence.
+    """
+
+    def __init__(self, seed: int = 0, origin: datetime.date = datetime.date(2000, 1, 3), drift: float = 0.05,
+                 volatility: float = 0.25, dividend_yield: float = 0.02, gap_rate: float = 0.0,
+                 split_rate: float = 0.0, glitch_rate: float = 0.0):
+        """
+        :param gap_rate: probability that a business day has no quotation
+        :param split_rate: expected splits per year of an equity, 2:1 or 3:1. Prices stay split adjusted as on Yahoo
+        :param glitch_rate: probability that Open and Close of a ".L" symbol are in pounds on a day
+        """
+        self.seed = seed
+        self.origin = pd.Timestamp(origin)
+        self.drift = drift
+        self.volatility = volatility
+        self.dividend_yield = dividend_yield
+        self.gap_rate = gap_rate
+        self.split_rate = split_rate
+        self.glitch_rate = glitch_rate
+
+    def _rng(self, symbol: str, stream: int):
+        return np.random.default_rng([self.seed, zlib.crc32(symbol.encode()), stream])
+
+    def _series(self, symbol: str, end_date: datetime.date) -> pd.DataFrame:
+        # genero sempre a partire da origin, così il valore di una data non dipende dalla finestra richiesta
+        # ogni grandezza ha il suo generatore: i primi n valori non cambiano allungando la serie
+        # i giorni lavorativi con numpy: bdate_range genera le date una per una ed è il costo maggiore
+        days = np.arange(self.origin.to_datetime64().astype('M8[D]'),
+                         pd.Timestamp(end_date).to_datetime64().astype('M8[D]') + 1)
+        dates = pd.DatetimeIndex(days[np.is_busday(days)].astype('M8[ns]'), name='Date')
+        volatility = self.volatility / 5 if symbol.endswith("=X") else self.volatility
+        daily_volatility = volatility / math.sqrt(252)
+        first_price = self._rng(symbol, 0).uniform(0.5, 1.5) if symbol.endswith("=X") else self._rng(
+            symbol, 0).uniform(10.0, 200.0)
+        daily_returns = self._rng(symbol, 2).normal((self.drift - volatility ** 2 / 2) / 252, daily_volatility,
+                                                     len(dates))
+        close = first_price * np.exp(np.cumsum(daily_returns))
+        open_price = np.concatenate(([first_price], close[:-1])) * np.exp(
+            self._rng(symbol, 3).normal(0.0, daily_volatility / 4, len(dates)))
+        spread = np.abs(self._rng(symbol, 4).normal(0.0, daily_volatility / 2, len(dates)))
+        return pd.DataFrame({'High': np.maximum(open_price, close) * (1 + spread),
+                             'Low': np.minimum(open_price, close) * (1 - spread),
+                             'Open': open_price, 'Close': close,
+                             'Volume': self._rng(symbol, 5).integers(1000, 1000000, len(dates)).astype('float64'),
+                             'Adj Close': close}, index=dates)
+
+    def get_quotes(self, symbol, start_date, end_date):
+        history = self._series(symbol, end_date)
+        # anche i difetti sono estratti su tutta la serie, dal primo giorno
+        if self.glitch_rate > 0.0 and symbol.endswith(".L"):
+            glitch = self._rng(symbol, 6).random(len(history)) < self.glitch_rate
+            history.loc[glitch, ['Open', 'Close']] /= 100
+        if self.gap_rate > 0.0:
+            history = history[self._rng(symbol, 7).random(len(history)) >= self.gap_rate]
+        return history.loc[pd.Timestamp(start_date):]
+
+    def get_actions(self, symbol, start_date, end_date):
+        if symbol.endswith("=X"):
+            return super().get_actions(symbol, start_date, end_date)
+        close = self._series(symbol, end_date)['Close']
+        # un dividendo ogni 63 giorni lavorativi (circa un trimestre), con una fase diversa per ogni simbolo
+        phase = int(self._rng(symbol, 1).integers(0, 63))
+        paid = close.iloc[phase::63]
+        actions = pd.DataFrame({'action': "DIVIDEND", 'value': paid * self.dividend_yield / 4}, index=paid.index)
+        if self.split_rate > 0.0:
+            split = self._rng(symbol, 8).random(len(close)) < self.split_rate / 252
+            ratio = self._rng(symbol, 9).choice([2.0, 3.0], len(close))[split]
+            actions = pd.concat([actions, pd.DataFrame({'action': "SPLIT", 'value': ratio},
+                                                       index=close.index[split])]).sort_index()
+        return actions.loc[pd.Timestamp(start_date):].sort_index(ascending=False)
 
 
 # Defining Basic Classes
@@ -115,8 +652,40 @@ class Asset:
         self.currency = currency
         # self.avg_buy_price = avg_buy_price  # this is in the actual asset currency
         # self.avg_buy_curr_chg = avg_buy_curr_chg  # this is the average exchange from asset curr. to default one (EURO)
+        self.market_data = None
         self.history = history
 
+    # finché il Portfolio non costruisce il MarketData history è un DataFrame autonomo,
+    # dopo diventa una vista sulle colonne dell'asset nel pannello: le scritture via .loc finiscono nel pannello
+    @property
+    def history(self) -> pd.DataFrame:
+        if self.market_data is not None and self._history_version != self.market_data.version:
+            self._history = self.market_data.frame(self._market_key)
+            self._history_version = self.market_data.version
+        return self._history
+
+    @history.setter
+    def history(self, history: pd.DataFrame):
+        self._history = history
+        self.market_data = None
+
+    def attach(self, market_data: 'MarketData', key: str):
+        """
+        :param market_data: panel containing this asset
+        :param key: column of the asset in the panel, the key of the asset in Portfolio.assets
+        """
+        self.market_data = market_data
+        self._market_key = key
+        self._history_version = -1
+
+    def __getstate__(self):
+        # la vista non va copiata: viene ricostruita sul pannello copiato (o caricato) insieme al Portfolio
+        state = self.__dict__.copy()
+        if self.market_data is not None:
+            state['_history'] = None
+            state['_history_version'] = -1
+        return state
+
     def __str__(self):
         # return self.symbol + "\t" + self.name + "\t" + str(self.quantity) + "\t" + str(self.assetType)
         return self.name + "\t" + str(self.assetType)
@@ -174,60 +743,556 @@ class Asset:
 # se il verbo è DIVIDEND, è il valore unitario del dividendo nella valuta dell'asset
 # Deve avere un commento
 class Transaction:
-    def __init__(self, verb, asset, when, quantity=0, value=0.0, note="", state="pending", score=100):
+    # i campi vivono in una riga di una TransactionLog: di solito quella del book o della lista del Portfolio che la
+    # conterrà (log), altrimenti una tabella tutta sua finché non entra in un book o in una lista
+    __slots__ = ('_log', '_row')
+
+    def __init__(self, verb, asset, when, quantity=0, value=0.0, note="", state="pending", score=100,
+                 log: 'TransactionLog' = None):
         assert isinstance(asset, Asset)
         assert isinstance(when, datetime.date)
-        self.when = when
-        self.asset = asset
         tx_valid_verbs = ("BUY", "SELL", "DIVIDEND", "SPLIT")
-        if verb in tx_valid_verbs:
-            self.verb = verb
-        else:
+        if verb not in tx_valid_verbs:
             raise ValueError(str(verb) + ": Invalid action. Transaction verb must be one of: " + str(tx_valid_verbs))
         tx_valid_states = ("pending", "executed", "failed")
-        if state in tx_valid_states:
-            self.state = state
-        else:
+        if state not in tx_valid_states:
             raise ValueError("Transaction state must be one of: " + str(tx_valid_states))
-        if quantity >= 0:
-            self.quantity = quantity
-        else:
+        if quantity < 0:
             raise ValueError("Transaction quantity must be a positive number")
-        if value >= 0.0:
-            self.value = value
-        else:
+        if value < 0.0:
             raise ValueError("Transaction value must be a positive number")
-        self.note = note
-        self.score = score
+        self._log = TransactionLog(capacity=1) if log is None else log
+        self._row = self._log.add(verb, asset, when, quantity, value, note, state, score)
+
+    def __eq__(self, other):
+        # due viste sulla stessa riga sono la stessa transazione
+        return isinstance(other, Transaction) and self._log is other._log and self._row == other._row
+
+    def __hash__(self):
+        return hash((id(self._log), self._row))
+
+    def _field(self, name):
+        return self._log._data[name][self._row]
+
+    def _set(self, name, value):
+        self._log._data[name][self._row] = value
+
+    @property
+    def when(self) -> pd.Timestamp:
+        return pd.Timestamp(self._field('Date'))
+
+    @when.setter
+    def when(self, when: datetime.date):
+        self._set('Date', pd.Timestamp(when).to_datetime64())
+
+    @property
+    def asset(self) -> 'Asset':
+        return self._log.assets[self._field('asset')]
+
+    @asset.setter
+    def asset(self, asset: 'Asset'):
+        self._set('asset', self._log.asset_id(asset))
+
+    @property
+    def verb(self) -> str:
+        return str(self._field('verb'))
+
+    @verb.setter
+    def verb(self, verb: str):
+        self._set('verb', verb)
+
+    @property
+    def state(self) -> str:
+        return str(self._field('state'))
+
+    @state.setter
+    def state(self, state: str):
+        self._set('state', state)
+
+    @property
+    def quantity(self) -> float:
+        return float(self._field('quantity'))
+
+    @quantity.setter
+    def quantity(self, quantity: float):
+        self._set('quantity', quantity)
+        self._set('integral', isinstance(quantity, numbers.Integral))
+
+    @property
+    def value(self) -> float:
+        return float(self._field('value'))
+
+    @value.setter
+    def value(self, value: float):
+        self._set('value', value)
+
+    @property
+    def score(self) -> float:
+        return float(self._field('score'))
+
+    @score.setter
+    def score(self, score: float):
+        self._set('score', score)
+
+    @property
+    def note(self) -> str:
+        return self._field('note')
+
+    @note.setter
+    def note(self, note: str):
+        self._set('note', note)
 
     def __str__(self):
+        quantity = int(self.quantity) if self._field('integral') else self.quantity
         return str(self.when.date()) + " : " + self.verb + "\t" + self.asset.symbol + "\t" + str(
-            self.value) + " " + str(self.quantity) + " " + self.state + "\tscore: " + str(self.score)
+            self.value) + " " + str(quantity) + " " + self.state + "\tscore: " + str(self.score)
+
+    def priority(self) -> int:
+        """
+        Execution order of the transaction within its day: first SPLIT, then DIVIDEND, then SELL and finally BUY,
+        the BUY with the highest score first. Scores outside 1..30 are sorted as 1, the score itself is not changed
+        """
+        if self.verb == "BUY":
+            # In caso di BUY, ordino ulteriormente in base allo "score" della transazione, siccome in questo caso
+            # penalizzo le transazioni con score più alto faccio l'inverso
+            score = self.score
+            if math.isnan(score) or score < 1 or score > 30:
+                trace.debug("txt score for %s is out of range, sorted as 1", self)
+                score = 1
+            return 3 + int(100 / score)
+        return VERB_PRIORITY[self.verb]
 
     # credo un metodo statico che userò per ordinare gli array di trabsazioni
     @staticmethod
     def to_datetime(txt):
         assert isinstance(txt, Transaction)
-        # trasformo la data in un numero e ci aggiungo 1 h per ordinare la sequenza con cui eseguire gli ordini
-        # la sequenza deve essere
-        # prima SPLIT, poi DIVIDEND, poi SELL e infine BUY
-        verbSort = None
-        if txt.verb == "SPLIT":
-            verbSort = 0
-        elif txt.verb == "DIVIDEND":
-            verbSort = 1
-        elif txt.verb == "SELL":
-            verbSort = 2
-        elif txt.verb == "BUY":
-            # In caso di BUY, ordino ulteriormente in base allo "score" della transazione, siccome in questo caso
-            # penalizzo le transazioni con score più alto faccio l'inverso
-            if math.isnan(txt.score) or txt.score < 1 or txt.score > 30:
-                logging.info("txt score for " + str(txt) + " has been changed from " + str(txt.score) + " to 1")
-                txt.score = 1
-            verbSort = 3 + int(100 / txt.score)
-        else:
-            raise
-        return datetime.datetime.combine(txt.when, datetime.time.min) + datetime.timedelta(minutes=verbSort)
+        # trasformo la data in un numero e ci aggiungo i minuti della priorità per ordinare la sequenza degli ordini
+        return datetime.datetime.combine(txt.when, datetime.time.min) + datetime.timedelta(minutes=txt.priority())
+
+
+# Tabella a colonne delle transazioni, una riga per transazione in un array strutturato che cresce raddoppiando.
+# Al posto del puntatore all'Asset ogni riga ha l'indice dell'asset nell'elenco della tabella
+class TransactionLog(collections.abc.Sequence):
+    """
+    Columnar list of transactions. Items are Transaction views on the rows, the whole table is exported at once
+    by frame and to_parquet
+    """
+
+    def __init__(self, capacity=16):
+        self.assets = []
+        self._ids = dict()
+        self._data = np.zeros(capacity, TRANSACTION_DTYPE)
+        self._count = 0
+
+    @property
+    def table(self) -> np.ndarray:
+        """
+        :return: the rows of the transactions, a TRANSACTION_DTYPE array
+        """
+        return self._data[:self._count]
+
+    def asset_id(self, asset: 'Asset') -> int:
+        """
+        :return: index of the asset in self.assets, the asset is added if it is new
+        """
+        if asset.symbol not in self._ids:
+            self._ids[asset.symbol] = len(self.assets)
+            self.assets.append(asset)
+        return self._ids[asset.symbol]
+
+    def _reserve(self) -> int:
+        if self._count == len(self._data):
+            data = np.zeros(max(2 * len(self._data), 16), TRANSACTION_DTYPE)
+            data[:self._count] = self._data[:self._count]
+            self._data = data
+        self._count += 1
+        return self._count - 1
+
+    def add(self, verb, asset, when, quantity=0, value=0.0, note="", state="pending", score=100) -> int:
+        """
+        Adds a row without validating it, see Transaction
+        :return: the position of the row
+        """
+        row = self._reserve()
+        self._data[row] = (pd.Timestamp(when).to_datetime64(), self.asset_id(asset), verb, state, quantity,
+                           isinstance(quantity, numbers.Integral), value, score, note)
+        return row
+
+    def append(self, t: Transaction):
+        """
+        Copies the current fields of the transaction in a new row
+        """
+        row = self._reserve()
+        self._data[row] = t._log._data[t._row]
+        self._data['asset'][row] = self.asset_id(t.asset)
+
+    def adopt(self, t: Transaction):
+        """
+        Moves the transaction in a new row of this table, t becomes a view on that row
+        """
+        if t._log is not self:
+            self.append(t)
+            t._log, t._row = self, self._count - 1
+
+    def copy(self, assets: Dict[str, 'Asset'] = None) -> 'TransactionLog':
+        """
+        :param assets: replacement assets by symbol, used when the copy belongs to a copy of the Portfolio
+        """
+        log = TransactionLog(capacity=max(self._count, 1))
+        log._data[:self._count] = self.table
+        log._count = self._count
+        for asset in self.assets:
+            log.asset_id(assets.get(asset.symbol, asset) if assets else asset)
+        return log
+
+    def frame(self) -> pd.DataFrame:
+        """
+        :return: one row per transaction, with the asset symbol in place of the asset
+        """
+        table = self.table
+        symbols = np.array([asset.symbol for asset in self.assets], dtype=object)
+        return pd.DataFrame({'Date': table['Date'], 'symbol': symbols[table['asset']], 'verb': table['verb'],
+                             'quantity': table['quantity'], 'value': table['value'], 'state': table['state'],
+                             'score': table['score'], 'note': table['note']})
+
+    def to_parquet(self, path: str):
+        """
+        Writes frame() to a Parquet file, it needs pyarrow or fastparquet
+        """
+        self.frame().to_parquet(path, index=False)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if not -self._count <= i < self._count:
+            raise IndexError("TransactionLog index out of range")
+        t = Transaction.__new__(Transaction)
+        t._log, t._row = self, i % self._count
+        return t
+
+    def __len__(self) -> int:
+        return self._count
+
+
+# Gli ordini in attesa, per giorno del calendario del Portfolio. Le transazioni stanno nelle righe di una
+# TransactionLog e solo i giorni con almeno un ordine occupano memoria: ogni giorno è una lista di (priorità, riga)
+# mantenuta ordinata ad ogni inserimento, così la simulazione la legge già nell'ordine di esecuzione
+class OrderBook(collections.abc.Mapping):
+    """
+    Pending transactions by trading day. Reading a day returns its transactions in insertion order, execution_order
+    returns them in the order they are executed, see Transaction.priority. Iterating gives only the days with orders
+    """
+
+    def __init__(self, calendar: pd.DatetimeIndex):
+        """
+        :param calendar: trading days that can hold orders
+        """
+        self.calendar = pd.DatetimeIndex(calendar)
+        self.log = TransactionLog()
+        self._days = dict()
+
+    def day(self, when: datetime.date) -> int:
+        """
+        :param when: trading day
+        :return: position of the day in the calendar, KeyError if it is not in the calendar
+        """
+        return self.calendar.get_loc(pd.Timestamp(when))
+
+    def add(self, t: Transaction):
+        """
+        Adds a pending transaction on the day t.when, t becomes a view on its row of self.log
+        """
+        orders = self._days.setdefault(self.day(t.when), [])
+        self.log.adopt(t)
+        bisect.insort(orders, (t.priority(), t._row))
+
+    def new(self, verb, asset, when, quantity=0, value=0.0, note="", score=100) -> Transaction:
+        """
+        Adds a pending transaction written directly in a row of self.log, see Transaction for the arguments
+        :return: the new transaction
+        """
+        # il giorno prima della riga, così un giorno fuori calendario non lascia righe orfane nella tabella
+        day = self.day(when)
+        t = Transaction(verb, asset, when, quantity, value, note, score=score, log=self.log)
+        bisect.insort(self._days.setdefault(day, []), (t.priority(), t._row))
+        return t
+
+    def extend(self, transactions: typing.Iterable[Transaction]):
+        for t in transactions:
+            self.add(t)
+
+    def execution_order(self, when: datetime.date) -> typing.List[Transaction]:
+        """
+        :return: the transactions of the day in execution order
+        """
+        return [self.log[row] for _, row in self._days.get(self.day(when), ())]
+
+    def transactions(self) -> typing.List[Transaction]:
+        """
+        :return: all the transactions, by day and then in insertion order
+        """
+        return [t for when in self for t in self[when]]
+
+    def copy(self, assets: Dict[str, 'Asset'] = None) -> 'OrderBook':
+        """
+        :param assets: replacement assets by symbol, see TransactionLog.copy
+        """
+        book = OrderBook.__new__(OrderBook)
+        book.calendar = self.calendar
+        book.log = self.log.copy(assets)
+        book._days = {day: list(orders) for day, orders in self._days.items()}
+        return book
+
+    def __getitem__(self, when: datetime.date) -> typing.Tuple[Transaction, ...]:
+        # un giorno del calendario senza ordini è vuoto, un giorno fuori dal calendario è KeyError
+        return tuple(self.log[row] for row in sorted(row for _, row in self._days.get(self.day(when), ())))
+
+    def __contains__(self, when) -> bool:
+        try:
+            return self.day(when) in self._days
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        return (self.calendar[day] for day in sorted(self._days))
+
+    def __len__(self) -> int:
+        return len(self._days)
+
+
+# Medie e deviazioni standard mobili della chiusura di tutti gli asset in un'unica operazione 2D.
+# Ogni asset ha i suoi giorni di quotazione: le serie Close sono impacchettate allineate a destra in una matrice
+# righe x asset, con NaN in testa alle serie più corte, così la finestra mobile scorre sulle righe di ogni asset
+class Indicators:
+    """
+    Rolling mean and standard deviation of the Close of the whole universe, for any window, computed once per window
+    """
+
+    def __init__(self, closes: Dict[str, pd.Series]):
+        """
+        :param closes: Close series by asset key, each on its own dates
+        """
+        self.symbols = sorted(closes)
+        self.dates = {key: closes[key].index for key in self.symbols}
+        self._symbol_pos = {key: j for j, key in enumerate(self.symbols)}
+        rows = max([len(closes[key]) for key in self.symbols], default=0)
+        self.closes = np.full((rows, len(self.symbols)), np.nan)
+        for j, key in enumerate(self.symbols):
+            self.closes[rows - len(closes[key]):, j] = closes[key].to_numpy(dtype='float64')
+        self._rolling = dict()
+
+    def rolling(self, window: int) -> list:
+        """
+        :return: [sma, std] matrices rows x symbols for the window, same packing as self.closes
+        """
+        if window not in self._rolling:
+            rolling = pd.DataFrame(self.closes).rolling(window=window)
+            self._rolling[window] = [rolling.mean().to_numpy(), rolling.std().to_numpy()]
+        return self._rolling[window]
+
+    def unpack(self, matrix: np.ndarray, key: str) -> np.ndarray:
+        """
+        :return: the values of one asset, aligned to its own dates
+        """
+        return matrix[len(matrix) - len(self.dates[key]):, self._symbol_pos[key]]
+
+
+# Il pannello dei dati di mercato del Portfolio: per ogni campo (Close, sma_long, OwnedAmount, ...) una matrice
+# giorni x asset su un calendario condiviso. Con date_pos e symbol_pos si legge e si scrive per posizione,
+# senza passare dagli indici pandas; Asset.history resta disponibile come vista sulle colonne dell'asset.
+# Le simulazioni lavorano su un fork: condivide le matrici di mercato e copia solo quelle dello stato.
+# Per i processi di un pool, share() pubblica il pannello in un file mappato in memoria (in /dev/shm se c'è):
+# serializzandolo viaggia solo il percorso del file e i worker lo mappano in sola lettura, senza copiarlo
+class MarketData:
+    """
+    Aligned market data: one float64 matrix dates x symbols per field, on a shared calendar and symbol index.
+    The matrices of the fields given to the constructor are views of a single contiguous block fields x dates x symbols.
+    """
+
+    def __init__(self, dates: pd.DatetimeIndex, symbols: list, fields: list, values: np.ndarray = None):
+        """
+        :param symbols: keys of the assets in Portfolio.assets
+        :param values: optional fields x dates x symbols block, NaN filled if missing
+        """
+        self.dates = pd.DatetimeIndex(dates, name='Date')
+        self.symbols = list(symbols)
+        if values is None:
+            values = np.full((len(fields), len(self.dates), len(self.symbols)), np.nan)
+        assert values.shape == (len(fields), len(self.dates), len(self.symbols))
+        self._matrices = {field: values[f] for f, field in enumerate(fields)}
+        # file e blocco fields x dates x symbols condivisi, vedi share()
+        self._path = None
+        self._shared = None
+        # cambia ogni volta che aggiungo o sostituisco una matrice, così le viste in Asset.history vengono ricostruite
+        self.version = 0
+        self._date_pos = {dd: i for i, dd in enumerate(self.dates)}
+        self._symbol_pos = {symbol: j for j, symbol in enumerate(self.symbols)}
+
+    @classmethod
+    def from_assets(cls, assets: Dict[str, 'Asset'], dates: pd.DatetimeIndex) -> 'MarketData':
+        """
+        :param assets: Portfolio.assets, the symbols of the panel are the dictionary keys
+        :param dates: shared calendar, history rows outside of it are left out
+        """
+        keys = sorted(assets)
+        fields = []
+        for key in keys:
+            fields += [column for column in assets[key].history.columns if column not in fields]
+        values = np.empty((len(fields), len(dates), len(keys)))
+        for j, key in enumerate(keys):
+            history = assets[key].history.reindex(index=dates, columns=fields)
+            values[:, :, j] = history.to_numpy(dtype='float64').T
+        return cls(dates, keys, fields, values)
+
+    @property
+    def fields(self) -> list:
+        return list(self._matrices)
+
+    def date_pos(self, when: datetime.date) -> int:
+        return self._date_pos[pd.Timestamp(when)]
+
+    def symbol_pos(self, key: str) -> int:
+        return self._symbol_pos[key]
+
+    def field(self, name: str) -> np.ndarray:
+        """
+        :return: the dates x symbols matrix of the field, read only if it is shared by a fork
+        """
+        return self._matrices[name]
+
+    def add_field(self, name: str, values: np.ndarray = None) -> np.ndarray:
+        """
+        Adds a field, or replaces its values: in place if the matrix is writable, with a new matrix otherwise.
+
+        :param values: dates x symbols values, NaN filled if missing
+        :return: the matrix of the field
+        """
+        matrix = self._matrices.get(name)
+        if matrix is None or not matrix.flags.writeable:
+            matrix = np.empty((len(self.dates), len(self.symbols)))
+            self._matrices[name] = matrix
+            self.version += 1
+        matrix[:] = np.nan if values is None else values
+        return matrix
+
+    def fork(self, private: typing.Iterable[str]) -> 'MarketData':
+        """
+        :param private: fields copied for the fork, e.g. STATE_COLUMNS
+        :return: a panel on the same calendar and symbols that shares all the other matrices with this one,
+         read only in the fork
+        """
+        fork = MarketData.__new__(MarketData)
+        fork.__dict__.update(self.__dict__)
+        fork._matrices = dict()
+        for name, matrix in self._matrices.items():
+            if name in private:
+                fork._matrices[name] = matrix.copy()
+            else:
+                fork._matrices[name] = matrix.view()
+                fork._matrices[name].flags.writeable = False
+        return fork
+
+    def alias(self, names: Dict[str, str]):
+        """
+        Each field in names becomes the matrix of its source field, e.g. {'sma_long': 'sma_60'}. All the sources are
+        read before any field changes
+        """
+        self._matrices.update({name: self._matrices[source] for name, source in names.items()})
+        self.version += 1
+
+    def share(self, directory: str = None) -> 'MarketData':
+        """
+        :param directory: where to create the file, /dev/shm if available
+        :return: read only copy of the panel in a memory mapped file. Pickling it (or one of its forks) only sends the
+         path of the file for the shared matrices; the unpickled panels map the same file. The caller removes the file
+         with unlink()
+        """
+        if directory is None and os.path.isdir('/dev/shm'):
+            directory = '/dev/shm'
+        fd, path = tempfile.mkstemp(prefix='sim_trade_', suffix='.panel', dir=directory)
+        os.close(fd)
+        fields = self.fields
+        shape = (len(fields), len(self.dates), len(self.symbols))
+        block = np.memmap(path, dtype='float64', mode='w+', shape=shape)
+        for f, name in enumerate(fields):
+            block[f] = self._matrices[name]
+        block.flush()
+        del block
+        block = self._map(path, shape)
+        shared = MarketData(self.dates, self.symbols, fields, block)
+        shared._path = path
+        shared._shared = block
+        return shared
+
+    @staticmethod
+    def _map(path: str, shape: tuple) -> np.ndarray:
+        # mappa il file in sola lettura, come ndarray semplice
+        return np.asarray(np.memmap(path, dtype='float64', mode='r', shape=shape))
+
+    def unlink(self):
+        """
+        Removes the file created by share(), the panels mapping it stay valid until they are released
+        """
+        os.remove(self._path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._path is not None:
+            # le matrici nel file condiviso viaggiano come posizione nel file, le altre (lo stato di un fork) come copia
+            block = self._shared
+            size = max(1, block[0].nbytes)
+            start = block.__array_interface__['data'][0]
+            state['_matrices'] = {name: (matrix.__array_interface__['data'][0] - start) // size
+                                  if np.may_share_memory(matrix, block) else matrix
+                                  for name, matrix in self._matrices.items()}
+            state['_shared'] = block.shape
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._path is not None:
+            self._shared = self._map(self._path, self._shared)
+            self._matrices = {name: self._shared[matrix] if isinstance(matrix, int) else matrix
+                              for name, matrix in self._matrices.items()}
+
+    def frame(self, key: str) -> pd.DataFrame:
+        """
+        :return: DataFrame dates x fields of one symbol, each column a view on the panel: writes through .loc land
+         in the matrices
+        """
+        j = self._symbol_pos[key]
+        return pd.DataFrame({name: matrix[:, j] for name, matrix in self._matrices.items()}, index=self.dates,
+                            copy=False)
+
+
+# Valorizzazione a fine giornata: il valore delle posizioni al netto delle tasse dovute vendendole.
+# Funziona sia su un giorno (vettori per asset) sia su una simulazione intera (matrici giorni x asset)
+def net_worth(owned: np.ndarray, average_price: np.ndarray, close: np.ndarray, tax_rate: np.ndarray) -> np.ndarray:
+    """
+    :param owned: owned amount
+    :param average_price: average buy price, in default currency
+    :param close: close price converted to default currency
+    :param tax_rate: tax rate of each asset
+    :return: net worth of each position, 0.0 where nothing is owned
+    """
+    with np.errstate(invalid='ignore'):
+        # FIXME: con questa formula, in caso di perdita, lo zainetto fiscale mi fa aumentare leggermente il valore
+        # manca la SELL commission, ma incide poco sul senso del numero
+        worth = owned * (close + tax_rate * (average_price - close))
+    return np.where(owned > 0.0, worth, 0.0)
+
+
+def net_value(liquidity, worth: np.ndarray, order: np.ndarray):
+    """
+    :param liquidity: liquidity of the day, or of each day
+    :param worth: net worth from net_worth, one day or days x symbols
+    :param order: symbol positions in the order the values are summed (the order of Portfolio.assets), summing
+     one after the other as a running total does
+    :return: liquidity plus the net worth of all the positions
+    """
+    if len(order) == 0:
+        return liquidity + 0.0
+    return liquidity + np.cumsum(worth[..., order], axis=-1)[..., -1]
 
 
 # A Portfolio is a set of Assets that I want to access by Symbol
@@ -238,7 +1303,9 @@ class Transaction:
 # totalValue() per calcolare il valore totale del Portafoglio in EUR
 # da qualche parte ha senso mettere il valore del Portafoglio nel tempo, da capire se inserirlo come _SELF_ asset
 class Portfolio:
-    pendingTransactions: Dict[datetime.date, typing.List[Transaction]]
+    pendingTransactions: 'OrderBook'
+    executedTransactions: 'TransactionLog'
+    failedTransactions: 'TransactionLog'
 
     def __init__(self, start_date: datetime.date, end_date: datetime.date, initial_capital: float = 0.0, days_short=20,
                  days_long=150, description="Default Portfolio"):
@@ -249,39 +1316,129 @@ class Portfolio:
         # no data analysis needed only plotting, but I keep using DataFrame...
         # key = datetime, data = liquidity and portfolio value in def curr (netting selling commissions)
         assert (isinstance(start_date, datetime.date))
-        data = {'Date': [start_date], 'Liquidity': [initial_capital], 'NetValue': [initial_capital],
-                'TotalCommissions': [0.0], 'TotalDividens': [0.0], 'TotalTaxes': [0.0]}
-        temp = pd.DataFrame(data, columns=['Date', 'Liquidity', 'NetValue', 'TotalCommissions', 'TotalDividens',
-                                           'TotalTaxes'])
-        temp['Date'] = pd.to_datetime(temp['Date'])
-        self.por_history = temp.set_index('Date')
         self.days_short = days_short
         self.days_long = days_long
-        # TODO: valutare se spostare pendingTransactions dentro self.por_history
-        self.pendingTransactions = dict()
-        self.executedTransactions = []
-        self.failedTransactions = []
+        # vengono costruiti da calc_stats e fix_history_data
+        self.indicators = None
+        self.market_data = None
+        self.executedTransactions = TransactionLog()
+        self.failedTransactions = TransactionLog()
         self.start_date = start_date
         self.end_date = end_date
         self.initial_capital = initial_capital
         self.description = description
         # self.total_commissions = total_commissions
         logging.debug("fill_history_gaps for Portfolio[_SELF_] e Transactions")
-        last_row = self.por_history.loc[datetime.datetime.combine(self.start_date, datetime.time.min)]
-        for dd in pd.date_range(start=start_date - BDay(1), end=end_date, freq='B'):
-            # TODO: capire se ha senso settare last row con start_date e poi partire da start_date -1
-            self.pendingTransactions[dd] = []
-            try:
-                last_row = self.por_history.loc[dd]
-            except KeyError as e:
-                # non esiste l'indice
-                logging.debug("\tMissing Index: " + str(dd.date()) + " in port_history ")
-                t = datetime.datetime.combine(dd.date(), datetime.time.min)
-                # TODO: adesso che genero l'indice con pd.date_range questa "Combine" non dovrebbe essere più necessaria
-                self.por_history.loc[t] = last_row
-            except Exception as e:
-                logging.exception("Unexpected error:" + str(e))
-                exit(-1)
+        calendar, self.por_history = self._new_history(start_date, end_date, initial_capital)
+        # TODO: valutare se spostare pendingTransactions dentro self.por_history
+        self.pendingTransactions = OrderBook(calendar)
+
+    @staticmethod
+    def _new_history(start_date: datetime.date, end_date: datetime.date, initial_capital: float) -> tuple:
+        # una riga per start_date seguita dai giorni lavorativi da start_date - 1 a end_date, tutte con il capitale
+        # iniziale. Costruisco il DataFrame in un colpo solo invece di aggiungere una riga al giorno
+        calendar = pd.date_range(start=start_date - BDay(1), end=end_date, freq='B')
+        first_day = pd.Timestamp(start_date)
+        dates = pd.DatetimeIndex([first_day]).append(calendar[calendar != first_day])
+        dates.name = 'Date'
+        data = np.tile([initial_capital, initial_capital, 0.0, 0.0, 0.0], (len(dates), 1)).astype('float64')
+        return calendar, pd.DataFrame(data, index=dates, columns=['Liquidity', 'NetValue', 'TotalCommissions',
+                                                                  'TotalDividens', 'TotalTaxes'])
+
+    def clone(self, days_short: int = None, days_long: int = None) -> 'Portfolio':
+        """
+        Copy of the portfolio for a simulation. Market data, indicators and asset definitions are shared (the shared
+        panel matrices are read only in the copy); STATE_COLUMNS, por_history and the transactions are copied.
+        Without a MarketData panel it is a deepcopy.
+
+        :param days_short: window of sma_short and std_short in the copy, taken from the sma_<days_short> and
+         std_<days_short> fields added by calc_stats(windows=...)
+        :param days_long: same for sma_long and std_long
+        """
+        if self.market_data is None:
+            if (days_short, days_long) != (None, None):
+                raise ValueError("Changing the stats windows needs the MarketData panel: run fix_history_data first")
+            return cp.deepcopy(self)
+        windows = {term: days for term, days in (('short', days_short), ('long', days_long))
+                   if days is not None and days != getattr(self, 'days_' + term)}
+        names = {stat + '_' + term: self.stat_field(stat, days) for term, days in windows.items()
+                 for stat in ('sma', 'std')}
+        clone = self._copy_on(self.market_data.fork(STATE_COLUMNS))
+        if names:
+            clone.market_data.alias(names)
+        for term, days in windows.items():
+            setattr(clone, 'days_' + term, days)
+        return clone
+
+    def window(self, start_date: datetime.date, end_date: datetime.date, days_short: int = None,
+               days_long: int = None) -> 'Portfolio':
+        """
+        Clone of the portfolio on start_date..end_date, with the initial capital and no positions, e.g. for a
+        walk-forward fold. Market data and indicators stay the ones computed once on the full history; of the pending
+        transactions only dividends and splits after start_date are kept.
+
+        :param days_short: see clone, same for days_long
+        """
+        start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        calendar, por_history = self._new_history(start_date, end_date, self.initial_capital)
+        if self.market_data is None or not calendar.isin(self.market_data.dates).all():
+            raise ValueError("The window " + str(start_date.date()) + " - " + str(end_date.date()) +
+                             " must lie inside the MarketData calendar")
+        clone = self.clone(days_short=days_short, days_long=days_long)
+        clone.start_date, clone.end_date = start_date, end_date
+        clone.por_history = por_history
+        # dei movimenti in attesa tengo solo dividendi e split, come nuove transazioni
+        pending = clone.pendingTransactions
+        clone.pendingTransactions = OrderBook(calendar)
+        for t in pending.transactions():
+            if t.verb in ("DIVIDEND", "SPLIT") and start_date < t.when <= end_date:
+                clone.pendingTransactions.new(t.verb, t.asset, t.when, 0, t.value)
+        clone.executedTransactions = TransactionLog()
+        clone.failedTransactions = TransactionLog()
+        for name in STATE_COLUMNS:
+            clone.market_data.add_field(name, 0.0)
+        return clone
+
+    def stat_field(self, stat: str, days: int) -> str:
+        """
+        :param stat: 'sma' or 'std'
+        :return: MarketData field with the stat over days: <stat>_short or <stat>_long for the windows of the portfolio,
+         <stat>_<days> added by calc_stats(windows=...) otherwise
+        """
+        for term in ('short', 'long'):
+            if days == getattr(self, 'days_' + term):
+                return stat + '_' + term
+        name = stat + '_' + str(days)
+        if self.market_data is None or name not in self.market_data.fields:
+            raise ValueError("Missing " + name + ": run calc_stats(windows=[" + str(days) + "]) before fix_history_data")
+        return name
+
+    def share(self) -> 'Portfolio':
+        """
+        Copy of the portfolio on a read only MarketData in shared memory (see MarketData.share), to hand to worker
+        processes: pickling it does not copy the market data. Strategies run on it as usual, their clones get private
+        STATE_COLUMNS. Release the block with market_data.unlink() when the workers are done.
+        """
+        shared = self._copy_on(self.market_data.share())
+        # gli indicatori servono solo a calc_stats, i loro risultati sono già nel pannello
+        shared.indicators = None
+        return shared
+
+    def _copy_on(self, market_data: 'MarketData') -> 'Portfolio':
+        # copia di portafoglio, asset e transazioni, sul pannello dato
+        clone = cp.copy(self)
+        clone.market_data = market_data
+        clone.por_history = self.por_history.copy()
+        clone.assets = dict()
+        for key, asset in self.assets.items():
+            clone.assets[key] = cp.copy(asset)
+            clone.assets[key].attach(clone.market_data, key)
+        # le tabelle delle transazioni vengono copiate in blocco e puntano agli asset copiati
+        assets = {asset.symbol: clone.assets[key] for key, asset in self.assets.items()}
+        clone.pendingTransactions = self.pendingTransactions.copy(assets)
+        clone.executedTransactions = self.executedTransactions.copy(assets)
+        clone.failedTransactions = self.failedTransactions.copy(assets)
+        return clone
 
     def loadAssetList(self):
         if self.defCurrency == "EUR":
@@ -290,6 +1447,7 @@ class Portfolio:
             self.assets["CHF"] = Asset(CURRENCY, "CHF", "CHFEUR=X", "FX", "CHF")
         else:
             raise ValueError('Default Currencies other than EUR not yet implemented')
+        securities = dict()
 
         AssetsInScopeCSV = "./sim_trade/AssetsInScope.csv"
         # TODO: segnalare se simbolo è duplicato in CSV
@@ -314,155 +1472,237 @@ class Portfolio:
                         raise Exception(row[2] + " is an invalid Asset Class for " + row[0])
                     market = row[3]
                     currency = row[4]
-                    self.assets[symbol] = Asset(asset_class, name, symbol, market, currency)
+                    securities[symbol] = Asset(asset_class, name, symbol, market, currency)
+        # per ogni altra valuta presente nel CSV aggiungo il tasso di cambio verso la valuta di riferimento
+        for asset in securities.values():
+            if asset.currency != self.defCurrency and asset.currency not in self.assets:
+                self.assets[asset.currency] = Asset(CURRENCY, asset.currency, asset.currency + self.defCurrency + "=X",
+                                                    "FX", asset.currency)
+        self.assets.update(securities)
 
-    def calc_stats(self):
+    def calc_stats(self, windows: typing.Iterable[int] = ()):
+        """
+        Adds sma_short, sma_long, std_short and std_long to every asset history, computed for all the assets
+        at once by self.indicators.
+
+        :param windows: extra windows, added as sma_<window> and std_<window>. The stats of a previous run are
+         replaced, windows not requested again are dropped
+        """
         # TODO: questo metodo dovrebbe stare a livello di Strategia... Però deve essere eseguito prima di sistemare i
         #  gaps, quindi per il momento lo lascio a livello di portafoglio
         logging.debug("Entering calc_stats")
         logging.debug("Setting days_short: " + str(self.days_short))
         logging.debug("Setting days_long: " + str(self.days_long))
-        # asset['SMA_short'] = 0.0
-        # asset['SMA_long'] = 0.0
-        # asset['STD_short'] = 0.0
-        for key, asset in sorted(self.assets.items()):
-            logging.debug("Processing :" + asset.symbol)
-            sma_short = asset.history['Close'].rolling(window=self.days_short).mean()
-            asset.history['sma_short'] = sma_short
-            sma_long = asset.history['Close'].rolling(window=self.days_long).mean()
-            asset.history['sma_long'] = sma_long
-            std_short = asset.history['Close'].rolling(window=self.days_short).std()
-            asset.history['std_short'] = std_short
-
-            std_long = asset.history['Close'].rolling(window=self.days_long).std()
-            asset.history['std_long'] = std_long
-            # asset.history.plot(y=['Close', 'sma_short', 'sma_long'], title=asset.symbol)
-            # plt.show()
-            print(".", end="", flush=True)
-        print(" ")
+        self.indicators = Indicators({key: asset.history['Close'] for key, asset in self.assets.items()})
+        sma_short, std_short = self.indicators.rolling(self.days_short)
+        sma_long, std_long = self.indicators.rolling(self.days_long)
+        columns = {'sma_short': sma_short, 'sma_long': sma_long, 'std_short': std_short, 'std_long': std_long}
+        for window in windows:
+            columns['sma_' + str(window)], columns['std_' + str(window)] = self.indicators.rolling(window)
+        for key, asset in self.assets.items():
+            history = asset.history.drop(columns=[column for column in asset.history.columns
+                                                  if STAT_COLUMN.fullmatch(str(column))])
+            history[list(columns)] = np.column_stack([self.indicators.unpack(matrix, key)
+                                                      for matrix in columns.values()])
+            asset.history = history
 
-    # TODO: questo metodo dovrebbe essere multi-process.
     def fix_history_data(self):
+        """
+        Aligns every asset history to the business days calendar between start_date - 5 days and end_date,
+        and corrects the UK quotations where pence and pounds got mixed up. Vectorized, one asset at a time.
+        At the end builds self.market_data on that calendar, attaches every asset to it and runs convert_currencies.
+        """
         logging.debug("Entering fix_history_data")
+        calendar = pd.date_range(start=self.start_date - BDay(5), end=self.end_date, freq='B')
         for key, asset in sorted(self.assets.items()):
             print(".", end="", flush=True)
-            # create a set containing all dates in Range
             logging.debug("Processing :" + asset.symbol)
-            # logging.debug(asset.history)
-            last_row = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
             if asset.symbol == self.defCurrency:
                 asset.history = pd.DataFrame()  # devo definire la struttura
             if asset.history.index.has_duplicates:
                 logging.error("There are duplicates in the history for " + asset.symbol)
                 # remove duplicates, keep first
                 asset.history = asset.history[~asset.history.index.duplicated(keep='first')]
-            for dd in pd.date_range(start=self.start_date - BDay(5), end=self.end_date, freq='B'):
-                try:
-                    last_row = asset.history.loc[dd, :]
-                    # ogni tanto le quotazioni inglesi fanno casino tra pence e pound.
-                    # se il valore esiste, ma rappresenta un errore, allora lo sostituisco con la media a 20 gg
-                    if math.isnan(last_row['sma_short']) == False:
-
-                        # se il valore è inferiore al 2% della media corta, oppure se il valore è più del doppio tratto la riga come un errore e sostituisco i valori con la media breve
-                        if last_row['Close'] < (last_row['sma_short'] * 0.02) or last_row['Close'] > (
-                                last_row['sma_short'] * 3):
-                            if last_row['Close'] < (last_row['sma_short'] * 0.02):
-                                new_value = last_row['Close'] * 100
-                            else:
-                                new_value = last_row['Close'] / 100
-                            logging.info(
-                                "Found Outlier on CLOSE: replacing value " + str(last_row['Close']) + " with " + str(
-                                    new_value) + " for " + asset.symbol + " on " + str(dd.date()))
-                            asset.history.loc[dd, 'Close'] = new_value
-                            # di solito se è sbagliato il close lo è anche l'Open
-                        if last_row['Open'] < last_row['sma_short'] * 0.02 or last_row['Open'] > (
-                                last_row['sma_short'] * 3):
-                            if last_row['Open'] < (last_row['sma_short'] * 0.02):
-                                new_value = last_row['Open'] * 100
-                            else:
-                                new_value = last_row['Open'] / 100
-                            logging.info(
-                                "Found Outlier on OPEN: replacing value " + str(last_row['Open']) + " with " + str(
-                                    new_value) + " for " + asset.symbol + " on " + str(dd.date()))
-                            asset.history.loc[dd, 'Open'] = new_value
-                except KeyError as e:
-                    # non esiste l'indice
-                    logging.debug("\tMissing Index: " + str(dd.date()) + " in Asset " + str(asset.symbol))
-                    asset.history.loc[dd] = last_row
-                    # ho due situazioni limite: alcune azioni non esistono prima di una certa data
-                    # e altre volte semplicemente pesco un festivo come primo giorno
-                    # da capire
-                except Exception as e:
-                    logging.debug("\nLast Row: " + str(last_row))
-                    logging.exception("\nUnexpected error:" + str(e))
-                    exit(-1)
-            # asset.history = asset.history.sort_index()
-            # estendo il DataFrame aggiungendo la colonna OwnedAmount
-            asset.history['OwnedAmount'] = 0.0
-            asset.history['AverageBuyPrice'] = 0.0  # in DEF CURR
-            asset.history['NetWorth'] = 0.0  # in DEF CURR
-            asset.history['TotTaxes'] = 0.0  # in DEF CURR
-            asset.history['TotCommissions'] = 0.0  # in DEF CURR
-            # come ultimo atto, riordino il DataFrame per data
-            asset.history = asset.history.sort_values(by='Date')
+            history = asset.history
+            values = history.to_numpy(dtype='float64', copy=True)
+            # righe del calendario per cui ho una quotazione, con i valori prima di qualunque correzione
+            exists = calendar.isin(history.index)
+            raw_rows = values[history.index.get_indexer(calendar[exists])]
+            # ogni tanto le quotazioni inglesi fanno casino tra pence e pound.
+            # se il valore è inferiore al 2% della media corta lo moltiplico per 100, se è più del triplo lo divido
+            in_range = history.index.isin(calendar)
+            sma_short = values[:, history.columns.get_loc('sma_short')]
+            for column in ('Close', 'Open'):
+                col = history.columns.get_loc(column)
+                with np.errstate(invalid='ignore'):
+                    too_low = in_range & (values[:, col] < sma_short * 0.02)
+                    too_high = in_range & ~too_low & (values[:, col] > sma_short * 3)
+                for pos in np.flatnonzero(too_low | too_high):
+                    new_value = values[pos, col] * 100 if too_low[pos] else values[pos, col] / 100
+                    logging.info("Found Outlier on " + column.upper() + ": replacing value " + str(values[pos, col]) +
+                                 " with " + str(new_value) + " for " + asset.symbol + " on " +
+                                 str(history.index[pos].date()))
+                    values[pos, col] = new_value
+            index = history.index
+            # i giorni mancanti copiano l'ultima quotazione esistente (prima delle correzioni, come faceva il
+            # vecchio ciclo), oppure tutti zeri se nel calendario non ho ancora quotazioni:
+            # alcune azioni non esistono prima di una certa data e altre volte pesco un festivo come primo giorno
+            if not exists.all():
+                last_existing = np.maximum.accumulate(np.where(exists, np.cumsum(exists) - 1, -1))[~exists]
+                filled = np.zeros((len(last_existing), len(history.columns)))
+                filled[last_existing >= 0] = raw_rows[last_existing[last_existing >= 0]]
+                logging.debug("\t" + str(len(last_existing)) + " missing days in Asset " + str(asset.symbol))
+                index = index.append(calendar[~exists])
+                values = np.concatenate([values, filled])
+            # come ultimo atto, riordino per data ed estendo il DataFrame con le colonne dello stato (in DEF CURR)
+            order = index.argsort()
+            asset.history = pd.DataFrame(np.concatenate([values[order], np.zeros((len(order), len(STATE_COLUMNS)))],
+                                                        axis=1),
+                                         index=pd.DatetimeIndex(index[order], name='Date'),
+                                         columns=list(history.columns) + STATE_COLUMNS)
+        # pubblico il pannello allineato al calendario: da qui in poi asset.history è una vista sul pannello
+        self.market_data = MarketData.from_assets(self.assets, calendar)
+        for key, asset in self.assets.items():
+            asset.attach(self.market_data, key)
+        self.convert_currencies()
         print(" ")
 
-    def port_net_value(self, date: datetime.datetime):
-        tot_value = 0.0
-        GBPEUR = self.assets['GBP'].history.loc[date, 'Close'] / 100  # quotazioni e dividendi UK sono in pence
-        CHFEUR = self.assets['CHF'].history.loc[date, 'Close']
-        USDEUR = self.assets['USD'].history.loc[date, 'Close']
-        for key, asset in self.assets.items():
-            line = asset.history.loc[date]
-            if line['OwnedAmount'] > 0.0:
-                curr_conv = 1.0
-                if asset.currency != "EUR":
-                    if asset.currency == "USD":
-                        curr_conv = USDEUR
-                    elif asset.currency == "GBP":
-                        curr_conv = GBPEUR
-                    elif asset.currency == "CHF":
-                        curr_conv = CHFEUR
-                logging.debug("Calculating Port Net Value")
-                logging.debug("Asset: " + asset.symbol)
-                logging.debug("Owned Amount: " + str(line['OwnedAmount']))
-                logging.debug("Average Buy_Price: " + str(line['AverageBuyPrice']))
-                logging.debug("Currency Conversion: " + str(curr_conv))
-                logging.debug("current quotation: " + str(line['Close']))
-                # TODO: aggiungere NerWorth anche su singolo asset, per permettere regole di bilanciamento del portafoglio
-                asset.history.loc[date, 'NetWorth'] = line['OwnedAmount'] * (
-                        line['Close'] * curr_conv + asset.assetType.tax_rate * (
-                        line['AverageBuyPrice'] - line['Close'] * curr_conv))
-                tot_value = tot_value + asset.history.loc[date, 'NetWorth']
-                # FIXME: con questa formula, in caso di perdita, lo zainetto fiscale mi fa aumentare leggermente il valore
-                # manca la SELL commission, ma incide poco sul senso del numero
-        logging.debug("calcolato tot_value: " + str(tot_value) + " per giorno: " + str(date))
-        liquidity = self.por_history.loc[date, 'Liquidity']
-        logging.debug("Liquidità: " + str(liquidity))
-        logging.debug("Net Value Port: " + str(tot_value + liquidity))
-        self.por_history.loc[date, 'NetValue'] = liquidity + tot_value  # da finire
-
-    def loadQuotations(self, cache_file='cache'):
+    def convert_currencies(self):
+        """
+        One-time FX stage: adds to the panel, for every asset, the factors converting its prices to the default
+        currency ('OpenFX' and 'CloseFX') and the converted prices ('Open' and 'Close' followed by defCurrency).
+        The exchange rates are the currency assets, keyed by currency; quotations of MINOR_UNITS currencies are
+        divided accordingly.
+        """
+        panel = self.market_data
+        rates = {asset.currency: key for key, asset in self.assets.items() if asset.assetType.assetType == "currency"}
+        currencies = [self.defCurrency] + sorted(rates)
+        column = []
+        for key in panel.symbols:
+            currency = self.assets[key].currency
+            if currency not in currencies:
+                logging.warning("No exchange rate for " + currency + ", prices of " + key + " are not converted")
+                currency = self.defCurrency
+            column.append(currencies.index(currency))
+        units = np.array([MINOR_UNITS.get(currencies[c], 1.0) if c > 0 else 1.0 for c in column])
+        for field in ('Open', 'Close'):
+            # una colonna per valuta, la prima è la valuta di riferimento
+            table = np.column_stack([np.ones(len(panel.dates))] + [
+                panel.field(field)[:, panel.symbol_pos(rates[currency])] for currency in currencies[1:]])
+            conv = panel.add_field(field + 'FX', table[:, column] / units)
+            panel.add_field(field + self.defCurrency, panel.field(field) * conv)
+
+    def port_net_value(self, date: datetime.date = None):
+        """
+        Marks the portfolio to market at the close: writes NetWorth of every asset and NetValue in por_history.
+
+        :param date: day to value, without it every day of por_history in the panel is valued in one pass
+        :return: NetValue of the day, or of every valued day
+        """
+        panel = self.market_data
+        if date is None:
+            dates = self.por_history.index[self.por_history.index.isin(panel.dates)]
+            rows = np.array([panel.date_pos(dd) for dd in dates], dtype=int)
+        else:
+            dates = pd.Timestamp(date)
+            rows = panel.date_pos(date)
+        close = panel.field('Close' + self.defCurrency)[rows]
+        tax_rate = np.array([self.assets[key].assetType.tax_rate for key in panel.symbols])
+        worth = net_worth(panel.field('OwnedAmount')[rows], panel.field('AverageBuyPrice')[rows], close, tax_rate)
+        panel.field('NetWorth')[rows] = worth
+        value = net_value(np.asarray(self.por_history.loc[dates, 'Liquidity']),
+                          worth, np.array([panel.symbol_pos(key) for key in self.assets], dtype=int))
+        self.por_history.loc[dates, 'NetValue'] = value
+        trace.debug("Net Value Port: %s per giorno: %s", value, date)
+        return value
+
+    def loadQuotations(self, cache_file='cache', store: QuoteStore = None, overlap: int = 5, concurrency: int = 20,
+                       retries: int = 3, backoff: float = 1.0, provider: MarketDataProvider = None) -> Dict[str, str]:
+        """
+        Retrieves quotations and dividends for all Assets in Portfolio
+
+        :param cache_file: sqlite file used to cache HTTP responses
+        :param store: optional QuoteStore, symbols already stored for the needed window are read from disk.
+         If only the first or the last days are missing, just those are downloaded and merged into the store
+        :param overlap: number of already stored business days downloaded again, to catch revised quotations
+        :param concurrency: maximum number of downloads running at the same time
+        :param retries: how many times a failed download is retried, see fetch_quotations
+        :param backoff: seconds to wait before the first retry, doubled at every attempt
+        :param provider: where quotations come from, by default Yahoo with a sqlite cache in cache_file
+        :return: failure report, symbol -> error, for the assets that could not be downloaded.
+         These assets are removed from the Portfolio, a failure on a currency raises an Exception
+        """
         # setto una cache per i pandas_datareader
         # TODO: dovrei rendere la location e la durata della cache parametriche
-        expire_after = datetime.timedelta(days=3)
-        session = requests_cache.CachedSession(cache_name=cache_file, backend='sqlite', expire_after=expire_after,
-                                               allowable_codes=(200,), fast_save=False)
+        if provider is None:
+            expire_after = datetime.timedelta(days=3)
+            session = requests_cache.CachedSession(cache_name=cache_file, backend='sqlite', expire_after=expire_after,
+                                                   allowable_codes=(200,), fast_save=False)
+            provider = YahooProvider(session)
         # get Quotations & Dividends for all Assets in myPortfolio
         initial_data_day = self.start_date - BDay(self.days_long + self.days_short)
-        # Since this is I/O bound performance can be imporved by using Multi_threading.
-        # create an array of inputs for the ThreadPool
+        # i download completi partono sempre dal primo gennaio: così lanci con start_date o days_long diversi
+        # trovano la stessa risposta nella cache HTTP, poi filtro localmente
+        canonical_start = pd.Timestamp(datetime.date(initial_data_day.year, 1, 1))
+        # uso un dizionario simbolo -> azioni societarie (dividendi e split)
+        actions_by_symbol = dict()
+        # Since this is I/O bound performance can be imporved by using asyncio.
+        # create an array of inputs for fetch_quotations
         MP_Inputs = []
         for key, value in sorted(self.assets.items()):
-            MP_Inputs.append([value, initial_data_day, self.end_date, session])
-        pool = ThreadPool(20)
-        results = pool.map(download_quotations, MP_Inputs)
+            if store is not None and store.covers(value.symbol, initial_data_day, self.end_date):
+                logging.info("Loading quotations for:\t" + str(value.symbol) + " from " + store.path)
+                value.history, actions_by_symbol[value.symbol] = store.load(value.symbol, initial_data_day,
+                                                                            self.end_date)
+                continue
+            window = None if store is None else store.window(value.symbol)
+            last_bar = None if window is None else store.last_bar(value.symbol)
+            if last_bar is None:
+                MP_Inputs.append([value, canonical_start, self.end_date, provider])
+                continue
+            # aggiornamento incrementale: scarico solo i giorni che mancano nello store
+            if initial_data_day < window[0]:
+                # mi mancano i giorni più vecchi, ad esempio perché è cambiato days_long o start_date
+                logging.info("Backfilling quotations for:\t" + str(value.symbol) + " to " + str(window[0].date()))
+                MP_Inputs.append([value, canonical_start, window[0] - datetime.timedelta(days=1), provider])
+            if not store.covers(value.symbol, window[0], self.end_date):
+                # riscarico anche qualche giorno già salvato, nel caso Yahoo abbia corretto le ultime quotazioni
+                logging.info("Updating quotations for:\t" + str(value.symbol) + " from " + str(last_bar.date()))
+                MP_Inputs.append([value, last_bar - BDay(overlap), self.end_date, provider])
+        failures = dict()
+        if len(MP_Inputs) > 0:
+            results = fetch_quotations(MP_Inputs, concurrency, retries, backoff)
+            # fetch_quotations mantiene l'ordine degli input, quindi ritrovo la finestra scaricata per ogni asset
+            for inputs, outcome in zip(MP_Inputs, results):
+                asset = inputs[0]
+                if isinstance(outcome, Exception):
+                    failures[asset.symbol] = repr(outcome)
+                elif store is not None:
+                    store.update(asset.symbol, outcome[1], outcome[2], inputs[1], inputs[2])
+                else:
+                    asset.history = outcome[1].loc[initial_data_day:self.end_date]
+                    actions_by_symbol[asset.symbol] = outcome[2]
+            if store is not None:
+                for inputs in MP_Inputs:
+                    asset = inputs[0]
+                    if asset.symbol not in failures and asset.symbol not in actions_by_symbol:
+                        asset.history, actions_by_symbol[asset.symbol] = store.load(asset.symbol, initial_data_day,
+                                                                                    self.end_date)
+        for key, asset in sorted(self.assets.items()):
+            if asset.symbol in failures:
+                logging.error("Failed to retrieve " + str(asset.symbol) + ": " + failures[asset.symbol])
+                if asset.assetType.assetType == "currency":
+                    # senza il cambio non posso valutare il portafoglio
+                    raise Exception("Failed to retrieve exchange rate " + str(asset.symbol) + ": " +
+                                    failures[asset.symbol])
+                del self.assets[key]
         # Se tutto ha funzionato bene, a questo punto, le varie asset.history sono popolate e in più ho un array da processare per i dividendi.
-        for asset, actions in results:
-            for dd, sym_div in actions.iterrows():
+        for key, asset in sorted(self.assets.items()):
+            for dd, sym_div in actions_by_symbol[asset.symbol].iterrows():
                 if dd > self.start_date:
-                    self.pendingTransactions[dd].append(Transaction(sym_div["action"], asset, dd, 0, sym_div["value"]))
+                    self.pendingTransactions.new(sym_div["action"], asset, dd, 0, sym_div["value"])
         print(" ")
+        return failures
 
     def printReport(self):
         print("Portafoglio: " + str(self.description))
@@ -485,19 +1725,105 @@ class Portfolio:
         return stats
 
 
+# Lo stato di una simulazione: invece di aggiornare asset.history e por_history con .loc giorno per giorno,
+# posizioni, prezzi medi di carico, liquidità e totali cumulati stanno in array preallocati per giorno (e per asset).
+# La riga 0 è il giorno precedente al primo giorno di trading e contiene lo stato iniziale
+class SimulationState:
+    """
+    Positions, average buy price and net worth per day and asset; liquidity, net value and cumulative commissions,
+    dividends and taxes per day. Rows follow the business days of the MarketData panel from days[0] - 1 to days[-1].
+    """
+
+    def __init__(self, portfolio: Portfolio, days: pd.DatetimeIndex):
+        """
+        :param days: trading days, consecutive rows of portfolio.market_data
+        """
+        self.portfolio = portfolio
+        panel = portfolio.market_data
+        self.first_row = panel.date_pos(days[0]) - 1
+        rows = slice(self.first_row, self.first_row + len(days) + 1)
+        self.dates = panel.dates[rows]
+        self.open = panel.field('Open')[rows]
+        self.owned = panel.field('OwnedAmount')[rows].copy()
+        self.average_price = panel.field('AverageBuyPrice')[rows].copy()
+        self.net_worth = panel.field('NetWorth')[rows].copy()
+        initial = portfolio.por_history.loc[self.dates[0]]
+        self.liquidity = np.full(len(self.dates), initial['Liquidity'])
+        self.net_value = np.full(len(self.dates), initial['NetValue'])
+        self.commissions = np.full(len(self.dates), initial['TotalCommissions'])
+        self.dividends = np.full(len(self.dates), initial['TotalDividens'])
+        self.taxes = np.full(len(self.dates), initial['TotalTaxes'])
+        assets = [portfolio.assets[key] for key in panel.symbols]
+        self.tax_rate = np.array([asset.assetType.tax_rate for asset in assets])
+        # i valori del portafoglio si sommano nell'ordine di portfolio.assets
+        self.order = np.array([panel.symbol_pos(key) for key in portfolio.assets], dtype=int)
+        # fattori di conversione verso EUR per gli ordini, chiusura in EUR per la valutazione
+        self.open_conv = panel.field('OpenFX')[rows]
+        self.close_eur = panel.field('Close' + portfolio.defCurrency)[rows]
+
+    def row(self, when: datetime.date) -> int:
+        return self.portfolio.market_data.date_pos(when) - self.first_row
+
+    def carry(self, r: int):
+        """
+        Starts day r with the positions and the totals of the day before
+        """
+        self.owned[r] = self.owned[r - 1]
+        self.average_price[r] = self.average_price[r - 1]
+        for values in (self.liquidity, self.net_value, self.commissions, self.dividends, self.taxes):
+            values[r] = values[r - 1]
+
+    def value(self, r: int) -> float:
+        """
+        Marks day r to market at the close, see net_worth and net_value
+        """
+        self.net_worth[r] = net_worth(self.owned[r], self.average_price[r], self.close_eur[r], self.tax_rate)
+        self.net_value[r] = net_value(self.liquidity[r], self.net_worth[r], self.order)
+        return self.net_value[r]
+
+    def write_back(self):
+        """
+        Copies the simulated days into portfolio.por_history and the MarketData panel
+        """
+        panel = self.portfolio.market_data
+        rows = slice(self.first_row + 1, self.first_row + len(self.dates))
+        panel.field('OwnedAmount')[rows] = self.owned[1:]
+        panel.field('AverageBuyPrice')[rows] = self.average_price[1:]
+        panel.field('NetWorth')[rows] = self.net_worth[1:]
+        self.portfolio.por_history.loc[self.dates[1:], ['Liquidity', 'NetValue', 'TotalCommissions', 'TotalDividens',
+                                                        'TotalTaxes']] = np.column_stack(
+            [self.liquidity[1:], self.net_value[1:], self.commissions[1:], self.dividends[1:], self.taxes[1:]])
+
+
+def signal_table(*parts) -> np.ndarray:
+    """
+    :param parts: lists of (Date, symbol, verb, score, reason) rows or signal tables, concatenated in order
+    :return: read only SIGNAL_DTYPE array
+    """
+    table = np.concatenate([np.array(part, dtype=SIGNAL_DTYPE) for part in parts]) if parts else np.empty(
+        0, dtype=SIGNAL_DTYPE)
+    table.flags.writeable = False
+    return table
+
+
 # Creo la Classe TradingStrategy
 # analizza il portafoglio un asset alla volta.
 # Se voglio imporre vincoli tra asset, lo faccio all'interno della Simulazione
 # ad esempio ETC oro deve essere tra 5% e 10% del valore totale del Portafoglio
 # Devo avere valuta per investire, etc...
 # come strategia di Trading Baseline, implemento BUY&HOLD
-# se voglio fare strategie più sofisticate eredito e faccio override del metodo 'suggested_transactions'
+# se voglio fare strategie più sofisticate eredito e faccio override del metodo 'calc_signals'
+# i segnali sono una tabella immutabile: calc_suggested_transactions li trasforma in Transaction del portafoglio
+# clonato, execute li esegue ogni volta su un nuovo clone, così una sola analisi alimenta più simulazioni
 # ricordarsi di aggiungere StopLossTreshold (10%?)
 class BuyAndHoldTradingStrategy:
     def __init__(self, in_port: Portfolio):
         self.description = "BUY and HOLD"
-        # clono il Portafoglio in Input così lo posso modificare
-        self.outcome = cp.deepcopy(in_port)
+        # il portafoglio di partenza, da cui clonare quelli delle esecuzioni
+        self.portfolio = in_port
+        self.signals = None
+        # clono il Portafoglio in Input così lo posso modificare: i dati di mercato restano condivisi
+        self.outcome = in_port.clone()
         self.outcome.description = self.description
         # setto un valore standard per i BUY oders, in modo che sia possibile investire su tutti gli asset
         # self.BUY_ORDER_VALUE = self.outcome.initial_capital / len(self.outcome.assets.keys())
@@ -506,24 +1832,66 @@ class BuyAndHoldTradingStrategy:
         # voglio ricevere una TradingStrategy che contenga le regole da applicare
         # restiruisco un nuovo Portafoglio elaborato con le regole
 
-    def sell_all(self):
+    def sell_all(self) -> list:
         # l'ultimo giorno vendo tutto.
+        signals = []
         for key, asset in sorted(self.outcome.assets.items()):
             if asset.assetType.assetType != "currency":
-                logging.info("\tRequesting SELL for " + str(key) + " on " + str(self.outcome.end_date))
+                trace.info("\tRequesting SELL for %s on %s", key, self.outcome.end_date)
                 dd = datetime.datetime.combine(self.outcome.end_date, datetime.time.min)
                 score = self.scoreSignal(asset, dd)
-                dailyPendTx = self.outcome.pendingTransactions[dd]
-                dailyPendTx.append(Transaction("SELL", asset, dd, 0, 0.0, self.description, score=score))
+                signals.append((dd, key, "SELL", score, self.description))
+        return signals
 
-    # TODO: questo metodo dovrebbe essere multi-thread.
     def calc_suggested_transactions(self, sell_all=True, **kwparams):
+        """
+        Computes the signal table (see calc_signals) and turns it into pending transactions of self.outcome
+
+        :return: self.outcome.pendingTransactions
+        """
+        self.signals = self.calc_signals(sell_all=sell_all, **kwparams)
+        self.schedule(self.signals, self.outcome)
+        return self.outcome.pendingTransactions
+
+    @staticmethod
+    def schedule(signals: np.ndarray, portfolio: Portfolio):
+        """
+        Adds one pending Transaction per signal to portfolio.pendingTransactions, in the order of the table
+        """
+        for dd, key, verb, score, reason in zip(pd.DatetimeIndex(signals['Date']), signals['symbol'].tolist(),
+                                                signals['verb'].tolist(), signals['score'].tolist(),
+                                                signals['reason'].tolist()):
+            portfolio.pendingTransactions.new(verb, portfolio.assets[key], dd, 0, 0.0, reason, score)
+
+    def execute(self, signals: np.ndarray = None, max_orders=25.0, initial_capital: float = None) -> Portfolio:
+        """
+        Simulates the signals on a new clone of the input portfolio, leaving the strategy and self.outcome untouched
+
+        :param signals: signal table, the one of the last calc_suggested_transactions if missing
+        :param initial_capital: replaces the capital of the input portfolio
+        :return: the simulated portfolio
+        """
+        execution = cp.copy(self)
+        execution.outcome = self.portfolio.clone()
+        execution.outcome.description = self.description
+        if initial_capital is not None:
+            execution.outcome.por_history[['Liquidity', 'NetValue']] += initial_capital - self.portfolio.initial_capital
+            execution.outcome.initial_capital = initial_capital
+        self.schedule(self.signals if signals is None else signals, execution.outcome)
+        return execution.runTradingSimulation(max_orders=max_orders)
+
+    # TODO: questo metodo dovrebbe essere multi-thread.
+    def calc_signals(self, sell_all=True, **kwparams) -> np.ndarray:
+        """
+        :return: the signal table of the strategy, see SIGNAL_DTYPE
+        """
         # Strategia base "BUY & HOLD"
         # wish_list = ["IBM", "GLEN.L", "MCRO.L", "MSFT", "GOOG", "GOOGL", "KAZ.L", "BRE.MI", "CRM", "RSW.L", "FME.DE", "ENEL.MI", "EQIX", "LLOY.L", "BP.L", "HSBA.L", "RWI.L", "SOON.SW", "BA.L", "PHAU.MI", "UCG.MI", "GSK.L", "TWLO", "ESNT.L", "BT-A.L", "GEO.MI", "ENI.MI", "NOVN.SW"]
         wish_list = ["AMZN", "DPZ", "PHAU.MI", "NEXI.MI", "CPR.MI", "SOON.SW", "LSE.L", "MED", "NOW", "DIS", "VNA.DE",
                      "GOOGL", "MSFT", "NKLA", "SVMK", "TEAM", "TWLO", "ULVR.L", "BRBY.L", "GES", "NFLX", "DOCU",
                      "DPW.DE", "KER.PA", "SWBI"]
         days_long = self.outcome.days_long
+        signals = []
         for key, asset in sorted(self.outcome.assets.items()):
             assert isinstance(asset, Asset)
             # per tutti gli asset, tranne il portafoglio stesso e la valuta di riferimento genero dei segnali di BUY o
@@ -533,41 +1901,38 @@ class BuyAndHoldTradingStrategy:
                                         freq='W-WED'):
                     if asset.history.loc[dd, 'Close'] > 0.0 and asset.assetType.assetType != "currency":
                         score = self.scoreSignal(asset, dd)
-                        logging.debug("\tRequesting BUY for " + str(key) + " on " + str(dd.date() + BDay(1)) +
-                                      "\tquotation: " + str(asset.history.loc[dd, 'Close']) + "\tscore: " + str(score))
-                        logging.debug("assetType: " + str(asset.assetType))
-                        dailyPendTx = self.outcome.pendingTransactions[dd + BDay(1)]
-                        dailyPendTx.append(Transaction("BUY", asset, dd +
-                                                       BDay(1), 0, 0.0, self.description, score=score))
+                        if trace.isEnabledFor(logging.DEBUG):
+                            trace.debug("\tRequesting BUY for %s on %s\tquotation: %s\tscore: %s", key,
+                                        dd.date() + BDay(1), asset.history.loc[dd, 'Close'], score)
+                            trace.debug("assetType: %s", asset.assetType)
+                        signals.append((dd + BDay(1), key, "BUY", score, self.description))
                         wish_list.remove(asset.symbol)
                         break
             print(".", end="", flush=True)
         if sell_all:
             # l'ultimo giorno vendo tutto.
-            self.sell_all()
+            signals += self.sell_all()
         print(" ")
-        return self.outcome.pendingTransactions
+        return signal_table(signals)
 
     # se ho segnali di BUY multipli, devo avere uno score relativo
     def scoreSignal(self, asset: Asset, day: BDay) -> int:
-        logging.debug("Calculating score for " + asset.symbol + " on " + str(day.date()))
-        logging.debug("std_short = " + str(asset.history.loc[day, 'std_short']))
-        logging.debug("sma_long = " + str(asset.history.loc[day, 'sma_long']))
+        std_short, sma_long = asset.history.loc[day, 'std_short'], asset.history.loc[day, 'sma_long']
+        trace.debug("Calculating score for %s on %s: std_short = %s sma_long = %s", asset.symbol, day, std_short,
+                    sma_long)
         # il fatto di mischiare grandezze statistiche short e long non è un errore.
         # sul campione analizzato era la funzione score con i migliori risultati
-        score = 100.0 * asset.history.loc[day, 'std_short'] / asset.history.loc[day, 'sma_long']
+        score = 100.0 * std_short / sma_long
         return score
 
     # Creo il metodo TradingSimulation che deve iterare dentro un range di date, eseguire gli ordini e aggiornare i valori
     def runTradingSimulation(self, max_orders=25.0):
-        logging.debug("Processing portfolio \'{0}\' start_date = {1} end_date = {2}".format(self.outcome.description,
-                                                                                            str(
-                                                                                                self.outcome.start_date),
-                                                                                            str(self.outcome.end_date)))
+        trace.debug("Processing portfolio '%s' start_date = %s end_date = %s", self.outcome.description,
+                    self.outcome.start_date, self.outcome.end_date)
         self.BUY_ORDER_VALUE = self.outcome.initial_capital / max_orders
         # max_orders = rappresenta una stima del numero massimo di ordini eseguiti in un BUY & HOLD.
         # con strategie più complesse, è una indicazione spannometrica del numero di titoli massimo nel portafoglio
-        logging.info("\nSetting BUY order value to: " + str(self.BUY_ORDER_VALUE))
+        trace.info("\nSetting BUY order value to: %s", self.BUY_ORDER_VALUE)
         # prima di tutto comincio a stampare la lista della transazioni pending
         # for key, value in self.outcome.pendingTransactions.items():
         #    print ("Key: " + str(key))
@@ -577,317 +1942,299 @@ class BuyAndHoldTradingStrategy:
         # il trading parte da start_date + 1 gg, prima non posso avere ordini basati su nessun dato
         first_trading_day = self.outcome.start_date + BDay(1)
         # TODO: validare se first_trading_day può essere uguale a start_date, per farlo devo capire meglio cosa faccio con prev day più sotto
-        # inizializzo un paio di variabili che utilizzo per stampre un'idea di progress bar
-        count = 0
-        mod = len(self.outcome.por_history) - 2
-        # inizio a fare il vero trading
-        for dd in pd.date_range(start=first_trading_day, end=self.outcome.end_date, freq='B'):
-            logging.debug("\tProcessing Trading Day " + str(dd.date()))
-            # dovrei iterare sui giorni ed eseguire le transazioni
-            # prima di tutto copio i valori por_history e asset history da ieri
-            # prima di tutto, passo tutti gli asset e se amount è > 0 calcolo il CLOSE_PRICE in EUR
-            # mi serve un metodo per calcolare il valore del Port in un dato giorno.
-            # ... devo riempire tutti i giorni per ...
-            # ...
-            # assumo
-            prev_day = dd - BDay(1)
-            # copio port history
-            self.outcome.por_history.loc[dd] = self.outcome.por_history.loc[prev_day]
-            # processo gli asset
-            for sym, asset in self.outcome.assets.items():
-                count += 1
-                if count % mod == 0:
-                    print(".", end="", flush=True)
-                # propago i cambiamenti del giorno precedente
-                asset.history.loc[dd, 'OwnedAmount'] = asset.history.loc[prev_day, 'OwnedAmount']
-                asset.history.loc[dd, 'AverageBuyPrice'] = asset.history.loc[prev_day, 'AverageBuyPrice']
-            today_tx = []
-            try:
-                # today_tx = self.outcome.pendingTransactions[datetime.datetime.combine(r.date(), datetime.time.min)]
-                today_tx = self.outcome.pendingTransactions[dd]
-                today_tx.sort(reverse=False, key=Transaction.to_datetime)
-            except KeyError as ke:
-                logging.exception(ke)
-                logging.debug("No pending TX for day: " + str(dd.date))
-            if len(today_tx) > 0:
-                for t in today_tx:
-                    self.exec_trade(t)
-            # calcolo il valore netto di Portafoglio alla fine della giornata di Trading.
-            self.outcome.port_net_value(dd)
-            # ricalcolo order value come percentuale del net value
-            self.BUY_ORDER_VALUE = self.outcome.por_history.loc[dd, 'NetValue'] / max_orders
+        days = pd.date_range(start=first_trading_day, end=self.outcome.end_date, freq='B')
+        if len(days) == 0:
+            return self.outcome
+        # posizioni e totali vivono negli array di SimulationState, li riporto nei DataFrame solo alla fine
+        self.state = SimulationState(self.outcome, days)
+        for r, dd in enumerate(days, start=1):
+            trace.debug("\tProcessing Trading Day %s", dd)
+            # prima di tutto copio posizioni e totali da ieri
+            self.state.carry(r)
+            # il book restituisce gli ordini del giorno già nella sequenza di esecuzione
+            for t in self.outcome.pendingTransactions.execution_order(dd):
+                self.exec_trade(t)
+            # calcolo il valore netto di Portafoglio alla fine della giornata di Trading
+            # e ricalcolo order value come percentuale del net value
+            self.BUY_ORDER_VALUE = self.state.value(r) / max_orders
+        self.state.write_back()
         print("\nBella zio!")
         return self.outcome
 
     def exec_trade(self, t: Transaction):
         # TODO: spostare order value come parametro di questo metodo, che è l'unico posto in cui viene usato
         # TODO: verificare che lo stato della Transazione sia Pending
-        # recupero l'asset su cui devo operare
-        logging.debug("Executing transaction: " + str(t))
-        asset = self.outcome.assets[t.asset.symbol]
-
-        # recupero il fattore di conversione per la valuta
-        GBPEUR = self.outcome.assets['GBP'].history.loc[t.when, 'Open'] / 100.0
-        CHFEUR = self.outcome.assets['CHF'].history.loc[t.when, 'Open']
-        USDEUR = self.outcome.assets['USD'].history.loc[t.when, 'Open']
-
-        curr_conv = 1.0
-        if asset.currency != "EUR":
-            if asset.currency == "USD":
-                curr_conv = USDEUR
-            elif asset.currency == "GBP":
-                curr_conv = GBPEUR
-            elif asset.currency == "CHF":
-                curr_conv = CHFEUR
-        logging.debug(asset.currency + " curr_conv " + str(curr_conv))
+        # recupero l'asset su cui devo operare e la sua posizione negli array della simulazione
+        trace.debug("Executing transaction: %s", t)
+        state = self.state
+        symbol = t.asset.symbol
+        asset = self.outcome.assets[symbol]
+        r = state.row(t.when)
+        j = self.outcome.market_data.symbol_pos(symbol)
+        open_price = state.open[r, j]
+        curr_conv = state.open_conv[r, j]
 
         if t.verb == "BUY":
-            logging.debug("Buying " + str(t))
-            # TODO: improve Buying Quantity calculation...
-
             #  assumo di eseguire gli ordini di BUY e SELL come prima
             #  azione della giornata, avendoli calcolati la sera del giorno prima
-            logging.debug("asset price " + str(asset.history.loc[t.when, 'Open']))
-            quantity = math.floor(self.BUY_ORDER_VALUE / (asset.history.loc[t.when, 'Open'] * curr_conv))
-            asset_price = quantity * asset.history.loc[t.when, 'Open'] * curr_conv
+            quantity = math.floor(self.BUY_ORDER_VALUE / (open_price * curr_conv))
+            asset_price = quantity * open_price * curr_conv
             commission = asset_price * asset.assetType.buyCommission
-            if self.outcome.por_history.loc[t.when, 'Liquidity'] >= (asset_price + commission) and quantity > 0.0:
-                # eseguo tx
-                # diminuisco liquidità
-                self.outcome.por_history.loc[t.when, 'Liquidity'] -= (asset_price + commission)
-                # aumento il monte commissioni
-                self.outcome.por_history.loc[t.when, 'TotalCommissions'] += commission
-                # modifico average buy price
-                asset.history.loc[t.when, 'AverageBuyPrice'] = (asset.history.loc[t.when, 'OwnedAmount'] *
-                                                                asset.history.loc[t.when,
-                                                                                  'AverageBuyPrice'] + asset_price) / (
-                                                                       asset.history.loc[t.when,
-                                                                                         'OwnedAmount'] + quantity)
-                # aumento quantità posseduta
-                asset.history.loc[t.when, 'OwnedAmount'] += quantity
+            if state.liquidity[r] >= (asset_price + commission) and quantity > 0.0:
+                # diminuisco liquidità e aumento il monte commissioni
+                state.liquidity[r] -= (asset_price + commission)
+                state.commissions[r] += commission
+                # modifico average buy price e aumento quantità posseduta
+                state.average_price[r, j] = (state.owned[r, j] * state.average_price[r, j] + asset_price) / (
+                        state.owned[r, j] + quantity)
+                state.owned[r, j] += quantity
                 t.state = "executed"
                 t.quantity = quantity
                 t.value = asset_price
-                logging.info("Tx " + str(t) + "\tvalue: " + str(asset_price))
                 self.outcome.executedTransactions.append(t)
+                log_trade(t, liquidity=state.liquidity[r], commission=commission)
             else:
                 # tx fallita per mancanza di liquidità
                 t.state = "failed"
                 t.note += "Not enough liquidity. Transaction" + str(t) + " failed."
-                logging.debug("Tx failed, Not enough liquidity. (Avail. Liquidity: " + str(
-                    self.outcome.por_history.loc[t.when, 'Liquidity']) + ")")
                 self.outcome.failedTransactions.append(t)
+                log_trade(t, liquidity=state.liquidity[r])
         elif t.verb == "SELL":
-            logging.debug("Selling " + str(t))
-            if asset.history.loc[t.when, 'OwnedAmount'] > 0.0:
-                # vendo
-                quantity = asset.history.loc[t.when, 'OwnedAmount']
-                asset_price = quantity * asset.history.loc[t.when, 'Open'] * curr_conv
+            if state.owned[r, j] > 0.0:
+                quantity = state.owned[r, j]
+                asset_price = quantity * open_price * curr_conv
                 commission = asset_price * asset.assetType.buyCommission
-                asset.history.loc[t.when, 'OwnedAmount'] = 0.0
-                # calcolo le tasse
-                tax = (asset_price - quantity * asset.history.loc[t.when, 'AverageBuyPrice']) * asset.assetType.tax_rate
-                # aggiorno liquidità
-                self.outcome.por_history.loc[t.when, 'Liquidity'] += (asset_price - commission - tax)
-                # aumento il monte commissioni
-                self.outcome.por_history.loc[t.when, 'TotalCommissions'] += commission
-                # aggiorno le tasse totali
-                self.outcome.por_history.loc[t.when, 'TotalTaxes'] += tax
+                state.owned[r, j] = 0.0
+                # calcolo le tasse, aggiorno liquidità, monte commissioni e tasse totali
+                tax = (asset_price - quantity * state.average_price[r, j]) * asset.assetType.tax_rate
+                state.liquidity[r] += (asset_price - commission - tax)
+                state.commissions[r] += commission
+                state.taxes[r] += tax
                 # FIXME: devo aggiornare le tasse su ciascuna azione
                 t.state = "executed"
                 t.quantity = quantity
                 t.value = asset_price
-                logging.info("Tx " + str(t) + "\tvalue: " + str(asset_price))
                 self.outcome.executedTransactions.append(t)
+                log_trade(t, liquidity=state.liquidity[r], commission=commission, tax=tax)
             else:
                 t.state = "failed"
                 t.note += "Nothing to SELL. Transaction" + str(t) + " failed."
-                logging.debug("Tx failed, Nothing to SELL")
                 self.outcome.failedTransactions.append(t)
+                log_trade(t, liquidity=state.liquidity[r])
         elif t.verb == "DIVIDEND":
-            logging.debug("DVND " + str(t))
-            tax = asset.assetType.tax_rate * curr_conv * asset.history.loc[t.when, 'OwnedAmount'] * t.value
-            logging.debug("TAX: " + str(tax))
-            net_divd = asset.history.loc[t.when, 'OwnedAmount'] * t.value * curr_conv * (1 - asset.assetType.tax_rate)
-            logging.debug("Net dividend: " + str(net_divd))
-            self.outcome.por_history.loc[t.when, 'Liquidity'] += net_divd
+            tax = asset.assetType.tax_rate * curr_conv * state.owned[r, j] * t.value
+            net_divd = state.owned[r, j] * t.value * curr_conv * (1 - asset.assetType.tax_rate)
+            state.liquidity[r] += net_divd
+            state.taxes[r] += tax
+            state.dividends[r] += net_divd
             t.state = "executed"
-            # aggiorno le tasse totali
-            self.outcome.por_history.loc[t.when, 'TotalTaxes'] += tax
-            t.quantity = asset.history.loc[t.when, 'OwnedAmount']
-            self.outcome.por_history.loc[t.when, 'TotalDividens'] += net_divd
+            t.quantity = state.owned[r, j]
             self.outcome.executedTransactions.append(t)
-            logging.debug("Dividend from " + str(asset.symbol) + " tot Value: " + str(
-                asset.history.loc[t.when, 'OwnedAmount'] * t.value * curr_conv * (1 - asset.assetType.tax_rate)))
+            log_trade(t, liquidity=state.liquidity[r], dividend=net_divd, tax=tax)
         else:
-            logging.debug("Ignoring Tx: " + str(t))
             t.state = "failed"
             t.note += " - no instructions for VERB: " + t.verb
             self.outcome.failedTransactions.append(t)
+            log_trade(t, liquidity=state.liquidity[r])
         # TODO: rimuovere transazione da pendingTransactions
 
 
+# base comune delle strategie sulle bande di Bollinger: le sottoclassi definiscono le regole in signal_masks
+class BandsStrategy(BuyAndHoldTradingStrategy):
+
+    def signal_masks(self, rows: slice, w_long: np.ndarray, days_long: np.ndarray, days_short: np.ndarray) -> tuple:
+        """
+        BUY and SELL rules of the strategy for many parameter sets at once, see screen
+
+        :param rows: MarketData rows of the signal days, each one compared with the row before
+        :param w_long: band multiplier of each parameter set, days_long and days_short its windows
+        :return: buy mask, sell mask and score, parameter sets x days x symbols
+        """
+        raise NotImplementedError
+
+    def _bands(self, rows: slice, w_long: np.ndarray, days_long: np.ndarray, days_short: np.ndarray) -> tuple:
+        # chiusure, bande di Bollinger long e score sui giorni rows preceduti dal giorno prima, per ogni set di
+        # parametri; tradable sui giorni rows
+        panel = self.outcome.market_data
+        span = slice(rows.start - 1, rows.stop)
+
+        def stack(stat: str, windows: np.ndarray) -> np.ndarray:
+            return np.stack([panel.field(self.outcome.stat_field(stat, int(days)))[span] for days in windows])
+
+        sma_long = stack('sma', days_long)
+        std_long = stack('std', days_long)
+        w_long = np.asarray(w_long, dtype='float64')[:, None, None]
+        close = panel.field('Close')[span]
+        # mi assicuro che esistano quotazioni per l'asset e che non sia una valuta
+        tradable = np.array([self.outcome.assets[key].assetType.assetType != "currency" for key in panel.symbols])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = 100.0 * stack('std', days_short)[:, 1:] / sma_long[:, 1:]
+            tradable = (close[1:] > 0.0) & tradable
+        return close, sma_long + w_long * std_long, sma_long - w_long * std_long, score, tradable
+
+    def screen(self, w_long=1.0, days_long=None, days_short=None, chunk: int = None) -> pd.DataFrame:
+        """
+        Evaluates many parameter sets in one vectorized pass, with the batched rules of signal_masks and a simplified
+        simulation: the capital is split evenly among the tradable assets, each share fully invested after a BUY and
+        in cash after a SELL, orders at the next open paying buyCommission, no taxes, dividends, initial buy or final
+        sell. Meant to shortlist the parameters for sweep and runTradingSimulation.
+
+        :param w_long: band multipliers, broadcast with days_long and days_short to one parameter set per element
+        :param days_long: windows, the portfolio ones if missing. Other windows need calc_stats(windows=...)
+        :param chunk: parameter sets evaluated together, bounded by memory if missing
+        :return: one row per parameter set ranked by final net value
+        """
+        portfolio = self.outcome
+        w_long, days_long, days_short = (np.ravel(values) for values in np.broadcast_arrays(
+            w_long, portfolio.days_long if days_long is None else days_long,
+            portfolio.days_short if days_short is None else days_short))
+        panel = portfolio.market_data
+        first = panel.dates.searchsorted(pd.Timestamp(portfolio.start_date))
+        last = panel.dates.searchsorted(pd.Timestamp(portfolio.end_date - BDay(1)), side='right')
+        stop = panel.dates.searchsorted(pd.Timestamp(portfolio.end_date), side='right')
+        # i segnali dei giorni first..last-1 si eseguono il giorno dopo, le posizioni si valutano fino a end_date
+        days = stop - first
+        open_price = panel.field('Open' + portfolio.defCurrency)[first:stop]
+        close = panel.field('Close' + portfolio.defCurrency)[first:stop]
+        prev_close = panel.field('Close' + portfolio.defCurrency)[first - 1:stop - 1]
+        assets = [portfolio.assets[key] for key in panel.symbols]
+        tradable = np.array([asset.assetType.assetType != "currency" for asset in assets])
+        commission = np.array([asset.assetType.buyCommission for asset in assets])
+        share = portfolio.initial_capital / max(1, tradable.sum())
+        cash = portfolio.initial_capital - share * tradable.sum()
+        chunk = chunk or max(1, int(2e7 // max(1, days * len(panel.symbols))))
+        final, average, trades = [], [], []
+        for start in range(0, len(w_long), chunk):
+            part = slice(start, start + chunk)
+            buy, sell, _ = self.signal_masks(slice(first, last), w_long[part], days_long[part], days_short[part])
+            # posizione dopo l'ultimo segnale di ogni giorno: 1 dopo un BUY, 0 dopo un SELL
+            signal = np.full((len(buy), days, len(panel.symbols)), np.nan)
+            signal[:, :last - first][buy] = 1.0
+            signal[:, :last - first][sell] = 0.0
+            latest = np.where(np.isnan(signal), 0, np.arange(days)[None, :, None])
+            np.maximum.accumulate(latest, axis=1, out=latest)
+            position = np.take_along_axis(signal, latest, axis=1) == 1.0
+            # un asset è in portafoglio durante il giorno successivo al segnale
+            held = np.zeros_like(position)
+            held[:, 1:] = position[:, :-1]
+            before = np.zeros_like(held)
+            before[:, 1:] = held[:, :-1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                growth = np.where(held & before, close / prev_close, 1.0)
+                growth = np.where(held & ~before, (1.0 - commission) * close / open_price, growth)
+                growth = np.where(~held & before, (1.0 - commission) * open_price / prev_close, growth)
+            growth[~np.isfinite(growth)] = 1.0
+            nav = cash + share * np.cumprod(growth[:, :, tradable], axis=1).sum(axis=2)
+            final.append(nav[:, -1])
+            average.append(nav.mean(axis=1))
+            trades.append((held != before).sum(axis=(1, 2)))
+        table = pd.DataFrame({'w_long': w_long, 'days_long': days_long, 'days_short': days_short,
+                              'Final Net Value': np.concatenate(final), 'Average Net Value': np.concatenate(average),
+                              'Trades': np.concatenate(trades)})
+        return table.sort_values('Final Net Value', ascending=False, kind='stable').reset_index(drop=True)
+
+
 # Per definire una strategia più complessa estendo la classe BuyAndHoldTradingStrategy e faccio overload del metodo
 # che calcola le suggested transactions
 # questa strategia funziona bene in mercati trending
-class InvBollbandsStrategy(BuyAndHoldTradingStrategy):
+class InvBollbandsStrategy(BandsStrategy):
 
     def __init__(self, in_port):
         super().__init__(in_port)
         self.description = "Inverse Bollinger Bands"
         self.outcome.description = self.description
 
-    def calc_suggested_transactions(self, sell_all=True, initial_buy=True, w_short=1.0, w_long=1.0):
+    def calc_signals(self, sell_all=True, initial_buy=True, w_short=1.0, w_long=1.0) -> np.ndarray:
         # Estendo la strategia base "BUY & HOLD"
         # per confrontare mele con mele, partirei sempre dal Buy and Hold
-        if initial_buy:
-            super().calc_suggested_transactions(sell_all=False)
+        initial = super().calc_signals(sell_all=False) if initial_buy else signal_table()
+        signals = []
         # w_short e w_long sono i moltiplicatori delle banda di Bollingher short e long
-        for key, asset in sorted(self.outcome.assets.items()):
-            assert isinstance(asset, Asset)
-            # per tutti gli asset, tranne il portafoglio stesso e la valuta di riferimento genero dei segnali di BUY o
-            # SELL. Nella strategia BUY & HOLD, se il valore di un asset è 0 allora genero un BUY
-            days_short = self.outcome.days_short
-            days_long = self.outcome.days_long
-            boll_multi = w_long
-            days_buy = []
-            quot_buy = []
-            days_sell = []
-            quot_sell = []
-            for dd in pd.date_range(start=self.outcome.start_date,
-                                    end=(self.outcome.end_date - BDay(1)), freq='B'):
-                # mi assicuro che esistano quotazioni per l'asset, che non sia una valuta e che la varianza sia
-                # significativa, altrimenti siamo in una fase di spostamento laterale
-                if asset.history.loc[dd, 'Close'] > 0.0 and asset.assetType.assetType != "currency":
-                    prev_day = dd - BDay(1)
-                    boll_up_old = asset.history.loc[prev_day, 'sma_long'] + boll_multi * asset.history.loc[
-                        prev_day, 'std_long']
-                    boll_down_old = asset.history.loc[prev_day, 'sma_long'] - boll_multi * asset.history.loc[
-                        prev_day, 'std_long']
-                    quot_old = asset.history.loc[prev_day, 'Close']
-                    quot = asset.history.loc[dd, 'Close']
-                    boll_up = asset.history.loc[dd, 'sma_long'] + boll_multi * asset.history.loc[dd, 'std_long']
-                    boll_down = asset.history.loc[dd, 'sma_long'] - boll_multi * asset.history.loc[dd, 'std_long']
-                    sma_long = asset.history.loc[dd, 'sma_long']
-                    sma_long_old = asset.history.loc[prev_day, 'sma_long']
-                    score = self.scoreSignal(asset, dd)
-
-                    if score > 3.0 and quot >= boll_up and quot_old <= boll_up_old:
-                        # BUY
-                        reason = "TRENDING UP"
-                        logging.debug("\t" + reason + ": Requesting BUY for " + str(key) + " on " + str(
-                            dd.date() + BDay(1)) + "\tquotation: " + str(
-                            asset.history.loc[dd, 'Close']) + "\tscore: " + str(score))
-                        logging.debug("assetType: " + str(asset.assetType))
-                        dailyPendTx = self.outcome.pendingTransactions[dd + BDay(1)]
-                        dailyPendTx.append(
-                            Transaction("BUY", asset, dd + BDay(1), 0, 0.0,
-                                        reason, score=score))
-                        days_buy.append(dd.date())
-                        quot_buy.append(quot)
-                    elif quot <= boll_down and quot_old >= boll_down_old:
-                        # SELL
-                        reason = "TRENDING DOWN"
-                        logging.debug("\t" + reason + ": Requesting SELL for " + str(key) + " on " + str(
-                            dd.date() + BDay(1)) + "\tquotation: " + str(
-                            asset.history.loc[dd, 'Close']) + "\tscore: " + str(score))
-                        dailyPendTx = self.outcome.pendingTransactions[dd + BDay(1)]
-                        dailyPendTx.append(Transaction("SELL", asset, dd + BDay(1), 0, 0.0, reason, score=score))
-                        days_sell.append(dd.date())
-                        quot_sell.append(quot)
-            print(".", end="", flush=True)
-            # BUY_points = pd.DataFrame({'Date': days_buy, 'Quotation': quot_buy})
-            # SELL_points = pd.DataFrame({'Date': days_sell, 'Quotation': quot_sell})
-            # ax = asset.history['Close'].plot(title=asset.symbol)
-            # BUY_points.plot(kind='scatter', ax=ax, x='Date', y='Quotation', color="green", alpha=0.5)
-            # SELL_points.plot(kind='scatter', ax=ax, x='Date', y='Quotation', color="red", alpha=0.5)
-            # plt.show()
-        if sell_all:
-            # l'ultimo giorno vendo tutto.
-            self.sell_all()
-        print(" ")
-        return self.outcome.pendingTransactions
+        # lavoro su tutti gli asset e tutti i giorni da start_date a end_date - 1 insieme, confrontando ogni giorno
+        # con il precedente: il calendario del pannello è fatto di giorni lavorativi, quindi prev_day è la riga prima
+        panel = self.outcome.market_data
+        first = panel.dates.searchsorted(pd.Timestamp(self.outcome.start_date))
+        last = panel.dates.searchsorted(pd.Timestamp(self.outcome.end_date - BDay(1)), side='right')
+        close = panel.field('Close')
+        buy, sell, score = (mask[0] for mask in self.signal_masks(slice(first, last), np.array([w_long]),
+                                                                  np.array([self.outcome.days_long]),
+                                                                  np.array([self.outcome.days_short])))
+        for j, key in enumerate(panel.symbols):
+            for i in np.flatnonzero(buy[:, j] | sell[:, j]):
+                # il segnale è calcolato alla chiusura di dd e l'ordine viene eseguito il giorno lavorativo successivo
+                dd = panel.dates[first + i + 1]
+                if buy[i, j]:
+                    verb = "BUY"
+                    reason = "TRENDING UP"
+                else:
+                    verb = "SELL"
+                    reason = "TRENDING DOWN"
+                trace.debug("\t%s: Requesting %s for %s on %s\tquotation: %s\tscore: %s", reason, verb, key, dd,
+                            close[first + i, j], score[i, j])
+                signals.append((dd, key, verb, score[i, j], reason))
+        # l'ultimo giorno vendo tutto.
+        return signal_table(initial, signals, self.sell_all() if sell_all else [])
+
+    def signal_masks(self, rows, w_long, days_long, days_short):
+        close, boll_up, boll_down, score, tradable = self._bands(rows, w_long, days_long, days_short)
+        with np.errstate(invalid='ignore'):
+            # BUY quando la quotazione attraversa la banda superiore verso l'alto e la varianza è significativa
+            buy = tradable & (score > 3.0) & (close[1:] >= boll_up[:, 1:]) & (close[:-1] <= boll_up[:, :-1])
+            # SELL quando attraversa la banda inferiore verso il basso
+            sell = tradable & ~buy & (close[1:] <= boll_down[:, 1:]) & (close[:-1] >= boll_down[:, :-1])
+        return buy, sell, score
 
 
 # Per definire una strategia più complessa estendo la classe BuyAndHoldTradingStrategy e faccio overload del metodo
 # che calcola le suggested transactions
 # questa strategia funziona bene in mercati bounded
-class BollbandsStrategy(BuyAndHoldTradingStrategy):
+class BollbandsStrategy(BandsStrategy):
 
     def __init__(self, in_port):
         super().__init__(in_port)
         self.description = "Bollinger Bands"
         self.outcome.description = self.description
 
-    def calc_suggested_transactions(self, sell_all=True, initial_buy=True, w_short=1.0, w_long=1.0):
+    def calc_signals(self, sell_all=True, initial_buy=True, w_short=1.0, w_long=1.0) -> np.ndarray:
         # Estendo la strategia base "BUY & HOLD"
         # per confrontare mele con mele, partirei sempre dal Buy and Hold
-        if initial_buy:
-            super().calc_suggested_transactions(sell_all=False)
+        initial = super().calc_signals(sell_all=False) if initial_buy else signal_table()
+        signals = []
         # w_short e w_long sono i moltiplicatori delle banda di Bollingher short e long
-        for key, asset in sorted(self.outcome.assets.items()):
-            assert isinstance(asset, Asset)
-            # per tutti gli asset, tranne il portafoglio stesso e la valuta di riferimento genero dei segnali di BUY o
-            # SELL. Nella strategia BUY & HOLD, se il valore di un asset è 0 allora genero un BUY
-            days_short = self.outcome.days_short
-            days_long = self.outcome.days_long
-            boll_multi = w_long
-            days_buy = []
-            quot_buy = []
-            days_sell = []
-            quot_sell = []
-            for dd in pd.date_range(start=self.outcome.start_date,
-                                    end=(self.outcome.end_date - BDay(1)), freq='B'):
-                # mi assicuro che esistano quotazioni per l'asset, che non sia una valuta e che la varianza sia
-                # significativa, altrimenti siamo in una fase di spostamento laterale
-                if asset.history.loc[dd, 'Close'] > 0.0 and asset.assetType.assetType != "currency":
-                    prev_day = dd.date() - BDay(1)
-                    boll_up_old = asset.history.loc[prev_day, 'sma_long'] + boll_multi * asset.history.loc[
-                        prev_day, 'std_long']
-                    boll_down_old = asset.history.loc[prev_day, 'sma_long'] - boll_multi * asset.history.loc[
-                        prev_day, 'std_long']
-                    quot_old = asset.history.loc[prev_day, 'Close']
-                    quot = asset.history.loc[dd, 'Close']
-                    boll_up = asset.history.loc[dd, 'sma_long'] + boll_multi * asset.history.loc[dd, 'std_long']
-                    boll_down = asset.history.loc[dd, 'sma_long'] - boll_multi * asset.history.loc[dd, 'std_long']
-                    sma_long = asset.history.loc[dd, 'sma_long']
-                    sma_long_old = asset.history.loc[prev_day, 'sma_long']
-
-                    if quot > boll_down and quot_old < boll_down_old:
-                        # BUY
-                        reason = "CHEAP"
-                        score = self.scoreSignal(asset, dd)
-                        logging.debug("\t" + reason + ": Requesting BUY for " + str(key) + " on " + str(
-                            dd.date() + BDay(1)) + "\tquotation: " + str(asset.history.loc[dd, 'Close']))
-                        logging.debug("assetType: " + str(asset.assetType))
-                        dailyPendTx = self.outcome.pendingTransactions[dd + BDay(1)]
-                        dailyPendTx.append(
-                            Transaction("BUY", asset, dd.date() + BDay(1), 0, 0.0,
-                                        reason, score=score))
-                        days_buy.append(dd.date())
-                        quot_buy.append(quot)
-                    elif quot < boll_up and quot_old > boll_up_old:
-                        # SELL
-                        reason = "EXPENSIVE"
-                        logging.debug("\t" + reason + ": Requesting SELL for " + str(key) + " on " + str(
-                            dd.date() + BDay(1)) + "\tquotation: " + str(
-                            asset.history.loc[dd, 'Close']))
-                        dailyPendTx = self.outcome.pendingTransactions[dd + BDay(1)]
-                        dailyPendTx.append(Transaction("SELL", asset, dd + BDay(1), 0, 0.0, reason))
-                        days_sell.append(dd.date())
-                        quot_sell.append(quot)
+        # come InvBollbandsStrategy lavoro su tutti gli asset e tutti i giorni da start_date a end_date - 1 insieme
+        panel = self.outcome.market_data
+        first = panel.dates.searchsorted(pd.Timestamp(self.outcome.start_date))
+        last = panel.dates.searchsorted(pd.Timestamp(self.outcome.end_date - BDay(1)), side='right')
+        close = panel.field('Close')
+        buy, sell, score = (mask[0] for mask in self.signal_masks(slice(first, last), np.array([w_long]),
+                                                                  np.array([self.outcome.days_long]),
+                                                                  np.array([self.outcome.days_short])))
+        for j, key in enumerate(panel.symbols):
+            for i in np.flatnonzero(buy[:, j] | sell[:, j]):
+                dd = panel.dates[first + i + 1]
+                if buy[i, j]:
+                    reason = "CHEAP"
+                    trace.debug("\t%s: Requesting BUY for %s on %s\tquotation: %s", reason, key, dd,
+                                close[first + i, j])
+                    signals.append((dd, key, "BUY", score[i, j], reason))
+                else:
+                    reason = "EXPENSIVE"
+                    trace.debug("\t%s: Requesting SELL for %s on %s\tquotation: %s", reason, key, dd,
+                                close[first + i, j])
+                    signals.append((dd, key, "SELL", 100, reason))
             print(".", end="", flush=True)
-            # BUY_points = pd.DataFrame({'Date': days_buy, 'Quotation': quot_buy})
-            # SELL_points = pd.DataFrame({'Date': days_sell, 'Quotation': quot_sell})
-            # ax = asset.history['Close'].plot(title=asset.symbol)
-            # BUY_points.plot(kind='scatter', ax=ax, x='Date', y='Quotation', color="green", alpha=0.5)
-            # SELL_points.plot(kind='scatter', ax=ax, x='Date', y='Quotation', color="red", alpha=0.5)
-            # plt.show()
-        if sell_all:
-            # l'ultimo giorno vendo tutto.
-            self.sell_all()
         print(" ")
-        return self.outcome.pendingTransactions
+        # l'ultimo giorno vendo tutto.
+        return signal_table(initial, signals, self.sell_all() if sell_all else [])
+
+    def signal_masks(self, rows, w_long, days_long, days_short):
+        close, boll_up, boll_down, score, tradable = self._bands(rows, w_long, days_long, days_short)
+        with np.errstate(invalid='ignore'):
+            # BUY quando la quotazione rientra sopra la banda inferiore
+            buy = tradable & (close[1:] > boll_down[:, 1:]) & (close[:-1] < boll_down[:, :-1])
+            # SELL quando rientra sotto la banda superiore
+            sell = tradable & ~buy & (close[1:] < boll_up[:, 1:]) & (close[:-1] > boll_up[:, :-1])
+        return buy, sell, score
 
 
 # Strategia complessa a piacere, con stop-loss e takeprofit
@@ -898,11 +2245,11 @@ class CustomStrategy(BuyAndHoldTradingStrategy):
         self.description = "Custom"
         self.outcome.description = self.description
 
-    def calc_suggested_transactions(self, sell_all=True, initial_buy=True, w_short=1.0, w_long=1.0):
+    def calc_signals(self, sell_all=True, initial_buy=True, w_short=1.0, w_long=1.0) -> np.ndarray:
         # Estendo la strategia base "BUY & HOLD"
         # per confrontare mele con mele, partirei sempre dal Buy and Hold
-        if initial_buy:
-            super().calc_suggested_transactions(sell_all=False)
+        initial = super().calc_signals(sell_all=False) if initial_buy else signal_table()
+        signals = []
 
         # da qui in poi applico le transazioni che ho registrato in un file CSV
         filename = "./sim_trade/myTransactions.csv"
@@ -924,16 +2271,13 @@ class CustomStrategy(BuyAndHoldTradingStrategy):
                     reason = "MANUAL TX"
                     if verb == "BUY":
                         score = self.scoreSignal(asset, dd)
-                        logging.debug("\t" + reason + ": Requesting BUY for " + str(symbol) + " on " + str(
-                            dd.date()) + "\tquotation: " + str(quot) + "\tscore: " + str(score))
-                        logging.debug("assetType: " + str(asset.assetType))
-                        dailyPendTx = self.outcome.pendingTransactions[dd]
-                        dailyPendTx.append(Transaction("BUY", asset, dd, 0, 0.0, reason, score=score))
+                        trace.debug("\t%s: Requesting BUY for %s on %s\tquotation: %s\tscore: %s", reason, symbol, dd,
+                                    quot, score)
+                        trace.debug("assetType: %s", asset.assetType)
+                        signals.append((dd, symbol, "BUY", score, reason))
                     elif verb == "SELL":
-                        logging.debug("\t" + reason + ": Requesting SELL for " + str(symbol) + " on " + str(
-                            dd.date()) + "\tquotation: " + str(quot))
-                        dailyPendTx = self.outcome.pendingTransactions[dd]
-                        dailyPendTx.append(Transaction("SELL", asset, dd, 0, 0.0, reason))
+                        trace.debug("\t%s: Requesting SELL for %s on %s\tquotation: %s", reason, symbol, dd, quot)
+                        signals.append((dd, symbol, "SELL", 100, reason))
                     else:
                         # unexpected, log error and raise exception
                         logging.error(verb + " : is not a valid VERB")
@@ -944,7 +2288,178 @@ class CustomStrategy(BuyAndHoldTradingStrategy):
             # BUY_points.plot(kind='scatter', ax=ax, x='Date', y='Quotation', color="green", alpha=0.5)
             # SELL_points.plot(kind='scatter', ax=ax, x='Date', y='Quotation', color="red", alpha=0.5)
             # plt.show()
-            if sell_all:
-                # l'ultimo giorno vendo tutto.
-                self.sell_all()
-        return self.outcome.pendingTransactions
+        # l'ultimo giorno vendo tutto.
+        return signal_table(initial, signals, self.sell_all() if sell_all else [])
+
+
+# Ricerca dei parametri: ogni combinazione di strategia e parametri viene simulata in un pool di processi.
+# Il Portfolio arriva a ogni worker una volta sola, all'avvio del processo, e non con ogni task: i dati di mercato
+# sono pubblicati con Portfolio.share, quindi ogni worker mappa lo stesso file invece di riceverne una copia;
+# i max_orders di una stessa combinazione condividono la tabella dei segnali (vedi BuyAndHoldTradingStrategy.execute)
+_sweep_portfolio = None
+
+
+def _init_sweep_worker(portfolio: Portfolio):
+    global _sweep_portfolio
+    _sweep_portfolio = portfolio
+
+
+def _sweep_task(task: tuple) -> list:
+    strategy_class, params, max_orders, sell_all = task
+    portfolio = _sweep_portfolio.clone(days_short=params['days_short'], days_long=params['days_long'])
+    strategy = strategy_class(portfolio)
+    signals = strategy.calc_signals(sell_all=sell_all, w_short=params['w_short'], w_long=params['w_long'])
+    rows = []
+    for orders in max_orders:
+        outcome = strategy.execute(signals, max_orders=orders)
+        rows.append(dict(simulation_outcome(outcome), **params, max_orders=orders))
+    return rows
+
+
+def simulation_outcome(outcome: Portfolio) -> dict:
+    """
+    :return: summary of a simulated portfolio, from start_date to end_date
+    """
+    por = outcome.por_history.loc[outcome.start_date:]
+    return {'Simulation Strategy': outcome.description, 'Average Net Value': por['NetValue'].mean(),
+            'Final Net Value': por['NetValue'].iloc[-1], 'Final Liquidity': por['Liquidity'].iloc[-1],
+            'TotalCommissions': por['TotalCommissions'].iloc[-1], 'TotalDividens': por['TotalDividens'].iloc[-1],
+            'TotalTaxes': por['TotalTaxes'].iloc[-1],
+            'Executed Tx': int(np.isin(outcome.executedTransactions.table['verb'], ("BUY", "SELL")).sum())}
+
+
+def sweep(portfolio: Portfolio, strategies: typing.Iterable[type] = (InvBollbandsStrategy,),
+          w_long: typing.Iterable[float] = (1.0,), w_short: typing.Iterable[float] = (1.0,),
+          days_short: typing.Iterable[int] = None, days_long: typing.Iterable[int] = None,
+          max_orders: typing.Iterable[float] = (25.0,), sell_all=True, processes: int = None) -> pd.DataFrame:
+    """
+    Simulates every combination of strategy and parameters on a process pool.
+
+    :param portfolio: loaded portfolio, after fix_history_data. Windows other than its days_short and days_long need
+     calc_stats(windows=...) before fix_history_data
+    :param strategies: BuyAndHoldTradingStrategy and subclasses
+    :param days_short: the portfolio days_short if missing, same for days_long
+    :param processes: worker processes, os.cpu_count() if missing; 1 runs everything in this process
+    :return: one row per simulation, ranked by final net value
+    """
+    days_short = [portfolio.days_short] if days_short is None else list(days_short)
+    days_long = [portfolio.days_long] if days_long is None else list(days_long)
+    for short, long in itertools.product(days_short, days_long):
+        # controllo subito che esistano gli indicatori, prima di far partire i worker
+        portfolio.clone(days_short=short, days_long=long)
+    tasks = [(strategy, dict(w_long=wl, w_short=ws, days_short=short, days_long=long), list(max_orders), sell_all)
+             for strategy, wl, ws, short, long in itertools.product(strategies, w_long, w_short, days_short, days_long)]
+    table = pd.DataFrame([row for rows in _run_tasks(portfolio, tasks, processes) for row in rows])
+    return table.sort_values('Final Net Value', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def _run_tasks(portfolio: Portfolio, tasks: list, processes: int = None) -> list:
+    # esegue i task di _sweep_task, in questo processo o in un pool che mappa il pannello condiviso
+    if processes == 1:
+        _init_sweep_worker(portfolio)
+        try:
+            return [_sweep_task(task) for task in tasks]
+        finally:
+            _init_sweep_worker(None)
+    shared = portfolio.share()
+    try:
+        with ProcessPoolExecutor(processes, initializer=_init_sweep_worker, initargs=(shared,)) as pool:
+            return list(pool.map(_sweep_task, tasks))
+    finally:
+        shared.market_data.unlink()
+
+
+# Walk-forward: finestre in-sample e out-of-sample scorrono sul periodo del Portfolio. Per ogni fold scelgo i
+# parametri migliori in-sample con sweep e li valuto sulla finestra successiva; tutte le finestre sono
+# Portfolio.window dello stesso portafoglio, quindi quotazioni e indicatori si calcolano una volta sola
+def walk_forward(portfolio: Portfolio, strategy_class: type = InvBollbandsStrategy, in_sample: int = 252,
+                 out_of_sample: int = 63, step: int = None, anchored=False, metric='Final Net Value',
+                 w_long: typing.Iterable[float] = (1.0,), w_short: typing.Iterable[float] = (1.0,),
+                 days_short: typing.Iterable[int] = None, days_long: typing.Iterable[int] = None,
+                 max_orders: typing.Iterable[float] = (25.0,), sell_all=True, processes: int = 1) -> pd.DataFrame:
+    """
+    Rolling-origin evaluation of a strategy between portfolio.start_date and portfolio.end_date.
+
+    :param portfolio: loaded portfolio, after fix_history_data; windows other than its own need
+     calc_stats(windows=...) before fix_history_data
+    :param in_sample: business days of the in-sample windows, out_of_sample those of the windows that follow
+    :param step: business days between two folds, out_of_sample if missing
+    :param anchored: every in-sample window starts at portfolio.start_date
+    :param metric: column of simulation_outcome maximized in-sample
+    :param processes: see sweep
+    :return: one row per fold with the windows, the parameters chosen in-sample, the in-sample metric and the
+     out-of-sample outcome
+    """
+    calendar = pd.bdate_range(portfolio.start_date, portfolio.end_date)
+    step = step or out_of_sample
+    folds = []
+    for origin in range(in_sample - 1, len(calendar) - out_of_sample, step):
+        start = calendar[0] if anchored else calendar[origin - in_sample + 1]
+        best = sweep(portfolio.window(start, calendar[origin]), strategies=[strategy_class], w_long=w_long,
+                     w_short=w_short, days_short=days_short, days_long=days_long, max_orders=max_orders,
+                     sell_all=sell_all, processes=processes).sort_values(metric, ascending=False, kind='stable').iloc[0]
+        # il fuori campione parte dalla chiusura dell'ultimo giorno in-sample: si opera dal giorno dopo
+        window = portfolio.window(calendar[origin], calendar[origin + out_of_sample],
+                                  days_short=int(best['days_short']), days_long=int(best['days_long']))
+        strategy = strategy_class(window)
+        signals = strategy.calc_signals(sell_all=sell_all, w_short=best['w_short'], w_long=best['w_long'])
+        outcome = strategy.execute(signals, max_orders=best['max_orders'])
+        folds.append(dict({'In Sample Start': start, 'In Sample End': calendar[origin],
+                           'Out of Sample End': calendar[origin + out_of_sample]},
+                          **{name: best[name] for name in ('w_long', 'w_short', 'days_short', 'days_long',
+                                                           'max_orders')},
+                          **{'In Sample ' + metric: best[metric]}, **simulation_outcome(outcome)))
+    return pd.DataFrame(folds)
+
+
+# Successive halving: tutte le configurazioni girano su un primo tratto del periodo, solo la frazione 1/eta migliore
+# passa al round successivo su un orizzonte eta volte più lungo, fino al periodo intero. Le configurazioni sono un
+# campione del grid estratto con seed e a parità di metrica vale l'ordine del grid: stesso seed, stesso risultato
+def successive_halving(portfolio: Portfolio, strategy_class: type = InvBollbandsStrategy,
+                       w_long: typing.Iterable[float] = (1.0,), w_short: typing.Iterable[float] = (1.0,),
+                       days_short: typing.Iterable[int] = None, days_long: typing.Iterable[int] = None,
+                       max_orders: typing.Iterable[float] = (25.0,), configurations: int = None, eta: int = 3,
+                       min_days: int = 63, metric='Final Net Value', sell_all=True, seed: int = 0,
+                       processes: int = 1) -> pd.DataFrame:
+    """
+    Searches the parameter grid running most configurations on a prefix of the period only.
+
+    :param portfolio: loaded portfolio, after fix_history_data, see sweep
+    :param configurations: size of the random sample of the grid, the whole grid if missing
+    :param eta: each round keeps the best 1/eta of the configurations and multiplies the horizon by eta
+    :param min_days: business days after portfolio.start_date simulated in the first round
+    :param metric: column of simulation_outcome to maximize
+    :param seed: seed of the sample
+    :return: one row per configuration and round, with its Configuration number in the grid, the Round and the End of
+     its horizon; the last round (on the whole period) first, best first
+    """
+    days_short = [portfolio.days_short] if days_short is None else list(days_short)
+    days_long = [portfolio.days_long] if days_long is None else list(days_long)
+    names = ('w_long', 'w_short', 'days_short', 'days_long', 'max_orders')
+    grid = list(itertools.product(w_long, w_short, days_short, days_long, max_orders))
+    numbers = range(len(grid))
+    if configurations is not None and configurations < len(grid):
+        numbers = np.sort(np.random.default_rng(seed).choice(len(grid), size=configurations, replace=False))
+    alive = [int(number) for number in numbers]
+    calendar = pd.bdate_range(portfolio.start_date, portfolio.end_date)
+    horizon = min_days
+    rounds = []
+    for number in itertools.count():
+        end = calendar[min(horizon, len(calendar) - 1)]
+        # i max_orders con gli stessi parametri di segnale condividono un task, e quindi la tabella dei segnali
+        groups = dict()
+        for configuration in alive:
+            groups.setdefault(grid[configuration][:4], []).append(configuration)
+        tasks = [(strategy_class, dict(zip(names[:4], params)), [grid[c][4] for c in group], sell_all)
+                 for params, group in groups.items()]
+        results = _run_tasks(portfolio.window(calendar[0], end), tasks, processes)
+        table = pd.DataFrame([dict(row, Configuration=configuration, Round=number, End=end)
+                              for group, rows in zip(groups.values(), results)
+                              for configuration, row in zip(group, rows)])
+        table = table.sort_values('Configuration').sort_values(metric, ascending=False, kind='stable')
+        rounds.append(table)
+        if end == calendar[-1]:
+            break
+        alive = sorted(table['Configuration'].iloc[:max(1, math.ceil(len(table) / eta))])
+        horizon *= eta
+    return pd.concat(rounds[::-1], ignore_index=True)
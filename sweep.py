@@ -0,0 +1,97 @@
+# ver 1.0
+
+"""
+Parameter sweep: simulates every combination of strategy and parameters on the same Portfolio, in parallel,
+and prints the results ranked by final net value. With --halving most combinations only run on a prefix of the
+period, see sim_trade.successive_halving.
+It relies on the sim_trade library
+
+example: python sweep.py --start 2018-01-02 --w-long 1 1.5 2 --days-long 100 150 --max-orders 10 25 50
+"""
+
+
+import argparse
+import datetime
+import logging
+import os
+import pandas as pd
+import sim_trade
+from pandas.tseries.offsets import BDay
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulates every combination of the given parameters")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, default=datetime.date(2020, 10, 28))
+    parser.add_argument("--end", type=datetime.date.fromisoformat, default=datetime.date.today())
+    parser.add_argument("--capital", type=float, default=100000.0)
+    parser.add_argument("--strategies", nargs='+', default=["InvBollbandsStrategy"],
+                        help="strategy classes of sim_trade")
+    parser.add_argument("--w-long", nargs='+', type=float, default=[1.0])
+    parser.add_argument("--w-short", nargs='+', type=float, default=[1.0])
+    parser.add_argument("--days-short", nargs='+', type=int, default=[20])
+    parser.add_argument("--days-long", nargs='+', type=int, default=[150])
+    parser.add_argument("--max-orders", nargs='+', type=float, default=[25.0])
+    parser.add_argument("--keep", action="store_true", help="do not sell everything on the last day")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, default one per CPU")
+    parser.add_argument("--halving", action="store_true",
+                        help="successive halving instead of the full grid, one strategy at a time")
+    parser.add_argument("--configurations", type=int, default=None, help="halving: random sample of the grid")
+    parser.add_argument("--eta", type=int, default=3, help="halving: keep 1/eta of the configurations per round")
+    parser.add_argument("--min-days", type=int, default=63, help="halving: business days of the first round")
+    parser.add_argument("--seed", type=int, default=0, help="halving: seed of the sample")
+    parser.add_argument("--output", default=None, help="CSV file for the results")
+    parser.add_argument("--profile", default=None, help="file for the cProfile statistics of the stages")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("\nStarting...")
+    os.makedirs("./logs", exist_ok=True)
+    logging.basicConfig(filename="./logs/sweep.log", level=logging.INFO)
+    start_date = args.start + BDay(0)
+    end_date = args.end + BDay(1)
+
+    profiler = sim_trade.Profiler(profile=args.profile)
+    # il Portfolio viene caricato una volta sola, con gli indicatori per tutte le finestre richieste
+    myPortfolio = sim_trade.Portfolio(start_date, end_date, args.capital, days_short=args.days_short[0],
+                                      days_long=args.days_long[0])
+    print("\tInit Portfolio")
+    with profiler.stage("loadAssetList"):
+        myPortfolio.loadAssetList()
+    print("\tLoading quotations")
+    with profiler.stage("loadQuotations"):
+        failures = myPortfolio.loadQuotations('./data/cache', store=sim_trade.QuoteStore('./data/quotes'))
+    for symbol, error in failures.items():
+        print("\tFailed to retrieve " + symbol + ", skipping it: " + error)
+    print("\tCalculating Basic Stats")
+    with profiler.stage("calc_stats"):
+        myPortfolio.calc_stats(windows=sorted(set(args.days_short + args.days_long)))
+    print("\tFixing Data")
+    with profiler.stage("fix_history_data"):
+        myPortfolio.fix_history_data()
+
+    print("\tSimulating")
+    params = dict(w_long=args.w_long, w_short=args.w_short, days_short=args.days_short, days_long=args.days_long,
+                  max_orders=args.max_orders, sell_all=not args.keep, processes=args.processes)
+    # i segnali e le simulazioni girano nei processi del pool: la fase ne misura il tempo complessivo
+    with profiler.stage("sweep"):
+        if args.halving:
+            results = pd.concat([sim_trade.successive_halving(myPortfolio, getattr(sim_trade, name),
+                                                              configurations=args.configurations, eta=args.eta,
+                                                              min_days=args.min_days, seed=args.seed, **params)
+                                 for name in args.strategies], ignore_index=True)
+        else:
+            results = sim_trade.sweep(myPortfolio, strategies=[getattr(sim_trade, name) for name in args.strategies],
+                                      **params)
+    pd.set_option("display.max_rows", None, "display.max_columns", None, "display.width", 1000)
+    print("\nSweep Outcome:\n")
+    print(results)
+    if args.output:
+        results.to_csv(args.output, index=False)
+    print("\nStages:\n")
+    print(profiler.table())
+    logging.info("Stages:\n" + profiler.table().to_string())
+    if args.profile:
+        profiler.dump()
+    print("\nEnded, please check log file.\n")
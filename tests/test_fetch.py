@@ -0,0 +1,77 @@
+import pandas as pd
+import pytest
+
+import sim_trade
+from test_quote_store import fake_yahoo_data
+
+
+def make_portfolio():
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-01-04'), pd.Timestamp('2021-03-31'), 1000.0)
+    portfolio.assets["USD"] = sim_trade.Asset(sim_trade.CURRENCY, "USD", "USDEUR=X", "FX", "USD")
+    portfolio.assets["NESN.SW"] = sim_trade.Asset(sim_trade.EQUITY, "Nestle", "NESN.SW", "VIRTX", "CHF")
+    portfolio.assets["FLAKY"] = sim_trade.Asset(sim_trade.EQUITY, "Flaky", "FLAKY", "NYSE", "USD")
+    portfolio.assets["BROKEN"] = sim_trade.Asset(sim_trade.EQUITY, "Broken", "BROKEN", "NYSE", "USD")
+    return portfolio
+
+
+@pytest.fixture
+def flaky_yahoo(monkeypatch):
+    calls = []
+
+    def get_data_yahoo(symbol, start, end, session=None, get_actions=False):
+        calls.append(symbol)
+        if symbol == "BROKEN" or (symbol == "FLAKY" and calls.count(symbol) < 3):
+            raise IOError("HTTP 503 for " + symbol)
+        return fake_yahoo_data(start, end)
+
+    monkeypatch.setattr(sim_trade.pdr, "get_data_yahoo", get_data_yahoo, raising=False)
+    return calls
+
+
+def test_flaky_symbol_is_retried_and_broken_one_reported(tmp_path, flaky_yahoo):
+    portfolio = make_portfolio()
+    failures = portfolio.loadQuotations(str(tmp_path / "cache"), concurrency=2, retries=2, backoff=0.0)
+    assert list(failures) == ["BROKEN"] and "HTTP 503" in failures["BROKEN"]
+    assert flaky_yahoo.count("FLAKY") == 3
+    assert flaky_yahoo.count("BROKEN") == 3
+    # gli altri simboli vengono scaricati una volta sola
+    assert flaky_yahoo.count("NESN.SW") == 1
+    assert sorted(portfolio.assets) == ["FLAKY", "NESN.SW", "USD"]
+    assert len(portfolio.assets["FLAKY"].history) > 0
+
+
+def test_failed_currency_raises(tmp_path, monkeypatch):
+    def get_data_yahoo(symbol, start, end, session=None, get_actions=False):
+        raise IOError("HTTP 503 for " + symbol)
+
+    monkeypatch.setattr(sim_trade.pdr, "get_data_yahoo", get_data_yahoo, raising=False)
+    with pytest.raises(Exception, match="USDEUR=X"):
+        make_portfolio().loadQuotations(str(tmp_path / "cache"), retries=0, backoff=0.0)
+
+
+def test_fetch_quotations_keeps_job_order(monkeypatch):
+    monkeypatch.setattr(sim_trade.pdr, "get_data_yahoo",
+                        lambda symbol, start, end, session=None, get_actions=False: fake_yahoo_data(start, end),
+                        raising=False)
+    provider = sim_trade.YahooProvider(sim_trade.requests_cache.CachedSession(backend='memory'))
+    assets = [sim_trade.Asset(sim_trade.CURRENCY, str(i), str(i), "FX", "USD") for i in range(5)]
+    jobs = [[asset, pd.Timestamp('2021-01-04'), pd.Timestamp('2021-01-29'), provider] for asset in assets]
+    results = sim_trade.fetch_quotations(jobs, concurrency=2)
+    assert [result[0] for result in results] == assets
+
+
+def test_yahoo_history_splits_bars_and_actions(monkeypatch):
+    def get_data_yahoo(symbol, start, end, session=None, get_actions=False):
+        assert get_actions
+        data = fake_yahoo_data(start, end)
+        data['Splits'] = float('nan')
+        data.loc[pd.Timestamp('2020-06-01'), 'Splits'] = 2.0
+        return data
+
+    monkeypatch.setattr(sim_trade.pdr, "get_data_yahoo", get_data_yahoo, raising=False)
+    provider = sim_trade.YahooProvider(sim_trade.requests_cache.CachedSession(backend='memory'))
+    history, actions = provider.get_history("NESN.SW", pd.Timestamp('2020-01-01'), pd.Timestamp('2020-12-31'))
+    assert list(history.columns) == sim_trade.QUOTE_COLUMNS and history['Close'].notna().all()
+    assert sorted(zip(actions.index, actions['action'], actions['value'])) == [
+        (pd.Timestamp('2020-03-16'), "DIVIDEND", 0.5), (pd.Timestamp('2020-06-01'), "SPLIT", 2.0),
+        (pd.Timestamp('2020-09-15'), "DIVIDEND", 0.5)]
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import sim_trade
+from test_quote_store import fake_history
+
+
+def make_portfolio(history):
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-03-01'), pd.Timestamp('2021-03-31'), 1000.0, days_short=5,
+                                    days_long=10)
+    portfolio.assets["NESN.SW"] = sim_trade.Asset(sim_trade.EQUITY, "Nestle", "NESN.SW", "VIRTX", "CHF", history)
+    portfolio.calc_stats()
+    return portfolio
+
+
+def test_fix_history_fills_gaps_and_repairs_outliers():
+    history = fake_history('2021-01-04', '2021-03-31')
+    history.loc['2021-03-10', ['Open', 'Close']] *= 100  # pence al posto di pound
+    history.loc['2021-03-24', 'Close'] /= 100
+    raw_0310 = history.loc['2021-03-10'].copy()
+    history = history.drop(pd.to_datetime(['2021-03-11', '2021-03-12', '2021-03-15']))
+    portfolio = make_portfolio(history)
+    portfolio.fix_history_data()
+    fixed = portfolio.assets["NESN.SW"].history
+
+    assert fixed.index.name == 'Date' and fixed.index.equals(pd.bdate_range('2021-02-22', '2021-03-31'))
+    assert (fixed[['OwnedAmount', 'AverageBuyPrice', 'NetWorth', 'TotTaxes', 'TotCommissions']] == 0.0).all().all()
+    assert fixed.loc['2021-03-10', 'Close'] == raw_0310['Close'] / 100
+    assert fixed.loc['2021-03-10', 'Open'] == raw_0310['Open'] / 100
+    assert fixed.loc['2021-03-24', 'Close'] == history.loc['2021-03-24', 'Close'] * 100
+    assert fixed.loc['2021-03-24', 'Open'] == history.loc['2021-03-24', 'Open']
+    # come il vecchio ciclo, i giorni mancanti copiano la quotazione precedente così come è arrivata
+    for day in ['2021-03-11', '2021-03-12', '2021-03-15']:
+        assert np.array_equal(fixed.loc[day, history.columns].to_numpy(dtype='float64'),
+                              history.loc['2021-03-10'].to_numpy(dtype='float64'), equal_nan=True)
+    # prima della prima quotazione nel calendario le righe sono a zero
+    late = make_portfolio(fake_history('2021-03-03', '2021-03-31'))
+    late.fix_history_data()
+    before_first_quote = late.assets["NESN.SW"].history.loc['2021-02-22':'2021-03-02']
+    assert (before_first_quote.drop(columns=['OpenFX', 'CloseFX']) == 0.0).all().all()
+
+
+def test_portfolio_calendar_is_preallocated():
+    # start_date di sabato: la prima riga resta start_date, seguita dai giorni lavorativi da start_date - 1
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-01-02'), pd.Timestamp('2021-01-08'), 1000.0)
+    assert list(portfolio.por_history.index) == list(pd.to_datetime(['2021-01-02', '2021-01-01', '2021-01-04',
+                                                                     '2021-01-05', '2021-01-06', '2021-01-07',
+                                                                     '2021-01-08']))
+    assert (portfolio.por_history[['Liquidity', 'NetValue']] == 1000.0).all().all()
+    assert (portfolio.por_history[['TotalCommissions', 'TotalDividens', 'TotalTaxes']] == 0.0).all().all()
+    assert portfolio.pendingTransactions.calendar.equals(pd.bdate_range('2021-01-01', '2021-01-08'))
+    # il book è vuoto finché non arrivano ordini, ma ogni giorno del calendario si può leggere
+    assert len(portfolio.pendingTransactions) == 0
+    assert portfolio.pendingTransactions[pd.Timestamp('2021-01-05')] == ()
+
+
+def test_order_book_is_sparse_and_sorted_for_execution():
+    portfolio = make_portfolio(fake_history('2021-01-04', '2021-03-31'))
+    asset, day = portfolio.assets["NESN.SW"], pd.Timestamp('2021-03-10')
+    orders = [sim_trade.Transaction("BUY", asset, day, score=5), sim_trade.Transaction("SELL", asset, day),
+              sim_trade.Transaction("BUY", asset, day, score=float('nan')),
+              sim_trade.Transaction("BUY", asset, day, score=20), sim_trade.Transaction("DIVIDEND", asset, day)]
+    book = portfolio.pendingTransactions
+    book.extend(orders)
+    assert list(book) == [day] and book[day] == tuple(orders)
+    assert book.execution_order(day) == [orders[i] for i in (4, 1, 3, 0, 2)]
+    # la priorità non modifica lo score delle transazioni
+    assert np.isnan(orders[2].score)
+    assert book[pd.Timestamp('2021-03-11')] == () and pd.Timestamp('2021-03-11') not in book
+    with pytest.raises(KeyError):
+        book.add(sim_trade.Transaction("BUY", asset, pd.Timestamp('2021-05-03')))
+    # new scrive la riga direttamente nella tabella del book
+    split = book.new("SPLIT", asset, day, 0, 2.0)
+    assert split._log is book.log and book.execution_order(day)[0] == split and len(book.log) == 6
+    with pytest.raises(KeyError):
+        book.new("BUY", asset, pd.Timestamp('2021-05-03'))
+    assert len(book.log) == 6
+    # le quantità intere si stampano senza ".0"
+    assert str(split) == "2021-03-10 : SPLIT\tNESN.SW\t2.0 0 pending\tscore: 100.0"
+    split.quantity = 120.0
+    assert str(split).startswith("2021-03-10 : SPLIT\tNESN.SW\t2.0 120.0 pending")
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+import sim_trade
+from test_quote_store import fake_history
+
+
+def test_calc_stats_matches_per_asset_rolling():
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-03-01'), pd.Timestamp('2021-03-31'), 1000.0, days_short=5,
+                                    days_long=30)
+    histories = {"USD": fake_history('2020-06-01', '2021-03-31') / 100,
+                 "NESN.SW": fake_history('2020-11-02', '2021-03-31').drop(pd.Timestamp('2021-01-06'))}
+    histories["NESN.SW"].loc['2021-02-10', 'Close'] = np.nan
+    portfolio.assets["USD"] = sim_trade.Asset(sim_trade.CURRENCY, "USD", "USDEUR=X", "FX", "USD", histories["USD"])
+    portfolio.assets["NESN.SW"] = sim_trade.Asset(sim_trade.EQUITY, "Nestle", "NESN.SW", "VIRTX", "CHF",
+                                                  histories["NESN.SW"])
+    portfolio.calc_stats(windows=[60])
+    for key, history in histories.items():
+        stats = portfolio.assets[key].history
+        assert stats.index.equals(history.index)
+        for suffix, window in (('short', 5), ('long', 30), ('60', 60)):
+            rolling = history['Close'].rolling(window=window)
+            assert np.array_equal(stats['sma_' + suffix], rolling.mean(), equal_nan=True)
+            assert np.array_equal(stats['std_' + suffix], rolling.std(), equal_nan=True)
+    # ricalcolare sostituisce le colonne invece di duplicarle, e toglie le finestre non più richieste
+    portfolio.calc_stats()
+    assert list(portfolio.assets["USD"].history.columns) == sim_trade.QUOTE_COLUMNS + [
+        'sma_short', 'sma_long', 'std_short', 'std_long']
+    portfolio.calc_stats(windows=[10])
+    assert list(portfolio.assets["NESN.SW"].history.columns) == sim_trade.QUOTE_COLUMNS + [
+        'sma_short', 'sma_long', 'std_short', 'std_long', 'sma_10', 'std_10']
+    assert np.array_equal(portfolio.assets["NESN.SW"].history['std_10'],
+                          histories["NESN.SW"]['Close'].rolling(window=10).std(), equal_nan=True)
@@ -0,0 +1,141 @@
+import copy
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sim_trade
+from test_quote_store import fake_history
+
+
+def make_portfolio(windows=()):
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-03-01'), pd.Timestamp('2021-03-31'), 1000.0, days_short=5,
+                                    days_long=10)
+    portfolio.assets["USD"] = sim_trade.Asset(sim_trade.CURRENCY, "USD", "USDEUR=X", "FX", "USD",
+                                              fake_history('2021-01-04', '2021-03-31') / 100)
+    portfolio.assets["NESN.SW"] = sim_trade.Asset(sim_trade.EQUITY, "Nestle", "NESN.SW", "VIRTX", "CHF",
+                                                  fake_history('2021-01-04', '2021-03-31'))
+    portfolio.calc_stats(windows=windows)
+    portfolio.fix_history_data()
+    return portfolio
+
+
+def test_panel_is_aligned_and_history_is_a_view():
+    portfolio = make_portfolio()
+    panel = portfolio.market_data
+    assert panel.symbols == ["NESN.SW", "USD"]
+    assert panel.dates.equals(pd.bdate_range('2021-02-22', '2021-03-31'))
+    assert all(panel.field(name).shape == (len(panel.dates), 2) for name in panel.fields)
+    day = pd.Timestamp('2021-03-10')
+    i, j = panel.date_pos(day), panel.symbol_pos("NESN.SW")
+    nestle = portfolio.assets["NESN.SW"]
+    assert panel.field('Close')[i, j] == nestle.history.loc[day, 'Close']
+    assert panel.field('sma_long')[i, panel.symbol_pos("USD")] == portfolio.assets["USD"].history.loc[day, 'sma_long']
+    # le scritture via .loc finiscono nel pannello e viceversa
+    nestle.history.loc[day, 'OwnedAmount'] += 10
+    assert panel.field('OwnedAmount')[i, j] == 10
+    panel.field('AverageBuyPrice')[i, j] = 42.0
+    assert nestle.history.loc[day, 'AverageBuyPrice'] == 42.0
+    # i nuovi campi compaiono nelle viste
+    panel.add_field('CloseEUR', panel.field('Close') * 2)
+    assert nestle.history.loc[day, 'CloseEUR'] == 2 * nestle.history.loc[day, 'Close']
+    nestle.history.loc[day, 'OwnedAmount'] = 5
+    assert panel.field('OwnedAmount')[i, j] == 5
+
+
+def test_deepcopy_gets_its_own_panel():
+    portfolio = make_portfolio()
+    clone = copy.deepcopy(portfolio)
+    day = pd.Timestamp('2021-03-10')
+    clone.assets["NESN.SW"].history.loc[day, 'OwnedAmount'] = 7
+    i, j = clone.market_data.date_pos(day), clone.market_data.symbol_pos("NESN.SW")
+    assert clone.market_data.field('OwnedAmount')[i, j] == 7
+    assert portfolio.market_data.field('OwnedAmount')[i, j] == 0
+    assert portfolio.assets["NESN.SW"].history.loc[day, 'OwnedAmount'] == 0
+    for name in portfolio.market_data.fields:
+        assert not np.shares_memory(clone.market_data.field(name), portfolio.market_data.field(name))
+
+
+def test_clone_shares_market_data_and_copies_the_state():
+    portfolio = make_portfolio()
+    day = pd.Timestamp('2021-03-10')
+    portfolio.pendingTransactions.add(sim_trade.Transaction("BUY", portfolio.assets["NESN.SW"], day, 1))
+    clone = portfolio.clone()
+    panel, fork = portfolio.market_data, clone.market_data
+    for name in panel.fields:
+        assert np.shares_memory(fork.field(name), panel.field(name)) == (name not in sim_trade.STATE_COLUMNS)
+    i, j = fork.date_pos(day), fork.symbol_pos("NESN.SW")
+    clone.assets["NESN.SW"].history.loc[day, 'OwnedAmount'] = 7
+    clone.por_history.loc[day, 'Liquidity'] = 0.0
+    assert fork.field('OwnedAmount')[i, j] == 7 and panel.field('OwnedAmount')[i, j] == 0
+    assert portfolio.por_history.loc[day, 'Liquidity'] == 1000.0
+    # le quotazioni sono in sola lettura nel clone
+    with pytest.raises(ValueError):
+        clone.assets["NESN.SW"].history.loc[day, 'Close'] = 0.0
+    # le transazioni sono copie che puntano agli asset del clone
+    tx = clone.pendingTransactions[day][0]
+    assert tx is not portfolio.pendingTransactions[day][0] and tx.asset is clone.assets["NESN.SW"]
+    assert clone.indicators is portfolio.indicators
+
+
+def test_convert_currencies_handles_any_currency_and_pence():
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-03-01'), pd.Timestamp('2021-03-31'), 1000.0, days_short=5,
+                                    days_long=10)
+    for key, asset_class, symbol, currency in (("GBP", sim_trade.CURRENCY, "GBPEUR=X", "GBP"),
+                                               ("JPY", sim_trade.CURRENCY, "JPYEUR=X", "JPY"),
+                                               ("LSE.L", sim_trade.EQUITY, "LSE.L", "GBP"),
+                                               ("7203.T", sim_trade.EQUITY, "7203.T", "JPY"),
+                                               ("ENEL.MI", sim_trade.EQUITY, "ENEL.MI", "EUR")):
+        portfolio.assets[key] = sim_trade.Asset(asset_class, key, symbol, "TEST", currency)
+    assert portfolio.loadQuotations(provider=sim_trade.SyntheticProvider(seed=2)) == {}
+    portfolio.calc_stats()
+    portfolio.fix_history_data()
+    panel = portfolio.market_data
+    day = panel.date_pos('2021-03-10')
+    for key, rate, units in (("LSE.L", "GBP", 100.0), ("7203.T", "JPY", 1.0), ("ENEL.MI", None, 1.0)):
+        j = panel.symbol_pos(key)
+        for field in ('Open', 'Close'):
+            conv = 1.0 if rate is None else panel.field(field)[day, panel.symbol_pos(rate)] / units
+            assert panel.field(field + 'FX')[day, j] == conv
+            assert panel.field(field + 'EUR')[day, j] == panel.field(field)[day, j] * conv
+
+
+def test_load_asset_list_adds_a_rate_for_every_currency(tmp_path, monkeypatch):
+    (tmp_path / "sim_trade").mkdir()
+    (tmp_path / "sim_trade" / "AssetsInScope.csv").write_text(
+        "SYMBOL,Full Name,Asset Class,Market,Currency\n7203.T,Toyota,equity,TSE,JPY\nENEL.MI,Enel,equity,MTA,EUR\n"
+        "AMZN,\"Amazon.com, Inc.\",equity,NASDAQ,USD\n")
+    monkeypatch.chdir(tmp_path)
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-03-01'), pd.Timestamp('2021-03-31'))
+    portfolio.loadAssetList()
+    assert list(portfolio.assets) == ["USD", "GBP", "CHF", "JPY", "7203.T", "ENEL.MI", "AMZN"]
+    assert portfolio.assets["JPY"].symbol == "JPYEUR=X"
+    assert portfolio.assets["JPY"].assetType.assetType == "currency"
+
+
+def test_shared_panel_is_mapped_not_copied():
+    portfolio = make_portfolio(windows=[5])
+    shared = portfolio.share()
+    panel = shared.market_data
+    try:
+        for name in portfolio.market_data.fields:
+            assert np.array_equal(panel.field(name), portfolio.market_data.field(name), equal_nan=True)
+            assert not panel.field(name).flags.writeable
+        assert len(pickle.dumps(shared)) < len(pickle.dumps(portfolio)) / 2
+        loaded = pickle.loads(pickle.dumps(shared))
+        assert np.array_equal(loaded.market_data.field('Close'), panel.field('Close'))
+        # il clone ha lo stato privato: serializzato viaggia per intero, le quotazioni restano nel file
+        day = pd.Timestamp('2021-03-10')
+        clone = shared.clone(days_long=5)
+        clone.assets["NESN.SW"].history.loc[day, 'OwnedAmount'] = 7
+        loaded = pickle.loads(pickle.dumps(clone))
+        assert loaded.assets["NESN.SW"].history.loc[day, 'OwnedAmount'] == 7
+        assert loaded.assets["NESN.SW"].history.loc[day, 'sma_long'] == clone.assets["NESN.SW"].history.loc[day,
+                                                                                                            'sma_5']
+        assert not loaded.market_data.field('Close').flags.writeable
+    finally:
+        panel.unlink()
+    assert not os.path.exists(panel._path)
+    assert loaded.market_data.field('Close')[0, 0] == portfolio.market_data.field('Close')[0, 0]
@@ -0,0 +1,32 @@
+import pstats
+
+import numpy as np
+import pytest
+
+import sim_trade
+
+
+def test_stages_record_time_and_memory(tmp_path):
+    profiler = sim_trade.Profiler(trace_memory=True, profile=str(tmp_path / "stages.prof"))
+    with profiler.stage("outer"):
+        with profiler.stage("inner"):
+            block = np.ones(2 ** 20)
+            del block
+        np.sort(np.random.default_rng(0).random(10 ** 5))
+    table = profiler.table()
+    assert list(table['Stage']) == ["outer", "inner"]
+    assert (table[['Wall s', 'CPU s', 'Max RSS MiB']] > 0).all().all()
+    # il picco della fase annidata vale anche per quella che la contiene
+    inner, outer = table['Peak MiB']
+    assert inner >= 8 and outer >= inner
+    profiler.dump()
+    assert pstats.Stats(str(tmp_path / "stages.prof")).total_calls > 0
+
+
+def test_dump_needs_a_profile_file():
+    profiler = sim_trade.Profiler()
+    with profiler.stage("only"):
+        pass
+    assert np.isnan(profiler.table()['Peak MiB'][0])
+    with pytest.raises(ValueError):
+        profiler.dump()
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+import sim_trade
+
+
+def make_portfolio():
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-01-04'), pd.Timestamp('2021-06-30'), 1000.0)
+    portfolio.assets["USD"] = sim_trade.Asset(sim_trade.CURRENCY, "USD", "USDEUR=X", "FX", "USD")
+    portfolio.assets["NESN.SW"] = sim_trade.Asset(sim_trade.EQUITY, "Nestle", "NESN.SW", "VIRTX", "CHF")
+    return portfolio
+
+
+def test_synthetic_provider_is_deterministic_across_windows():
+    provider = sim_trade.SyntheticProvider(seed=7)
+    full = provider.get_quotes("NESN.SW", '2020-01-01', '2021-12-31')
+    part = provider.get_quotes("NESN.SW", '2021-03-01', '2021-06-30')
+    assert list(full.columns) == sim_trade.QUOTE_COLUMNS
+    assert full.loc['2021-03-01':'2021-06-30'].equals(part)
+    assert sim_trade.SyntheticProvider(seed=8).get_quotes("NESN.SW", '2021-03-01', '2021-06-30')['Close'].iloc[
+        0] != part['Close'].iloc[0]
+    assert (full['High'] >= full[['Open', 'Close']].max(axis=1)).all()
+    assert (full['Low'] <= full[['Open', 'Close']].min(axis=1)).all()
+    actions = provider.get_actions("NESN.SW", '2020-01-01', '2021-12-31')
+    assert set(actions['action']) == {"DIVIDEND"} and 7 <= len(actions) <= 9
+    assert len(provider.get_actions("USDEUR=X", '2020-01-01', '2021-12-31')) == 0
+
+
+def test_synthetic_defects_are_deterministic_and_repaired():
+    provider = sim_trade.SyntheticProvider(seed=4, gap_rate=0.05, split_rate=1.0, glitch_rate=0.02)
+    clean = sim_trade.SyntheticProvider(seed=4).get_quotes("LSE.L", '2018-01-01', '2021-06-30')
+    quotes = provider.get_quotes("LSE.L", '2018-01-01', '2021-06-30')
+    assert quotes.loc['2021-01-01':].equals(provider.get_quotes("LSE.L", '2021-01-01', '2021-06-30'))
+    assert 0.9 * len(clean) < len(quotes) < len(clean)
+    glitch = quotes['Close'] < clean.loc[quotes.index, 'Close']
+    assert glitch.any() and np.allclose(quotes.loc[glitch, 'Close'] * 100, clean.loc[quotes.index[glitch], 'Close'])
+    # solo i titoli di Londra hanno giorni in pound
+    nesn = provider.get_quotes("NESN.SW", '2018-01-01', '2021-06-30')
+    assert nesn.equals(sim_trade.SyntheticProvider(seed=4).get_quotes("NESN.SW", '2018-01-01', '2021-06-30').loc[
+                           nesn.index])
+    actions = provider.get_actions("LSE.L", '2018-01-01', '2021-06-30')
+    assert set(actions['action']) == {"DIVIDEND", "SPLIT"}
+    assert set(actions.loc[actions['action'] == "SPLIT", 'value']) <= {2.0, 3.0}
+    # fix_history_data riempie i buchi e riporta in pence i giorni in pound
+    portfolio = sim_trade.Portfolio(pd.Timestamp('2021-01-04'), pd.Timestamp('2021-06-30'), 1000.0)
+    portfolio.assets["GBP"] = sim_trade.Asset(sim_trade.CURRENCY, "GBP", "GBPEUR=X", "FX", "GBP")
+    portfolio.assets["LSE.L"] = sim_trade.Asset(sim_trade.EQUITY, "LSE", "LSE.L", "LSE", "GBP")
+    assert portfolio.loadQuotations(provider=provider) == {}
+    portfolio.calc_stats()
+    portfolio.fix_history_data()
+    fixed = portfolio.assets["LSE.L"].history.loc['2021-01-04':, 'Close']
+    assert fixed.index.equals(pd.bdate_range('2021-01-04', '2021-06-30'))
+    assert (fixed > 0.5 * clean.loc['2021-01-04':'2021-06-30', 'Close'].min()).all()
+
+
+def test_load_quotations_offline_from_directory(tmp_path):
+    provider = sim_trade.SyntheticProvider(seed=1)
+    for symbol in ("USDEUR=X", "NESN.SW"):
+        provider.get_quotes(symbol, '2019-01-01', '2021-12-31').to_csv(
+            tmp_path / (symbol.replace("=", "_") + ".csv"))
+    provider.get_actions("NESN.SW", '2019-01-01', '2021-12-31').to_csv(tmp_path / "NESN.SW.actions.csv",
+                                                                       index_label='Date')
+
+    from_files = make_portfolio()
+    assert from_files.loadQuotations(provider=sim_trade.DirectoryProvider(str(tmp_path))) == {}
+    synthetic = make_portfolio()
+    synthetic.loadQuotations(provider=provider)
+    for key in ("USD", "NESN.SW"):
+        assert np.allclose(from_files.assets[key].history.to_numpy(), synthetic.assets[key].history.to_numpy())
+    dividends = [t for day in synthetic.pendingTransactions.values() for t in day]
+    assert len(dividends) == 2
+    from_csv = [t for day in from_files.pendingTransactions.values() for t in day]
+    assert [(t.when, t.verb) for t in from_csv] == [(t.when, t.verb) for t in dividends]
+    assert np.allclose([t.value for t in from_csv], [t.value for t in dividends])
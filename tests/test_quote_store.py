@@ -0,0 +1,169 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.tseries.offsets import BDay
+
+import sim_trade
+
+
+def fake_history(start, end):
+    # quotazioni deterministiche: il valore dipende solo dalla data, così finestre diverse sono confrontabili
+    index = pd.bdate_range(start, end, name='Date')
+    close = 100.0 + np.array([d.toordinal() % 97 for d in index], dtype=float)
+    return pd.DataFrame({'High': close + 1, 'Low': close - 1, 'Open': close, 'Close': close,
+                         'Volume': np.full(len(index), 1000), 'Adj Close': close}, index=index)
+
+
+def fake_actions(start, end):
+    dates = [d for d in pd.to_datetime(['2020-03-16', '2020-09-15', '2021-03-15']) if start <= d <= end]
+    return pd.DataFrame({'action': ['DIVIDEND'] * len(dates), 'value': [0.5] * len(dates)},
+                        index=pd.DatetimeIndex(dates, name='Date')).sort_index(ascending=False)
+
+
+def fake_yahoo_data(start, end):
+    # come Yahoo con get_actions=True: quotazioni più una colonna Dividends, con righe anche nei giorni festivi
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    dividends = fake_actions(start, end)['value'].rename('Dividends')
+    data = fake_history(start, end).join(dividends, how='outer')
+    data.index.name = 'Date'
+    return data
+
+
+@pytest.fixture
+def fake_yahoo(monkeypatch):
+    calls = []
+
+    def get_data_yahoo(symbol, start, end, session=None, get_actions=False):
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        calls.append((symbol, start, end))
+        return fake_yahoo_data(start, end)
+
+    monkeypatch.setattr(sim_trade.pdr, "get_data_yahoo", get_data_yahoo, raising=False)
+    return calls
+
+
+def make_portfolio(start_date, end_date, days_long=150):
+    portfolio = sim_trade.Portfolio(start_date, end_date, 1000.0, days_short=20, days_long=days_long)
+    portfolio.assets["NESN.SW"] = sim_trade.Asset(sim_trade.EQUITY, "Nestle", "NESN.SW", "VIRTX", "CHF")
+    portfolio.assets["USD"] = sim_trade.Asset(sim_trade.CURRENCY, "USD", "USDEUR=X", "FX", "USD")
+    return portfolio
+
+
+def test_save_load_round_trip(tmp_path):
+    store = sim_trade.QuoteStore(str(tmp_path))
+    history = fake_history('2020-01-01', '2020-12-31')
+    store.save("USDEUR=X", history, pd.DataFrame(), '2020-01-01', '2020-12-31')
+    assert store.window("USDEUR=X") == (pd.Timestamp('2020-01-01'), pd.Timestamp('2020-12-31'))
+    assert store.last_bar("USDEUR=X") == pd.Timestamp('2020-12-31')
+    loaded, actions = store.load("USDEUR=X")
+    assert np.array_equal(loaded.to_numpy(), history.to_numpy(dtype='float64'))
+    assert loaded.index.equals(history.index)
+    assert list(loaded.columns) == sim_trade.QUOTE_COLUMNS
+    assert len(actions) == 0 and list(actions.columns) == ['action', 'value']
+    assert store.window("MISSING") is None and store.last_bar("MISSING") is None
+
+
+def test_load_sub_window_and_actions_filter(tmp_path):
+    store = sim_trade.QuoteStore(str(tmp_path))
+    store.save("NESN.SW", fake_history('2020-01-01', '2021-12-31'), fake_actions(pd.Timestamp('2020-01-01'),
+               pd.Timestamp('2021-12-31')), '2020-01-01', '2021-12-31')
+    history, actions = store.load("NESN.SW", '2020-06-01', '2020-12-31')
+    assert history.index[0] == pd.Timestamp('2020-06-01') and history.index[-1] == pd.Timestamp('2020-12-31')
+    assert list(actions.index) == [pd.Timestamp('2020-09-15')]
+    assert actions['action'].iloc[0] == 'DIVIDEND' and actions['value'].iloc[0] == 0.5
+
+
+def test_load_wraps_memory_map_without_copy(tmp_path):
+    store = sim_trade.QuoteStore(str(tmp_path))
+    store.save("NESN.SW", fake_history('2020-01-01', '2020-12-31'), pd.DataFrame(), '2020-01-01', '2020-12-31')
+    history, actions = store.load("NESN.SW", '2020-06-01', '2020-06-30')
+    # to_numpy è una vista: risalendo le basi si arriva alla mappa del file salvato
+    values = history.to_numpy()
+    while not isinstance(values, np.memmap) and values.base is not None:
+        values = values.base
+    assert isinstance(values, np.memmap) and values.filename == os.path.abspath(store._file("NESN.SW", "values.npy"))
+    # la mappa è copy-on-write: una correzione in memoria non tocca il file
+    history.loc[pd.Timestamp('2020-06-01'), 'Close'] = -1.0
+    assert store.load("NESN.SW", '2020-06-01', '2020-06-01')[0]['Close'].iloc[0] != -1.0
+
+
+def test_window_ends_at_last_received_bar(tmp_path):
+    store = sim_trade.QuoteStore(str(tmp_path))
+    # il 2021-01-01 è festivo: la finestra non può dichiarare di arrivare a una data senza quotazioni
+    store.save("NESN.SW", fake_history('2020-06-01', '2020-12-31'), pd.DataFrame(), '2020-06-01', '2021-01-05')
+    assert store.window("NESN.SW")[1] == pd.Timestamp('2020-12-31')
+    assert not store.covers("NESN.SW", '2020-06-01', '2021-01-05')
+    assert store.covers("NESN.SW", '2020-06-01', '2020-12-31')
+
+
+def test_partial_bar_of_today_is_downloaded_again(tmp_path, monkeypatch):
+    store = sim_trade.QuoteStore(str(tmp_path))
+    today = pd.Timestamp('2021-03-10')
+    monkeypatch.setattr(sim_trade.QuoteStore, "last_completed_day", staticmethod(lambda: today - BDay(1)))
+    store.save("NESN.SW", fake_history('2021-01-04', '2021-03-10'), pd.DataFrame(), '2021-01-04', '2021-03-10')
+    # la barra parziale di oggi viene salvata, ma la finestra si ferma all'ultima giornata chiusa
+    assert store.last_bar("NESN.SW") == today
+    assert store.window("NESN.SW")[1] == today - BDay(1)
+    monkeypatch.setattr(sim_trade.QuoteStore, "last_completed_day", staticmethod(lambda: today))
+    assert not store.covers("NESN.SW", '2021-01-04', today + BDay(1))
+
+
+def test_update_replaces_overlap_and_keeps_older_rows(tmp_path):
+    store = sim_trade.QuoteStore(str(tmp_path))
+    store.save("NESN.SW", fake_history('2020-01-01', '2020-06-30'), pd.DataFrame(), '2020-01-01', '2020-06-30')
+    revised = fake_history('2020-06-24', '2020-07-31')
+    revised['Close'] = -1.0
+    store.update("NESN.SW", revised, fake_actions(pd.Timestamp('2020-06-24'), pd.Timestamp('2020-07-31')),
+                 '2020-06-24', '2020-07-31')
+    history, actions = store.load("NESN.SW")
+    assert not history.index.has_duplicates
+    assert (history.loc[:'2020-06-23', 'Close'] > 0).all()
+    assert (history.loc['2020-06-24':, 'Close'] == -1.0).all()
+    assert history.index[-1] == pd.Timestamp('2020-07-31')
+    assert store.window("NESN.SW") == (pd.Timestamp('2020-01-01'), pd.Timestamp('2020-07-31'))
+    # aggiungo i giorni più vecchi senza perdere quelli già salvati
+    store.update("NESN.SW", fake_history('2019-12-02', '2019-12-31'), pd.DataFrame(), '2019-12-02', '2019-12-31')
+    history, actions = store.load("NESN.SW")
+    assert history.index[0] == pd.Timestamp('2019-12-02') and history.index[-1] == pd.Timestamp('2020-07-31')
+    assert store.window("NESN.SW") == (pd.Timestamp('2019-12-02'), pd.Timestamp('2020-07-31'))
+
+
+def test_load_quotations_fetches_only_missing_days(tmp_path, fake_yahoo):
+    store = sim_trade.QuoteStore(str(tmp_path / "quotes"))
+    cache = str(tmp_path / "cache")
+    start_date = pd.Timestamp('2021-01-04')
+    portfolio = make_portfolio(start_date, pd.Timestamp('2021-03-31'))
+    portfolio.loadQuotations(cache, store=store)
+    # una sola richiesta per simbolo, quotazioni e dividendi insieme, a partire dal primo gennaio
+    assert sorted(fake_yahoo) == [("NESN.SW", pd.Timestamp('2020-01-01'), pd.Timestamp('2021-03-31')),
+                                  ("USDEUR=X", pd.Timestamp('2020-01-01'), pd.Timestamp('2021-03-31'))]
+
+    # stessa finestra: nessuna richiesta
+    del fake_yahoo[:]
+    make_portfolio(start_date, pd.Timestamp('2021-03-31')).loadQuotations(cache, store=store)
+    assert fake_yahoo == []
+
+    # finestra più lunga: scarico solo la coda, con qualche giorno di sovrapposizione
+    portfolio = make_portfolio(start_date, pd.Timestamp('2021-04-30'))
+    portfolio.loadQuotations(cache, store=store, overlap=5)
+    assert {call[1] for call in fake_yahoo} == {pd.Timestamp('2021-03-31') - BDay(5)}
+    full = fake_history(start_date - BDay(170), pd.Timestamp('2021-04-30'))
+    assert np.array_equal(portfolio.assets["NESN.SW"].history.to_numpy(), full.to_numpy(dtype='float64'))
+    assert [t.when for t in portfolio.pendingTransactions[pd.Timestamp('2021-03-15')]] == [
+        pd.Timestamp('2021-03-15')]
+
+    # days_long un po' più lungo: la finestra scaricata dal primo gennaio basta già
+    del fake_yahoo[:]
+    make_portfolio(start_date, pd.Timestamp('2021-04-30'), days_long=200).loadQuotations(cache, store=store)
+    assert fake_yahoo == []
+
+    # days_long molto più lungo: scarico solo la testa mancante
+    portfolio = make_portfolio(start_date, pd.Timestamp('2021-04-30'), days_long=400)
+    portfolio.loadQuotations(cache, store=store)
+    initial_data_day = start_date - BDay(420)
+    assert {(call[1], call[2]) for call in fake_yahoo} == {
+        (pd.Timestamp('2019-01-01'), pd.Timestamp('2019-12-31'))}
+    full = fake_history(initial_data_day, pd.Timestamp('2021-04-30'))
+    assert np.array_equal(portfolio.assets["NESN.SW"].history.to_numpy(), full.to_numpy(dtype='float64'))
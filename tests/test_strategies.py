@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.tseries.offsets import BDay
+
+import sim_trade
+
+SYMBOLS = ["AMZN", "MSFT", "NESN.SW", "LSE.L", "ENEL.MI", "DPZ"]
+
+
+def synthetic_portfolio(start_date='2021-01-04', end_date='2021-12-31', seed=3, days_long=150, windows=()):
+    portfolio = sim_trade.Portfolio(pd.Timestamp(start_date), pd.Timestamp(end_date), 100000.0, days_short=20,
+                                    days_long=days_long)
+    for currency in ("USD", "GBP", "CHF"):
+        portfolio.assets[currency] = sim_trade.Asset(sim_trade.CURRENCY, currency, currency + "EUR=X", "FX", currency)
+    currencies = {".SW": "CHF", ".L": "GBP", ".MI": "EUR"}
+    for symbol in SYMBOLS:
+        currency = next((c for suffix, c in currencies.items() if symbol.endswith(suffix)), "USD")
+        portfolio.assets[symbol] = sim_trade.Asset(sim_trade.EQUITY, symbol, symbol, "TEST", currency)
+    assert portfolio.loadQuotations(provider=sim_trade.SyntheticProvider(seed=seed, volatility=0.6)) == {}
+    portfolio.calc_stats(windows=windows)
+    portfolio.fix_history_data()
+    return portfolio
+
+
+def signals(pending):
+    return [(t.when, t.verb, t.asset.symbol, t.note, t.score) for day in sorted(pending) for t in pending[day]
+            if t.verb in ("BUY", "SELL")]
+
+
+def test_inv_bollbands_signals_match_day_by_day_rules():
+    strategy = sim_trade.InvBollbandsStrategy(synthetic_portfolio())
+    found = signals(strategy.calc_suggested_transactions(sell_all=False, initial_buy=False, w_long=1.0))
+    expected = []
+    for dd in pd.date_range(strategy.outcome.start_date, strategy.outcome.end_date - BDay(1), freq='B'):
+        for key, asset in sorted(strategy.outcome.assets.items()):
+            today, prev = asset.history.loc[dd], asset.history.loc[dd - BDay(1)]
+            if asset.assetType.assetType == "currency" or not today['Close'] > 0.0:
+                continue
+            score = 100.0 * today['std_short'] / today['sma_long']
+            up, up_old = today['sma_long'] + today['std_long'], prev['sma_long'] + prev['std_long']
+            down, down_old = today['sma_long'] - today['std_long'], prev['sma_long'] - prev['std_long']
+            if score > 3.0 and today['Close'] >= up and prev['Close'] <= up_old:
+                expected.append((dd + BDay(1), "BUY", key, "TRENDING UP", score))
+            elif today['Close'] <= down and prev['Close'] >= down_old:
+                expected.append((dd + BDay(1), "SELL", key, "TRENDING DOWN", score))
+    assert len(expected) > 10 and {s[1] for s in expected} == {"BUY", "SELL"}
+    assert found == expected
+
+
+def test_simulation_accounting_is_consistent():
+    strategy = sim_trade.InvBollbandsStrategy(synthetic_portfolio())
+    strategy.calc_suggested_transactions(sell_all=True, initial_buy=False, w_long=1.0)
+    outcome = strategy.runTradingSimulation(max_orders=5)
+    executed = [t for t in outcome.executedTransactions if t.verb in ("BUY", "SELL")]
+    assert {t.verb for t in executed} == {"BUY", "SELL"}
+    por = outcome.por_history.loc[outcome.start_date + BDay(1):]
+    commissions = sum(t.value * t.asset.assetType.buyCommission for t in executed)
+    assert np.isclose(por['TotalCommissions'].iloc[-1], commissions)
+    cash_flow = sum(-t.value if t.verb == "BUY" else t.value for t in executed)
+    # le tasse sui dividendi sono già sottratte dai dividendi netti
+    rate = sim_trade.EQUITY.tax_rate
+    dividend_taxes = por['TotalDividens'].iloc[-1] * rate / (1 - rate)
+    assert np.isclose(por['Liquidity'].iloc[-1], 100000.0 + cash_flow - commissions - por['TotalTaxes'].iloc[-1] +
+                      dividend_taxes + por['TotalDividens'].iloc[-1])
+    # il valore netto è liquidità più il valore delle posizioni
+    net_worth = sum(asset.history.loc[por.index, 'NetWorth'] * (asset.history.loc[por.index, 'OwnedAmount'] > 0)
+                    for asset in outcome.assets.values())
+    assert np.allclose(por['NetValue'], por['Liquidity'] + net_worth)
+    # sell_all: l'ultimo giorno non resta nulla in portafoglio
+    assert all(asset.history.loc[outcome.end_date, 'OwnedAmount'] == 0 for asset in outcome.assets.values())
+
+
+def test_trades_are_exported_in_bulk(tmp_path):
+    strategy = sim_trade.InvBollbandsStrategy(synthetic_portfolio())
+    strategy.calc_suggested_transactions(sell_all=True, initial_buy=False, w_long=1.0)
+    outcome = strategy.runTradingSimulation(max_orders=5)
+    trades = outcome.executedTransactions.frame()
+    assert len(trades) == len(outcome.executedTransactions) > 0
+    assert list(trades['symbol']) == [t.asset.symbol for t in outcome.executedTransactions]
+    assert list(trades['value']) == [t.value for t in outcome.executedTransactions]
+    assert (trades['state'] == "executed").all()
+    assert (outcome.failedTransactions.frame()['state'] == "failed").all()
+    # il clone copia le tabelle e punta ai propri asset
+    clone = outcome.clone()
+    assert clone.executedTransactions.frame().equals(trades)
+    assert clone.executedTransactions[0].asset is clone.assets[trades['symbol'][0]]
+    pytest.importorskip("pyarrow")
+    outcome.executedTransactions.to_parquet(tmp_path / "trades.parquet")
+    assert pd.read_parquet(tmp_path / "trades.parquet")[['symbol', 'quantity']].equals(trades[['symbol', 'quantity']])
+
+
+def test_one_pass_valuation_matches_the_simulation():
+    strategy = sim_trade.InvBollbandsStrategy(synthetic_portfolio())
+    strategy.calc_suggested_transactions(sell_all=False, initial_buy=True, w_long=1.0)
+    outcome = strategy.runTradingSimulation(max_orders=5)
+    simulated = outcome.por_history['NetValue'].copy()
+    worth = outcome.market_data.field('NetWorth').copy()
+    values = outcome.port_net_value()
+    days = outcome.por_history.index[outcome.por_history.index >= outcome.start_date + BDay(1)]
+    assert np.array_equal(outcome.por_history.loc[days, 'NetValue'], simulated[days])
+    assert np.array_equal(outcome.market_data.field('NetWorth'), worth)
+    assert len(values) == len(outcome.por_history)
+    day = days[100]
+    assert outcome.port_net_value(day) == simulated[day]
+
+
+def test_signal_table_keeps_long_symbols_and_reasons():
+    portfolio = synthetic_portfolio()
+    key, asset = next((key, asset) for key, asset in portfolio.assets.items() if asset.symbol != portfolio.defCurrency
+                      and asset.assetType.assetType != "currency")
+    long_key = key + ".A-VERY-LONG-EXCHANGE-SUFFIX"
+    portfolio.assets[long_key] = asset
+    reason = "REBALANCING AFTER A VERY LONG EXPLANATION"
+    table = sim_trade.signal_table([(portfolio.start_date, long_key, "BUY", 10.0, reason)])
+    assert table['symbol'][0] == long_key and table['reason'][0] == reason
+    sim_trade.BuyAndHoldTradingStrategy.schedule(table, portfolio)
+    assert portfolio.pendingTransactions[portfolio.start_date][0].note == reason
+
+
+def test_one_signal_table_feeds_many_executions():
+    portfolio = synthetic_portfolio()
+    strategy = sim_trade.InvBollbandsStrategy(portfolio)
+    strategy.calc_suggested_transactions(sell_all=True, initial_buy=True, w_long=1.0)
+    table = strategy.signals
+    assert table.dtype == sim_trade.SIGNAL_DTYPE and not table.flags.writeable
+    rows = sorted(table.tolist(), key=lambda row: row[0])
+    assert signals(strategy.outcome.pendingTransactions) == [
+        (pd.Timestamp(dd), verb, symbol, reason, score) for dd, symbol, verb, score, reason in rows]
+    snapshot = table.copy()
+    runs = {max_orders: strategy.execute(max_orders=max_orders) for max_orders in (5, 10)}
+    assert np.array_equal(table, snapshot)
+    assert not strategy.outcome.executedTransactions
+    # stesso risultato di una strategia che ricalcola i segnali
+    for max_orders, outcome in runs.items():
+        fresh = sim_trade.InvBollbandsStrategy(portfolio)
+        fresh.calc_suggested_transactions(sell_all=True, initial_buy=True, w_long=1.0)
+        expected = fresh.runTradingSimulation(max_orders=max_orders)
+        assert [str(t) for t in outcome.executedTransactions] == [str(t) for t in expected.executedTransactions]
+        assert outcome.por_history.equals(expected.por_history)
+    assert not runs[5].por_history.equals(runs[10].por_history)
+    richer = strategy.execute(max_orders=5, initial_capital=200000.0)
+    assert richer.por_history['Liquidity'].iloc[0] == 200000.0 and richer.initial_capital == 200000.0
+
+
+@pytest.mark.parametrize("strategy_class", [sim_trade.InvBollbandsStrategy, sim_trade.BollbandsStrategy])
+def test_batched_masks_match_single_runs(strategy_class):
+    portfolio = synthetic_portfolio(windows=[100])
+    strategy = strategy_class(portfolio)
+    panel = portfolio.market_data
+    first = panel.dates.searchsorted(portfolio.start_date)
+    last = panel.dates.searchsorted(portfolio.end_date - BDay(1), side='right')
+    params = [(1.0, 150), (1.5, 150), (1.0, 100)]
+    buy, sell, _ = strategy.signal_masks(slice(first, last), np.array([w for w, _ in params]),
+                                         np.array([days for _, days in params]), np.array([20, 20, 20]))
+    for p, (w_long, days_long) in enumerate(params):
+        single = strategy_class(portfolio.clone(days_long=days_long))
+        table = single.calc_signals(sell_all=False, initial_buy=False, w_long=w_long)
+        expected = sorted((pd.Timestamp(row[0]), row[1], row[2]) for row in table.tolist())
+        batched = sorted((panel.dates[first + i + 1], panel.symbols[j], "BUY" if buy[p, i, j] else "SELL")
+                         for i, j in zip(*np.nonzero(buy[p] | sell[p])))
+        assert len(expected) > 5 and batched == expected
+
+
+def test_screen_matches_a_day_by_day_model():
+    portfolio = synthetic_portfolio()
+    strategy = sim_trade.InvBollbandsStrategy(portfolio)
+    table = strategy.screen(w_long=[1.0, 0.5])
+    assert not hasattr(sim_trade.BuyAndHoldTradingStrategy(portfolio), 'screen')
+    assert list(table.columns[:3]) == ['w_long', 'days_long', 'days_short']
+    assert table['Final Net Value'].is_monotonic_decreasing
+    panel = portfolio.market_data
+    tradable = [key for key in panel.symbols if portfolio.assets[key].assetType.assetType != "currency"]
+    share = portfolio.initial_capital / len(tradable)
+    days = panel.dates[(panel.dates >= portfolio.start_date) & (panel.dates <= portfolio.end_date)]
+    for w_long in (1.0, 0.5):
+        signals = strategy.calc_signals(sell_all=False, initial_buy=False, w_long=w_long)
+        orders = {(pd.Timestamp(dd), key): verb for dd, key, verb, _, _ in signals.tolist()}
+        final = 0.0
+        for key in tradable:
+            history = portfolio.assets[key].history
+            value, held = share, False
+            for dd in days[1:]:
+                prev_close, (open_price, close) = history.loc[dd - BDay(1), 'CloseEUR'], history.loc[dd, ['OpenEUR',
+                                                                                                       'CloseEUR']]
+                verb = orders.get((dd, key))
+                if verb == "BUY" and not held:
+                    value *= (1 - sim_trade.EQUITY.buyCommission) * close / open_price
+                    held = True
+                elif verb == "SELL" and held:
+                    value *= (1 - sim_trade.EQUITY.buyCommission) * open_price / prev_close
+                    held = False
+                elif held:
+                    value *= close / prev_close
+            final += value
+        row = table[table.w_long == w_long].iloc[0]
+        assert np.isclose(row['Final Net Value'], final)
+        assert row['Trades'] > 0
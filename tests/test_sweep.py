@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+import sim_trade
+from test_strategies import synthetic_portfolio
+
+PARAMS = dict(w_long=(1.0, 1.5), days_short=(20,), days_long=(150, 100), max_orders=(5, 10))
+
+
+def test_sweep_ranks_every_combination_like_single_runs():
+    portfolio = synthetic_portfolio(windows=[100])
+    table = sim_trade.sweep(portfolio, processes=1, **PARAMS)
+    assert len(table) == 8 and table['Final Net Value'].is_monotonic_decreasing
+    reference = synthetic_portfolio(days_long=100)
+    row = table[(table.w_long == 1.5) & (table.days_long == 100) & (table.max_orders == 10)].iloc[0]
+    strategy = sim_trade.InvBollbandsStrategy(reference)
+    strategy.calc_suggested_transactions(sell_all=True, w_long=1.5)
+    outcome = strategy.runTradingSimulation(max_orders=10)
+    assert row['Final Net Value'] == outcome.por_history['NetValue'].iloc[-1]
+    assert row['Executed Tx'] == sum(t.verb in ("BUY", "SELL") for t in outcome.executedTransactions)
+    # stesso risultato con un pool di processi
+    parallel = sim_trade.sweep(portfolio, processes=2, **PARAMS)
+    pd.testing.assert_frame_equal(parallel, table)
+
+
+def test_sweep_needs_the_windows_from_calc_stats():
+    with pytest.raises(ValueError, match="sma_60"):
+        sim_trade.sweep(synthetic_portfolio(), days_long=(60,), processes=1)
+
+
+def test_successive_halving_is_deterministic_and_runs_a_fraction_of_the_grid():
+    portfolio = synthetic_portfolio('2020-01-02', '2021-12-31', windows=[100])
+    grid = dict(w_long=(0.5, 1.0, 1.5, 2.0), days_long=(150, 100), max_orders=(5, 10))
+    table = sim_trade.successive_halving(portfolio, eta=2, min_days=40, **grid)
+    pd.testing.assert_frame_equal(table, sim_trade.successive_halving(portfolio, eta=2, min_days=40, **grid))
+    calendar = pd.bdate_range(portfolio.start_date, portfolio.end_date)
+    sizes = table.groupby('Round').size()
+    assert list(sizes) == [16, 8, 4, 2, 1]
+    horizons = table.groupby('Round')['End'].first().map(calendar.get_loc)
+    assert horizons.iloc[-1] == len(calendar) - 1
+    assert (sizes * horizons).sum() < 0.5 * 16 * len(calendar)
+    # il vincitore ha il risultato di una simulazione completa con gli stessi parametri
+    best = table.iloc[0]
+    full = sim_trade.sweep(portfolio, w_long=[best['w_long']], days_long=[int(best['days_long'])],
+                           max_orders=[best['max_orders']], processes=1).iloc[0]
+    assert best['End'] == calendar[-1] and best['Final Net Value'] == full['Final Net Value']
+    # i sopravvissuti sono i migliori del round precedente
+    first = table[table.Round == 0]
+    assert set(table[table.Round == 1]['Configuration']) == set(first['Configuration'].iloc[:8])
+    sample = sim_trade.successive_halving(portfolio, configurations=6, seed=1, **grid)
+    assert (sample.Round == 0).sum() == 6
+    pd.testing.assert_frame_equal(sample, sim_trade.successive_halving(portfolio, configurations=6, seed=1, **grid))
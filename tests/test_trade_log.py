@@ -0,0 +1,52 @@
+import json
+import logging
+
+import pytest
+
+import sim_trade
+from test_strategies import synthetic_portfolio
+
+
+@pytest.fixture
+def debug_log():
+    root = logging.getLogger()
+    level = root.level
+    root.setLevel(logging.DEBUG)
+    yield
+    root.setLevel(level)
+    sim_trade.hot_path_logging(logging.NOTSET)
+
+
+def run(portfolio):
+    strategy = sim_trade.InvBollbandsStrategy(portfolio)
+    strategy.calc_suggested_transactions(sell_all=True, initial_buy=False, w_long=1.0)
+    return strategy.runTradingSimulation(max_orders=5)
+
+
+def test_fast_mode_does_not_format_the_transactions(debug_log, monkeypatch):
+    portfolio = synthetic_portfolio()
+    formatted = []
+    monkeypatch.setattr(sim_trade.Transaction, "__str__", lambda t: formatted.append(t) or "tx")
+    run(portfolio)
+    assert formatted
+    formatted.clear()
+    sim_trade.hot_path_logging()
+    outcome = run(portfolio)
+    # restano solo le note delle transazioni fallite
+    assert len(formatted) == len(outcome.failedTransactions)
+
+
+def test_trade_log_writes_one_event_per_transaction(tmp_path):
+    handler = sim_trade.trade_log(str(tmp_path / "trades.jsonl"), mode='w')
+    try:
+        outcome = run(synthetic_portfolio())
+    finally:
+        sim_trade.trades.removeHandler(handler)
+        handler.close()
+    events = [json.loads(line) for line in (tmp_path / "trades.jsonl").read_text().splitlines()]
+    trades = outcome.executedTransactions.frame()
+    assert len(events) == len(trades) + len(outcome.failedTransactions)
+    executed = [e for e in events if e['state'] == "executed"]
+    assert [e['symbol'] for e in executed] == list(trades['symbol'])
+    assert [e['value'] for e in executed] == list(trades['value'])
+    assert all('liquidity' in e for e in events)
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import BDay
+
+import sim_trade
+from test_strategies import synthetic_portfolio
+
+GRID = dict(w_long=(1.0, 1.5), days_long=(150, 100), max_orders=(5, 10))
+
+
+def test_window_starts_a_fresh_portfolio_on_the_shared_panel():
+    portfolio = synthetic_portfolio(windows=[100])
+    strategy = sim_trade.InvBollbandsStrategy(portfolio)
+    strategy.calc_suggested_transactions(sell_all=False, w_long=1.0)
+    simulated = strategy.runTradingSimulation(max_orders=5)
+    assert simulated.market_data.field('OwnedAmount').any()
+    start, end = pd.Timestamp('2021-03-01'), pd.Timestamp('2021-06-30')
+    window = simulated.window(start, end, days_long=100)
+    assert window.por_history.index.equals(sim_trade.Portfolio(start, end, 100000.0).por_history.index)
+    assert (window.por_history['Liquidity'] == 100000.0).all() and not window.executedTransactions
+    assert not window.market_data.field('OwnedAmount').any()
+    assert window.days_long == 100 and np.shares_memory(window.market_data.field('sma_long'),
+                                                         portfolio.market_data.field('sma_100'))
+    pending = [t for day in window.pendingTransactions.values() for t in day]
+    assert pending and all(start < t.when <= end and t.verb == "DIVIDEND" for t in pending)
+
+
+def test_walk_forward_picks_in_sample_and_scores_out_of_sample():
+    portfolio = synthetic_portfolio('2020-01-02', '2021-12-31', windows=[100])
+    table = sim_trade.walk_forward(portfolio, in_sample=120, out_of_sample=60, **GRID)
+    calendar = pd.bdate_range(portfolio.start_date, portfolio.end_date)
+    assert len(table) == len(range(119, len(calendar) - 60, 60)) > 3
+    ends = list(table['In Sample End'])
+    assert list(table['Out of Sample End']) == [end + 60 * BDay() for end in ends]
+    assert ends[1:] == [end + 60 * BDay() for end in ends[:-1]]
+    fold = table.iloc[1]
+    in_sample = sim_trade.sweep(portfolio.window(fold['In Sample Start'], fold['In Sample End']), processes=1,
+                                **GRID).iloc[0]
+    assert (fold[['w_long', 'days_long', 'max_orders']] == in_sample[['w_long', 'days_long', 'max_orders']]).all()
+    assert fold['In Sample Final Net Value'] == in_sample['Final Net Value']
+    window = portfolio.window(fold['In Sample End'], fold['Out of Sample End'], days_long=int(fold['days_long']))
+    strategy = sim_trade.InvBollbandsStrategy(window)
+    strategy.calc_suggested_transactions(sell_all=True, w_long=fold['w_long'])
+    outcome = strategy.runTradingSimulation(max_orders=fold['max_orders'])
+    assert fold['Final Net Value'] == outcome.por_history['NetValue'].iloc[-1]
+    anchored = sim_trade.walk_forward(portfolio, in_sample=120, out_of_sample=60, anchored=True, **GRID)
+    assert (anchored['In Sample Start'] == portfolio.start_date).all()